@@ -0,0 +1,118 @@
+""" Array versions of the trajnetplusplustools metrics, computed for all scenes at once """
+
+import numpy as np
+
+
+def track_positions(tracks, frame_index, num_tracks=None):
+    """ Positions of TrackRow lists at the frames of frame_index
+
+    Parameters
+    ----------
+    tracks: List
+        List of tracks (lists of TrackRows)
+    frame_index: Dictionary
+        Index of each frame of interest
+    num_tracks: Int
+        Number of tracks of the output (padded with absent tracks)
+
+    Returns
+    -------
+    positions: Array [num_tracks, num_frames, 2]
+        Positions of the tracks, NaN where absent
+    present: Array [num_tracks, num_frames]
+        True where the track has a row at the frame (its position may still be NaN)
+    """
+    num_tracks = num_tracks if num_tracks is not None else len(tracks)
+    positions = np.full((num_tracks, len(frame_index), 2), np.nan)
+    present = np.zeros((num_tracks, len(frame_index)), dtype=bool)
+    for j, track in enumerate(tracks):
+        for row in track:
+            index = frame_index.get(row.frame)
+            if index is not None:
+                positions[j, index] = row.x, row.y
+                present[j, index] = True
+    return positions, present
+
+
+def stack_tracks(positions, presents):
+    """ Stacks per-scene outputs of track_positions, padding the track dimension """
+    num_frames = positions[0].shape[1]
+    max_tracks = max([len(position) for position in positions] + [1])
+    stacked = np.full((len(positions), max_tracks, num_frames, 2), np.nan)
+    stacked_present = np.zeros((len(positions), max_tracks, num_frames), dtype=bool)
+    for i, (position, present) in enumerate(zip(positions, presents)):
+        stacked[i, :len(position)] = position
+        stacked_present[i, :len(present)] = present
+    return stacked, stacked_present
+
+
+def l2_errors(ground_truth, predictions):
+    """ Average and final L2 errors
+
+    Parameters
+    ----------
+    ground_truth: Array [num_scenes, pred_length, 2]
+    predictions: Array [num_scenes, num_modes, pred_length, 2]
+
+    Returns
+    -------
+    ade, fde: Arrays [num_scenes, num_modes]
+    """
+    distances = np.linalg.norm(predictions - ground_truth[:, None], axis=-1)
+    return distances.mean(axis=-1), distances[..., -1]
+
+
+def topk_errors(ade, fde):
+    """ ADE (and corresponding FDE) of the mode closest to the ground truth """
+    best = np.argmin(ade, axis=1)
+    scenes = np.arange(len(ade))
+    return ade[scenes, best], fde[scenes, best]
+
+
+def collisions(primary, others, present, person_radius=0.1, inter_parts=2):
+    """ True for the scenes where the primary collides with one of the other tracks
+
+    Same rule as trajnetplusplustools.metrics.collision: only frames present in
+    both tracks are compared, consecutive common frames are joined by segments
+    and each segment is checked at inter_parts + 1 equally spaced points.
+    Segments with a NaN end point never collide.
+
+    Parameters
+    ----------
+    primary: Array [num_scenes, pred_length, 2]
+        Primary positions (present at every frame)
+    others: Array [num_scenes, num_tracks, pred_length, 2]
+        Positions of the other tracks
+    present: Array [num_scenes, num_tracks, pred_length]
+        True where the other track has a row at the frame
+
+    Returns
+    -------
+    Array [num_scenes] of Bool
+    """
+    num_frames = present.shape[-1]
+    frames = np.arange(num_frames)
+
+    ## Index of the next common frame of every common frame
+    next_present = np.where(present, frames, num_frames)
+    next_present = np.minimum.accumulate(next_present[..., ::-1], axis=-1)[..., ::-1]
+    next_present = np.concatenate((next_present[..., 1:], np.full_like(next_present[..., :1], num_frames)), axis=-1)
+    segment = present & (next_present < num_frames)
+    next_present = np.minimum(next_present, num_frames - 1)[..., None]
+
+    primary = np.broadcast_to(primary[:, None], others.shape)
+    p1, p2 = primary, np.take_along_axis(primary, next_present, axis=2)
+    p3, p4 = others, np.take_along_axis(others, next_present, axis=2)
+
+    ## Points along both segments, as np.linspace(start, stop, inter_parts + 1)
+    step_12 = (p2 - p1) / inter_parts
+    step_34 = (p4 - p3) / inter_parts
+    distances = [np.linalg.norm(p1 - p3, axis=-1)]
+    for part in range(1, inter_parts):
+        distances.append(np.linalg.norm((part * step_12 + p1) - (part * step_34 + p3), axis=-1))
+    distances.append(np.linalg.norm(p2 - p4, axis=-1))
+    distances = np.stack(distances)
+
+    with np.errstate(invalid='ignore'):
+        colliding = ~np.isnan(distances).any(axis=0) & (np.min(distances, axis=0) <= 2 * person_radius)
+    return (colliding & segment).any(axis=(1, 2))
@@ -0,0 +1,123 @@
+""" Content-addressed cache of the predictions and results of the evaluator
+
+Every (model, dataset file) cell is stored under a key hashing the bytes of the
+model checkpoint, the bytes of the dataset file (and of its goal file, if any)
+and the options changing the predictions: observation length, prediction
+length, number of modes and scene normalization. Results additionally hash the
+ground truth file. Checkpoints are pickles of objects whose classes are loaded
+from the current sources, so the sources of the trajnetbaselines package are
+hashed as well. Handcrafted baselines have no checkpoint and hash the source
+files of their predictor instead. A retrained checkpoint, a modified model or
+baseline, or a modified dataset therefore never reuses stale predictions,
+while unchanged cells are never recomputed.
+"""
+
+import glob
+import hashlib
+import importlib.util
+import os
+import pickle
+from functools import lru_cache
+
+CHUNK_SIZE = 1 << 20
+
+## Modules implementing the handcrafted baselines, matched on the model name
+## in the order of predictor_pool.load_predictor
+BASELINE_MODULES = [
+    ('kf', ['trajnetbaselines.classical.kalman']),
+    ('sf', ['trajnetbaselines.classical.socialforce', 'socialforce']),
+    ('orca', ['trajnetbaselines.classical.orca']),
+    ('cv', ['trajnetbaselines.classical.constant_velocity']),
+]
+
+
+@lru_cache(maxsize=None)
+def _file_digest(path, mtime, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """ sha256 of the bytes of a file (memoized while the file is unchanged) """
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _key(*parts):
+    return hashlib.sha256('\n'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def module_files(name):
+    """ Source files of a module (all the files of the package, if it is a package) """
+    spec = importlib.util.find_spec(name)
+    if spec.submodule_search_locations is None:
+        return [spec.origin]
+    return sorted(path for location in spec.submodule_search_locations
+                  for path in glob.glob(os.path.join(location, '**', '*.py'), recursive=True))
+
+
+def baseline_digest(model_name):
+    """ Digest of the code of the handcrafted baseline model_name
+
+    Hashes the baseline module (and the socialforce package for sf, sf_opt), as
+    well as predictor_pool.py which selects and parametrizes the predictor.
+    """
+    files = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'predictor_pool.py')]
+    for baseline, modules in BASELINE_MODULES:
+        if baseline in model_name:
+            files += [path for module in modules for path in module_files(module)]
+            break
+    return _key(model_name, *(file_digest(path) for path in files))
+
+
+def model_digest(model):
+    """ Digest of the checkpoint model and of the sources of the trajnetbaselines models """
+    return _key(file_digest(model), *(file_digest(path) for path in module_files('trajnetbaselines')))
+
+
+def prediction_key(model, model_name, scene_file, goal_file, args):
+    """ Key of the predictions of model on scene_file
+
+    Handcrafted baselines (kf, sf, orca, cv) have no checkpoint and are
+    identified by their model name and the digest of their code.
+    """
+    checkpoint = model_digest(model) if os.path.isfile(model) else baseline_digest(model_name)
+    goals = file_digest(goal_file) if goal_file is not None and os.path.isfile(goal_file) else None
+    return _key('predictions', checkpoint, file_digest(scene_file), goals,
+                args.obs_length, args.pred_length, args.modes, args.normalize_scene)
+
+
+def result_key(pred_key, gt_file, args):
+    """ Key of the evaluation of the predictions pred_key against gt_file """
+    return _key('results', pred_key, file_digest(gt_file),
+                args.obs_length, args.pred_length, args.disable_collision)
+
+
+class EvalCache(object):
+    """ Cache of prediction files and evaluation results, stored in 'folder' """
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def prediction_file(self, key):
+        return os.path.join(self.folder, key + '.ndjson')
+
+    def has_predictions(self, key):
+        return os.path.exists(self.prediction_file(key))
+
+    def load_result(self, key):
+        """ Cached result of key, None if not computed yet """
+        result_file = os.path.join(self.folder, key + '.pkl')
+        if not os.path.exists(result_file):
+            return None
+        with open(result_file, 'rb') as handle:
+            return pickle.load(handle)
+
+    def save_result(self, key, result):
+        result_file = os.path.join(self.folder, key + '.pkl')
+        with open(result_file + '.tmp', 'wb') as handle:
+            pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(result_file + '.tmp', result_file)
@@ -12,15 +12,9 @@ import torch
 import trajnetplusplustools
 import trajnetbaselines
 
-## Parallel Compute
-import multiprocessing
-from joblib import Parallel, delayed
 from tqdm import tqdm
 
-def process_scene(predictor, model_name, paths, scene_goal, args):
-    ## For each scene, get predictions
-    predictions = predictor(paths, scene_goal, n_predict=args.pred_length, obs_length=args.obs_length, modes=args.modes, args=args)
-    return predictions
+from evaluator.predictor_pool import PredictorPool
 
 def main():
     parser = argparse.ArgumentParser()
@@ -48,6 +42,10 @@ def main():
                         help='provide multimodal nll evaluation')
     parser.add_argument('--modes', default=1, type=int,
                         help='number of modes to predict')
+    parser.add_argument('--batch_size', default=64, type=int,
+                        help='number of scenes predicted in one forward pass')
+    parser.add_argument('--n_jobs', default=None, type=int,
+                        help='number of prediction worker processes (default: number of available cores)')
     parser.add_argument('--scene_type', default=0, type=int,
                         choices=(0, 1, 2, 3, 4),
                         help='type of scene to evaluate')
@@ -106,6 +104,11 @@ def main():
         device = torch.device('cpu')
         predictor.model.to(device)
 
+        pool = None
+        if not hasattr(predictor, 'predict_batch'):
+            ## Long-lived workers: load the model once, then only receive scene ids
+            pool = PredictorPool(model, model_name, args, n_jobs=args.n_jobs)
+
         total_scenes = 0
         average = 0
         final = 0
@@ -135,15 +138,18 @@ def main():
                 filtered_scene_ids = [s_id for s_id, _, _ in reader_tag.scenes()]
 
             # Read file from 'test'
-            reader = trajnetplusplustools.Reader(args.path.replace('_pred', '') + dataset + '.ndjson', scene_type='paths')
+            scene_file = args.path.replace('_pred', '') + dataset + '.ndjson'
+            reader = trajnetplusplustools.Reader(scene_file, scene_type='paths')
             ## Necessary modification of train scene to add filename (for goals)
             scenes = [(dataset, s_id, s) for s_id, s in reader.scenes() if s_id in filtered_scene_ids]
 
             ## Consider goals
             ## Goal file must be present in 'goal_files/test_private' folder 
             ## Goal file must have the same name as corresponding test file 
+            goal_file = None
             if goal_flag:
-                goal_dict = pickle.load(open('goal_files/test_private/' + dataset +'.pkl', "rb"))
+                goal_file = 'goal_files/test_private/' + dataset +'.pkl'
+                goal_dict = pickle.load(open(goal_file, "rb"))
                 all_goals[dataset] = {s_id: [goal_dict[path[0].pedestrian] for path in s] for _, s_id, s in scenes}
 
             ## Get Goals
@@ -153,10 +159,16 @@ def main():
                 scene_goals = [np.zeros((len(paths), 2)) for _, scene_id, paths in scenes]
 
             print("Getting Predictions")
-            scenes = tqdm(scenes)
-            ## Get all predictions in parallel. Faster!
-            pred_list = Parallel(n_jobs=12)(delayed(process_scene)(predictor, model_name, paths, scene_goal, args)
-                                            for (_, _, paths), scene_goal in zip(scenes, scene_goals))
+            if pool is None:
+                ## Get predictions of batch_size scenes in one forward pass. Faster!
+                pred_list = []
+                for i in tqdm(range(0, len(scenes), args.batch_size)):
+                    pred_list += predictor.predict_batch([paths for _, _, paths in scenes[i:i + args.batch_size]],
+                                                         scene_goals[i:i + args.batch_size], n_predict=args.pred_length,
+                                                         obs_length=args.obs_length, modes=args.modes, args=args)
+            else:
+                ## Get all predictions in parallel, streamed as they are computed. Faster!
+                pred_list = pool.predict(scene_file, [scene_id for _, scene_id, _ in scenes], goal_file)
 
             ## GT Scenes
             reader_gt = trajnetplusplustools.Reader(args.path.replace('_pred', '_private') + dataset + '.ndjson', scene_type='paths')
@@ -235,6 +247,9 @@ def main():
                     nll_val = trajnetplusplustools.metrics.nll(primary_tracks_all, ground_truth[0], n_predictions=args.pred_length, n_samples=20)
                     average_nll += nll_val
 
+        if pool is not None:
+            pool.close()
+
         if args.unimodal:
             ## Average ADE and FDE
             average /= total_scenes
@@ -0,0 +1,143 @@
+""" Long-lived pool of processes computing the predictions of one model
+
+Every worker loads the model once and reads each dataset file (and goal file) once.
+Tasks then only carry the ids of the scenes to predict, and the predictions
+are streamed back chunk by chunk in the order of the scene ids.
+"""
+
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import torch
+
+import trajnetplusplustools
+import trajnetbaselines
+
+
+def available_cores():
+    """ Number of cores the current process is allowed to run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def load_predictor(model, model_name):
+    """ Loads the predictor of a model, selected by model name
+
+    Returns
+    -------
+    predictor: Predictor object, or predict function of the handcrafted baselines
+    goal_flag: Bool
+        True if the model requires the goals of the pedestrians
+    """
+    goal_flag = False
+    if 'kf' in model_name:
+        predictor = trajnetbaselines.classical.kalman.KalmanPredictor()
+    elif 'sf_opt' in model_name:
+        ## optimal sf_params (no collision constraint) [0.5, 1.0, 0.1],
+        predictor = trajnetbaselines.classical.socialforce.SocialForcePredictor(sf_params=[0.5, 5.0, 0.3])
+    elif 'sf' in model_name:
+        predictor = trajnetbaselines.classical.socialforce.SocialForcePredictor()
+    elif 'orca' in model_name:
+        predictor = trajnetbaselines.classical.orca.predict
+    elif 'cv' in model_name:
+        predictor = trajnetbaselines.classical.constant_velocity.ConstantVelocityPredictor()
+    elif 'sgan' in model_name:
+        predictor = trajnetbaselines.sgan.SGANPredictor.load(model)
+        predictor.model.to(torch.device('cpu'))
+        goal_flag = predictor.model.generator.goal_flag
+    elif 'vae' in model_name:
+        predictor = trajnetbaselines.vae.VAEPredictor.load(model)
+        predictor.model.to(torch.device('cpu'))
+        goal_flag = predictor.model.goal_flag
+    elif 'lstm' in model_name:
+        predictor = trajnetbaselines.lstm.LSTMPredictor.load(model)
+        predictor.model.to(torch.device('cpu'))
+        goal_flag = predictor.model.goal_flag
+    else:
+        print("Model Architecture not recognized")
+        raise ValueError
+    return predictor, goal_flag
+
+
+def process_scene(predictor, model_name, paths, scene_goal, args):
+    ## For each scene, get predictions
+    if 'sf_opt' in model_name:
+        predictions = predictor(paths, sf_params=[0.5, 5.0, 0.3], n_predict=args.pred_length, obs_length=args.obs_length) ## optimal sf_params (no collision constraint) [0.5, 1.0, 0.1],
+    elif 'orca_opt' in model_name:
+        predictions = predictor(paths, orca_params=[0.4, 1.0, 0.3], n_predict=args.pred_length, obs_length=args.obs_length) ## optimal orca_params (no collision constraint) [0.25, 1.0, 0.3]
+    elif  ('sf' in model_name) or ('orca' in model_name) or ('kf' in model_name):
+        predictions = predictor(paths, n_predict=args.pred_length, obs_length=args.obs_length)
+    elif 'cv' in model_name:
+        predictions = predictor(paths, n_predict=args.pred_length, obs_length=args.obs_length)
+    else:
+        predictions = predictor(paths, scene_goal, n_predict=args.pred_length, obs_length=args.obs_length, modes=args.modes, args=args)
+    return predictions
+
+
+## State of the current worker process
+_worker = {}
+
+
+def _init_worker(model, model_name, args):
+    ## The pool already runs one process per core
+    torch.set_num_threads(1)
+    _worker['predictor'], _ = load_predictor(model, model_name)
+    _worker['model_name'] = model_name
+    _worker['args'] = args
+    _worker['files'] = None
+
+
+def _predict_chunk(scene_file, goal_file, scene_ids):
+    ## Read scenes (and goals) of the dataset file once per worker
+    if _worker['files'] != (scene_file, goal_file):
+        reader = trajnetplusplustools.Reader(scene_file, scene_type='paths')
+        _worker['scenes'] = dict(reader.scenes())
+        _worker['goals'] = pickle.load(open(goal_file, "rb")) if goal_file is not None else None
+        _worker['files'] = (scene_file, goal_file)
+
+    predictions = []
+    for scene_id in scene_ids:
+        paths = _worker['scenes'][scene_id]
+        if _worker['goals'] is not None:
+            scene_goal = np.array([_worker['goals'][path[0].pedestrian] for path in paths])
+        else:
+            scene_goal = np.zeros((len(paths), 2))
+        predictions.append(process_scene(_worker['predictor'], _worker['model_name'], paths, scene_goal, _worker['args']))
+    return predictions
+
+
+class PredictorPool(object):
+    """ Pool of n_jobs processes predicting the scenes of dataset files with one model
+
+    Parameters
+    ----------
+    model: String
+        Path to the saved model (unused for the handcrafted baselines)
+    model_name: String
+        Name selecting the predictor, see load_predictor
+    n_jobs: Int
+        Number of worker processes. Defaults to the number of available cores.
+    """
+    def __init__(self, model, model_name, args, n_jobs=None):
+        n_jobs = n_jobs if n_jobs is not None else available_cores()
+        self.executor = ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                            initargs=(model, model_name, args))
+
+    def predict(self, scene_file, scene_ids, goal_file=None, chunk_size=16):
+        """ Yields the predictions of the scenes 'scene_ids' of 'scene_file', in order """
+        chunks = [scene_ids[i:i + chunk_size] for i in range(0, len(scene_ids), chunk_size)]
+        for predictions in self.executor.map(_predict_chunk, repeat(scene_file), repeat(goal_file), chunks):
+            yield from predictions
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -4,11 +4,15 @@ import argparse
 
 import pickle
 from joblib import Parallel, delayed
+import numpy as np
 import scipy
 
 import trajnetplusplustools
 import evaluator.write as write
+from evaluator.predictor_pool import available_cores
+from evaluator.eval_cache import EvalCache, result_key
 from evaluator.design_pd import Table
+from evaluator.array_metrics import track_positions, stack_tracks, l2_errors, topk_errors, collisions
 
 class TrajnetEvaluator:
     def __init__(self, reader_gt, scenes_gt, scenes_id_gt, scenes_sub, indexes, sub_indexes, args):
@@ -61,47 +65,29 @@ class TrajnetEvaluator:
 
     def aggregate(self, name, disable_collision):
 
-        ## Overall Single Mode Scores
-        average = 0.0
-        final = 0.0
+        num_scenes = len(self.scenes_gt)
 
-        ## Overall Multi Mode Scores
-        average_topk_ade = 0
-        average_topk_fde = 0
-        average_nll = 0
+        ## Modes considered for Topk ADE-FDE (first 3)
+        num_modes = min(3, self.num_predictions + 1) if self.num_predictions > 1 else 1
 
-        ## Aggregates ADE, FDE and Collision in GT & Pred, Topk ADE-FDE , NLL for each category & sub_category
-        score = {1: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0], 2: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0], \
-                 3: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0], 4: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0]}
-        sub_score = {1: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0], 2: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0], \
-                     3: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0], 4: [0.0, 0.0, 0, 0, 0, 0.0, 0.0, 0.0]}
+        ## Category and sub-category membership of each scene (set lookups)
+        key_masks = {key: np.array([scene_id in index for scene_id in self.scenes_id_gt], dtype=bool)
+                     for key, index in ((key, set(self.indexes[key])) for key in range(1, 5))}
+        sub_key_masks = {key: np.array([scene_id in index for scene_id in self.scenes_id_gt], dtype=bool)
+                         for key, index in ((key, set(self.sub_indexes[key])) for key in range(1, 5))}
 
-        ## Iterate
-        for i in range(len(self.scenes_gt)):
+        ## Extract GT and predictions of all scenes as arrays
+        gt_primary, pred_primary = [], []
+        gt_neighbours, gt_present, pred_neighbours, pred_present = [], [], [], []
+        num_gt_neigh, num_predicted_neigh = [], []
+        nll_list = []
+        for i in range(num_scenes):
             ground_truth = self.scenes_gt[i]
-
-            ## Get Keys and Sub_keys
-            keys = []
-            sub_keys = []
-
-            ## Main
-            for key in list(score.keys()):
-                if self.scenes_id_gt[i] in self.indexes[key]:
-                    keys.append(key)
-            # ## Sub
-            for sub_key in list(sub_score.keys()):
-                if self.scenes_id_gt[i] in self.sub_indexes[sub_key]:
-                    sub_keys.append(sub_key)
+            scene_id = self.scenes_id_gt[i]
 
             ## Extract Prediction Frames
-            primary_tracks_all = [t for t in self.scenes_sub[i][0] if t.scene_id == self.scenes_id_gt[i]]
-            neighbours_tracks_all = [[t for t in self.scenes_sub[i][j] if t.scene_id == self.scenes_id_gt[i]] for j in range(1, len(self.scenes_sub[i]))]
-
-##### --------------------------------------------------- SINGLE -------------------------------------------- ####
-
-
+            primary_tracks_all = [t for t in self.scenes_sub[i][0] if t.scene_id == scene_id]
             primary_tracks = [t for t in primary_tracks_all if t.prediction_number == 0]
-            neighbours_tracks = [[t for t in neighbours_tracks_all[j] if t.prediction_number == 0] for j in range(len(neighbours_tracks_all))]
 
             frame_gt = [t.frame for t in ground_truth[0]][-self.pred_length:]
             frame_pred = [t.frame for t in primary_tracks]
@@ -112,104 +98,80 @@ class TrajnetEvaluator:
                 print("Frame id Predictions: ", frame_pred)
                 raise Exception('frame numbers are not consistent')
 
-            average_l2 = trajnetplusplustools.metrics.average_l2(ground_truth[0], primary_tracks, n_predictions=self.pred_length)
-            final_l2 = trajnetplusplustools.metrics.final_l2(ground_truth[0], primary_tracks)
-            self.ade_list[self.scenes_id_gt[i]] = average_l2
-            self.fde_list[self.scenes_id_gt[i]] = final_l2
+            gt_primary.append([[t.x, t.y] for t in ground_truth[0][-self.pred_length:]])
+            modes = [primary_tracks] + [[t for t in primary_tracks_all if t.prediction_number == pred_num]
+                                        for pred_num in range(1, num_modes)]
+            pred_primary.append([[[t.x, t.y] for t in mode[-self.pred_length:]] for mode in modes])
 
             if not disable_collision:
+                frame_index = {frame: index for index, frame in enumerate(frame_gt)}
+                ## Neighbours in GT
                 ground_truth = self.drop_post_obs(ground_truth, self.obs_length)
-                ## Collisions in GT
-                # person_radius=0.1
-                for j in range(1, len(ground_truth)):
-                    if trajnetplusplustools.metrics.collision(primary_tracks, ground_truth[j], n_predictions=self.pred_length):
-                        for key in keys:
-                            score[key][2] += 1
-                        ## Sub
-                        for sub_key in sub_keys:
-                            sub_score[sub_key][2] += 1
-                        break
-
-                ## Collision in Predictions
-                # [Col-I] only if neighs in gt = neighs in prediction
-                num_gt_neigh = len(ground_truth) - 1
-                num_predicted_neigh = len(neighbours_tracks)
-                if num_gt_neigh != num_predicted_neigh:
-                    self.enable_col1 = False
-                    for key in score:
-                        score[key][4] = 0
-                        score[key][3] = 0
-                    for sub_key in sub_score:
-                        sub_score[sub_key][4] = 0
-                        sub_score[sub_key][3] = 0
-
-                if self.enable_col1:
-                    for key in keys:
-                        score[key][4] += 1
-                        for j in range(len(neighbours_tracks)):
-                            if trajnetplusplustools.metrics.collision(primary_tracks, neighbours_tracks[j], n_predictions=self.pred_length):
-                                score[key][3] += 1
-                                break
-                    ## Sub
-                    for sub_key in sub_keys:
-                        sub_score[sub_key][4] += 1
-                        for j in range(len(neighbours_tracks)):
-                            if trajnetplusplustools.metrics.collision(primary_tracks, neighbours_tracks[j], n_predictions=self.pred_length):
-                                sub_score[sub_key][3] += 1
-                                break
-
-
-            # aggregate FDE and ADE
-            average += average_l2
-            final += final_l2
-
-            for key in keys:
-                score[key][0] += average_l2
-                score[key][1] += final_l2
-
-            ## Sub
-            for sub_key in sub_keys:
-                sub_score[sub_key][0] += average_l2
-                sub_score[sub_key][1] += final_l2
+                positions, present = track_positions(ground_truth[1:], frame_index)
+                gt_neighbours.append(positions)
+                gt_present.append(present)
+                ## Neighbours in Predictions
+                neighbours_tracks = [[t for t in self.scenes_sub[i][j] if t.scene_id == scene_id and t.prediction_number == 0]
+                                     for j in range(1, len(self.scenes_sub[i]))]
+                positions, present = track_positions(neighbours_tracks, frame_index)
+                pred_neighbours.append(positions)
+                pred_present.append(present)
+
+                num_gt_neigh.append(len(ground_truth) - 1)
+                num_predicted_neigh.append(len(neighbours_tracks))
 
-##### --------------------------------------------------- SINGLE -------------------------------------------- ####
+            if self.num_predictions > 48:
+                nll_list.append(trajnetplusplustools.metrics.nll(primary_tracks_all, self.scenes_gt[i][0], n_predictions=self.pred_length, n_samples=50))
 
-##### --------------------------------------------------- Top 3 -------------------------------------------- ####
+##### --------------------------------------------------- SINGLE -------------------------------------------- ####
 
-            if self.num_predictions > 1:
-                topk_ade, topk_fde = trajnetplusplustools.metrics.topk(primary_tracks_all, ground_truth[0], n_predictions=self.pred_length)
-
-                average_topk_ade += topk_ade
-                ##Key
-                for key in keys:
-                    score[key][5] += topk_ade
-                ## SubKey
-                for sub_key in sub_keys:
-                    sub_score[sub_key][5] += topk_ade
-
-                average_topk_fde += topk_fde
-                ##Key
-                for key in keys:
-                    score[key][6] += topk_fde
-                ## SubKey
-                for sub_key in sub_keys:
-                    sub_score[sub_key][6] += topk_fde
+        gt_primary = np.array(gt_primary, dtype=float).reshape(num_scenes, self.pred_length, 2)
+        pred_primary = np.array(pred_primary, dtype=float).reshape(num_scenes, num_modes, self.pred_length, 2)
+        ade, fde = l2_errors(gt_primary, pred_primary)
+        average_l2, final_l2 = ade[:, 0], fde[:, 0]
+        self.ade_list.update(zip(self.scenes_id_gt, average_l2.tolist()))
+        self.fde_list.update(zip(self.scenes_id_gt, final_l2.tolist()))
+
+        ## Collisions in GT [Col-II] and in Predictions [Col-I]
+        gt_collision = np.zeros(num_scenes, dtype=bool)
+        pred_collision = np.zeros(num_scenes, dtype=bool)
+        if not disable_collision and num_scenes:
+            gt_collision = collisions(pred_primary[:, 0], *stack_tracks(gt_neighbours, gt_present))
+            # [Col-I] only if neighs in gt = neighs in prediction
+            if num_gt_neigh != num_predicted_neigh:
+                self.enable_col1 = False
+            if self.enable_col1:
+                pred_collision = collisions(pred_primary[:, 0], *stack_tracks(pred_neighbours, pred_present))
 
 ##### --------------------------------------------------- Top 3 -------------------------------------------- ####
 
-##### --------------------------------------------------- NLL -------------------------------------------- ####
-            if self.num_predictions > 48:
-                nll = trajnetplusplustools.metrics.nll(primary_tracks_all, ground_truth[0], n_predictions=self.pred_length, n_samples=50)
-
-                average_nll += nll
-                ##Key
-                for key in keys:
-                    score[key][7] += nll
-                ## SubKey
-                for sub_key in sub_keys:
-                    sub_score[sub_key][7] += nll
+        topk_ade, topk_fde = np.zeros(num_scenes), np.zeros(num_scenes)
+        if self.num_predictions > 1:
+            topk_ade, topk_fde = topk_errors(ade, fde)
+
 ##### --------------------------------------------------- NLL -------------------------------------------- ####
 
+        nll = np.array(nll_list) if self.num_predictions > 48 else np.zeros(num_scenes)
+
+        ## Aggregates ADE, FDE and Collision in GT & Pred, Topk ADE-FDE , NLL for each category & sub_category
+        def category_score(mask):
+            col1_scenes = int(mask.sum()) if (self.enable_col1 and not disable_collision) else 0
+            return [float(average_l2[mask].sum()), float(final_l2[mask].sum()),
+                    int(gt_collision[mask].sum()), int(pred_collision[mask].sum()), col1_scenes,
+                    float(topk_ade[mask].sum()), float(topk_fde[mask].sum()), float(nll[mask].sum())]
+
+        score = {key: category_score(mask) for key, mask in key_masks.items()}
+        sub_score = {sub_key: category_score(mask) for sub_key, mask in sub_key_masks.items()}
+
+        ## Overall Single Mode Scores
+        average = float(average_l2.sum())
+        final = float(final_l2.sum())
+
+        ## Overall Multi Mode Scores
+        average_topk_ade = float(topk_ade.sum())
+        average_topk_fde = float(topk_fde.sum())
+        average_nll = float(nll.sum())
+
         ## Average ADE and FDE
         average /= len(self.scenes_gt)
         final /= len(self.scenes_gt)
@@ -361,6 +323,12 @@ def main():
                         help='augment scenes')
     parser.add_argument('--modes', default=1, type=int,
                         help='number of modes to predict')
+    parser.add_argument('--batch_size', default=64, type=int,
+                        help='number of scenes predicted in one forward pass')
+    parser.add_argument('--n_jobs', default=None, type=int,
+                        help='number of prediction worker processes (default: number of available cores)')
+    parser.add_argument('--background_write', action='store_true',
+                        help='format and write predictions in a background thread')
     args = parser.parse_args()
 
     scipy.seterr('ignore')
@@ -377,7 +345,7 @@ def main():
     args.path = args.path + 'test_pred/'
 
     ## Writes to Test_pred
-    ## Does NOT overwrite existing predictions if they already exist ###
+    ## Only predicts the (model, dataset) pairs missing from the cache ###
     write.main(args)
     if args.write_only: # For submission to AICrowd.
         print("Predictions written in test_pred folder")
@@ -396,52 +364,45 @@ def main():
     else:
         labels = names
 
+    ## Datasets predicted by write.main
+    list_sub = sorted([f for f in os.listdir(args.path.replace('_pred', ''))
+                       if not f.startswith('.') and f.endswith('.ndjson')])
+    datasets = [f for f in list_sub if 'collision_test.ndjson' not in f]
+    true_datasets = {f: args.path.replace('pred', 'private') + f for f in datasets}
+
+    ## Results are cached per (predictions, ground truth, options)
+    ## Only the missing (model, dataset) cells are evaluated
+    cache = EvalCache(write.cache_folder(args))
+    keys = {}
+    for model, name in zip(args.output, names):
+        for dataset in datasets:
+            pred_key = write.dataset_key(model, name, dataset.replace('.ndjson', ''), args)
+            keys[name, dataset] = result_key(pred_key, true_datasets[dataset], args)
+    cells = {cell: cache.load_result(key) for cell, key in keys.items()}
+    missing = [cell for cell, result in cells.items() if result is None]
+    if missing:
+        print("Evaluating {} of {} (model, dataset) pairs".format(len(missing), len(cells)))
+        n_jobs = args.n_jobs if args.n_jobs is not None else min(4, available_cores())
+        results_list = Parallel(n_jobs=n_jobs)(delayed(eval)(true_datasets[dataset], args.path + name + '/' + dataset, args)
+                                               for name, dataset in missing)
+        for cell, result in zip(missing, results_list):
+            cache.save_result(keys[cell], result)
+            cells[cell] = result
+
     # Initiate Result Table
     table = Table()
 
     for num, name in enumerate(names):
         print(name)
 
-        result_file = args.path.replace('pred', 'results') + name
-
-        ## If result was pre-calculated and saved, Load
-        if os.path.exists(result_file + '/results.pkl'):
-            print("Loading Saved Results")
-            with open(result_file + '/results.pkl', 'rb') as handle:
-                [final_result, sub_final_result, col_result] = pickle.load(handle)
-            table.add_result(labels[num], final_result, sub_final_result)
-            table.add_collision_entry(labels[num], col_result)
-
-        # ## Else, Calculate results and save
-        else:
-            list_sub = sorted([f for f in os.listdir(args.path + name)
-                               if not f.startswith('.')])
-
-            ## Simple Collision Test
-            col_result = collision_test(list_sub, name, args)
-            table.add_collision_entry(labels[num], col_result)
-
-            submit_datasets = [args.path + name + '/' + f for f in list_sub if 'collision_test.ndjson' not in f]
-            true_datasets = [args.path.replace('pred', 'private') + f for f in list_sub if 'collision_test.ndjson' not in f]
-
-            ## Evaluate submitted datasets with True Datasets [The main eval function]
-            # results = {submit_datasets[i].replace(args.path, '').replace('.ndjson', ''):
-            #             eval(true_datasets[i], submit_datasets[i], args)
-            #            for i in range(len(true_datasets))}
-
-            results_list = Parallel(n_jobs=4)(delayed(eval)(true_datasets[i], submit_datasets[i], args)
-                                                            for i in range(len(true_datasets)))
-            results = {submit_datasets[i].replace(args.path, '').replace('.ndjson', ''): results_list[i] 
-                       for i in range(len(true_datasets))}
-
-            # print(results)
-            ## Generate results
-            final_result, sub_final_result = table.add_entry(labels[num], results)
-
-            ## Save results as pkl (to avoid computation again)
-            os.makedirs(result_file)
-            with open(result_file + '/results.pkl', 'wb') as handle:
-                pickle.dump([final_result, sub_final_result, col_result], handle, protocol=pickle.HIGHEST_PROTOCOL)
+        ## Simple Collision Test
+        col_result = collision_test(list_sub, name, args)
+        table.add_collision_entry(labels[num], col_result)
+
+        results = {name + '/' + dataset.replace('.ndjson', ''): cells[name, dataset] for dataset in datasets}
+
+        ## Generate results
+        table.add_entry(labels[num], results)
 
     ## Make Result Table
     table.print_table()
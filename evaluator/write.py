@@ -2,30 +2,124 @@ import shutil
 import os
 import pickle
 
-import torch
 import numpy as np
 
 import trajnetplusplustools
-import trajnetbaselines
 
-## Parallel Compute
-import multiprocessing
-from joblib import Parallel, delayed
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-def process_scene(predictor, model_name, paths, scene_goal, args):
-    ## For each scene, get predictions
-    if 'sf_opt' in model_name:
-        predictions = predictor(paths, sf_params=[0.5, 5.0, 0.3], n_predict=args.pred_length, obs_length=args.obs_length) ## optimal sf_params (no collision constraint) [0.5, 1.0, 0.1],
-    elif 'orca_opt' in model_name:
-        predictions = predictor(paths, orca_params=[0.4, 1.0, 0.3], n_predict=args.pred_length, obs_length=args.obs_length) ## optimal orca_params (no collision constraint) [0.25, 1.0, 0.3]
-    elif  ('sf' in model_name) or ('orca' in model_name) or ('kf' in model_name):
-        predictions = predictor(paths, n_predict=args.pred_length, obs_length=args.obs_length)
-    elif 'cv' in model_name:
-        predictions = predictor(paths, n_predict=args.pred_length, obs_length=args.obs_length)
-    else:
-        predictions = predictor(paths, scene_goal, n_predict=args.pred_length, obs_length=args.obs_length, modes=args.modes, args=args)
-    return predictions
+from evaluator.predictor_pool import PredictorPool, load_predictor
+from evaluator.eval_cache import EvalCache, prediction_key
+
+## Same layout as trajnetplusplustools.writers.trajnet(TrackRow)
+TRACK_ROW = '{"track": {"f": %s, "p": %s, "x": %s, "y": %s, "prediction_number": %s, "scene_id": %s}}'
+JSON_SPECIAL = {'nan': 'NaN', 'inf': 'Infinity', '-inf': '-Infinity'}
+WRITE_BUFFER = 1 << 22
+
+
+def json_coordinates(coordinates):
+    """ Coordinates rounded and formatted as json.dumps(round(value, 2)) """
+    rounded = np.round(coordinates, 2)
+    ## np.round can differ from round() next to ties: use round() there
+    scaled = coordinates * 100
+    with np.errstate(invalid='ignore'):
+        near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = [round(value, 2) for value in coordinates[near_tie].tolist()]
+    strings = [repr(value) for value in rounded.tolist()]
+    if not np.isfinite(rounded).all():
+        strings = [JSON_SPECIAL.get(string, string) for string in strings]
+    return strings
+
+
+def track_lines(tracks, ped_ids, frames, mode, scene_id):
+    """ ndjson TrackRows of the predictions 'tracks' [pred_length, n_tracks, 2], track after track """
+    tracks = np.asarray(tracks, dtype=np.float64)
+    num_frames, num_tracks = tracks.shape[:2]
+    coordinates = json_coordinates(tracks.transpose(1, 0, 2).reshape(-1))
+    peds = [ped_id for ped_id in ped_ids[:num_tracks] for _ in range(num_frames)]
+    return [TRACK_ROW % (frame, ped_id, x, y, mode, scene_id)
+            for frame, ped_id, x, y in zip(frames * num_tracks, peds, coordinates[0::2], coordinates[1::2])]
+
+
+def format_scene(scene_id, paths, predictions, obs_length, seq_length):
+    """ ndjson lines of the SceneRow and the predicted TrackRows (all modes) of a scene """
+    ## Extract 1) first_frame, 2) frame_diff 3) ped_ids for writing predictions
+    observed_path = paths[0]
+    frame_diff = observed_path[1].frame - observed_path[0].frame
+    first_frame = observed_path[obs_length-1].frame + frame_diff
+    ped_ids = [path[0].pedestrian for path in paths]
+
+    ## SceneRow
+    scenerow = trajnetplusplustools.SceneRow(scene_id, ped_ids[0], observed_path[0].frame,
+                                             observed_path[0].frame + (seq_length - 1) * frame_diff, 2.5, 0)
+    lines = [trajnetplusplustools.writers.trajnet(scenerow)]
+
+    for m in range(len(predictions)):
+        prediction, neigh_predictions = predictions[m]
+        frames = [first_frame + i * frame_diff for i in range(len(prediction))]
+        ## Primary
+        lines += track_lines(np.asarray(prediction)[:, None], ped_ids[:1], frames, m, scene_id)
+        ## Neighbours (if non-empty)
+        if len(neigh_predictions):
+            frames = [first_frame + j * frame_diff for j in range(len(neigh_predictions))]
+            lines += track_lines(neigh_predictions, ped_ids[1:], frames, m, scene_id)
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class PredictionWriter(object):
+    """ Buffered writer of the predictions of one test_pred file
+
+    Scenes are formatted as whole arrays and written through a large buffer.
+    If background is True, formatting and writing happen in a separate thread
+    (in scene order) while the next scenes are being predicted.
+    """
+    def __init__(self, filename, obs_length, seq_length, background=False):
+        self.file = open(filename, "a", buffering=WRITE_BUFFER)
+        self.obs_length = obs_length
+        self.seq_length = seq_length
+        self.executor = ThreadPoolExecutor(1) if background else None
+        self.pending = []
+
+    def _write(self, scene_id, paths, predictions):
+        self.file.write(format_scene(scene_id, paths, predictions, self.obs_length, self.seq_length))
+
+    def write(self, scene_id, paths, predictions):
+        if self.executor is None:
+            self._write(scene_id, paths, predictions)
+            return
+        self.pending.append(self.executor.submit(self._write, scene_id, paths, predictions))
+        ## Surface errors of the writes done so far
+        while self.pending and self.pending[0].done():
+            self.pending.pop(0).result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            for future in self.pending:
+                future.result()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def cache_folder(args):
+    """ Folder of the evaluation cache, next to the 'test_pred' folder """
+    return os.path.join(os.path.dirname(os.path.normpath(args.path)), 'eval_cache')
+
+
+def dataset_key(model, model_name, dataset, args):
+    """ Cache key of the predictions of model on the test dataset 'dataset' """
+    scene_file = args.path.replace('_pred', '') + dataset + '.ndjson'
+    goal_file = 'goal_files/test_private/' + dataset + '.pkl'
+    return prediction_key(model, model_name, scene_file, goal_file, args)
+
 
 def main(args=None):
     ## List of .json file inside the args.path (waiting to be predicted by the testing model)
@@ -45,77 +139,55 @@ def main(args=None):
     if args.cv:
         args.output.append('/cv.pkl')
 
+    ## Predictions are cached per (model checkpoint, dataset file, options)
+    cache = EvalCache(cache_folder(args))
+
     ## Extract Model names from arguments and create its own folder in 'test_pred' for storing predictions
-    ## WARNING: If Model predictions already exist from previous run, this process SKIPS WRITING
+    ## Only the datasets without cached predictions are predicted
     for model in args.output:
         model_name = model.split('/')[-1].replace('.pkl', '')
         model_name = model_name + '_modes' + str(args.modes)
+        os.makedirs(args.path + model_name, exist_ok=True)
 
-        ## Check if model predictions already exist
-        if not os.path.exists(args.path):
-            os.makedirs(args.path)
-        if not os.path.exists(args.path + model_name):
-            os.makedirs(args.path + model_name)
-        else:
+        keys = {dataset: dataset_key(model, model_name, dataset, args) for dataset in datasets}
+        missing = [dataset for dataset in datasets if not cache.has_predictions(keys[dataset])]
+        for dataset in datasets:
+            if dataset not in missing:
+                shutil.copyfile(cache.prediction_file(keys[dataset]), args.path + '{}/{}.ndjson'.format(model_name, dataset))
+        if not missing:
             print('Predictions corresponding to {} already exist.'.format(model_name))
             print('Loading the saved predictions')
             continue
 
+        # Loading the APPROPRIATE model
+        ## Keep Adding Different Model Architectures to load_predictor
+        print("Model Name: ", model_name)
+        predictor, goal_flag = load_predictor(model, model_name)
+        pool = None
+        if not hasattr(predictor, 'predict_batch'):
+            ## Long-lived workers: load the model once, then only receive scene ids
+            pool = PredictorPool(model, model_name, args, n_jobs=args.n_jobs)
+
         ## Start writing predictions in dataset/test_pred
-        for dataset in datasets:
+        for dataset in missing:
             # Model's name
             name = dataset.replace(args.path.replace('_pred', '') + 'test/', '') + '.ndjson'
             print('NAME: ', name)
 
-            # Loading the APPROPRIATE model
-            ## Keep Adding Different Model Architectures to this List
-            print("Model Name: ", model_name)
-            goal_flag = False
-            if 'kf' in model_name:
-                print("Kalman")
-                predictor = trajnetbaselines.classical.kalman.predict
-            elif 'sf' in model_name:
-                print("Social Force")
-                predictor = trajnetbaselines.classical.socialforce.predict
-            elif 'orca' in model_name:
-                print("ORCA")
-                predictor = trajnetbaselines.classical.orca.predict
-            elif 'cv' in model_name:
-                print("CV")
-                predictor = trajnetbaselines.classical.constant_velocity.predict
-            elif 'sgan' in model_name:
-                print("SGAN")
-                predictor = trajnetbaselines.sgan.SGANPredictor.load(model)
-                device = torch.device('cpu')
-                predictor.model.to(device)
-                goal_flag = predictor.model.generator.goal_flag
-            elif 'vae' in model_name:
-                print("VAE")
-                predictor = trajnetbaselines.vae.VAEPredictor.load(model)
-                device = torch.device('cpu')
-                predictor.model.to(device)
-                goal_flag = predictor.model.goal_flag
-            elif 'lstm' in model_name:
-                print("LSTM")
-                predictor = trajnetbaselines.lstm.LSTMPredictor.load(model)
-                device = torch.device('cpu')
-                predictor.model.to(device)
-                goal_flag = predictor.model.goal_flag
-            else:
-                print("Model Architecture not recognized")
-                raise ValueError
-
             # Read Scenes from 'test' folder
-            reader = trajnetplusplustools.Reader(args.path.replace('_pred', '') + dataset + '.ndjson', scene_type='paths')
+            scene_file = args.path.replace('_pred', '') + dataset + '.ndjson'
+            reader = trajnetplusplustools.Reader(scene_file, scene_type='paths')
             ## Necessary modification of train scene to add filename (for goals)
             scenes = [(dataset, s_id, s) for s_id, s in reader.scenes()]
 
             ## Consider goals
             ## Goal file must be present in 'goal_files/test_private' folder
             ## Goal file must have the same name as corresponding test file
+            goal_file = None
             if goal_flag:
                 print("Loading Test Goals file")
-                goal_dict = pickle.load(open('goal_files/test_private/' + dataset +'.pkl', "rb"))
+                goal_file = 'goal_files/test_private/' + dataset +'.pkl'
+                goal_dict = pickle.load(open(goal_file, "rb"))
                 all_goals[dataset] = {s_id: [goal_dict[path[0].pedestrian] for path in s] for _, s_id, s in scenes}
 
             ## Get Goals
@@ -133,51 +205,34 @@ def main(args=None):
             # Shape of primary_prediction: Tensor of Shape (Prediction length, 2)
             # Shape of Neighbour_prediction: Tensor of Shape (Prediction length, n_tracks - 1, 2).
             # (See LSTMPredictor.py for more details)
-            scenes = tqdm(scenes)
-            with open(args.path + '{}/{}'.format(model_name, name), "a") as myfile:
-                ## Get all predictions in parallel. Faster!
-                print("before the parelel stuff")
-
-                pred_list = Parallel(n_jobs=12)(delayed(process_scene)(predictor, model_name, paths, scene_goal, args)
-                                                for (_, _, paths), scene_goal in zip(scenes, scene_goals))
-                print("after the parelel stuff")
-                ## Write All Predictions
-                for (predictions, (_, scene_id, paths)) in zip(pred_list, scenes):
-                    ## Extract 1) first_frame, 2) frame_diff 3) ped_ids for writing predictions
-                    observed_path = paths[0]
-                    frame_diff = observed_path[1].frame - observed_path[0].frame
-                    first_frame = observed_path[args.obs_length-1].frame + frame_diff
-                    ped_id = observed_path[0].pedestrian
-                    ped_id_ = []
-                    for j, _ in enumerate(paths[1:]): ## Only need neighbour ids
-                        ped_id_.append(paths[j+1][0].pedestrian)
-
-                    ## Write SceneRow
-                    scenerow = trajnetplusplustools.SceneRow(scene_id, ped_id, observed_path[0].frame, 
-                                                             observed_path[0].frame + (seq_length - 1) * frame_diff, 2.5, 0)
-                    # scenerow = trajnetplusplustools.SceneRow(scenerow.scene, scenerow.pedestrian, scenerow.start, scenerow.end, 2.5, 0)
-                    myfile.write(trajnetplusplustools.writers.trajnet(scenerow))
-                    myfile.write('\n')
-
-                    for m in range(len(predictions)):
-                        prediction, neigh_predictions = predictions[m]
-                        ## Write Primary
-                        for i in range(len(prediction)):
-                            track = trajnetplusplustools.TrackRow(first_frame + i * frame_diff, ped_id,
-                                                                  prediction[i, 0].item(), prediction[i, 1].item(), m, scene_id)
-                            myfile.write(trajnetplusplustools.writers.trajnet(track))
-                            myfile.write('\n')
-
-                        ## Write Neighbours (if non-empty)
-                        if len(neigh_predictions):
-                            for n in range(neigh_predictions.shape[1]):
-                                neigh = neigh_predictions[:, n]
-                                for j in range(len(neigh)):
-                                    track = trajnetplusplustools.TrackRow(first_frame + j * frame_diff, ped_id_[n],
-                                                                          neigh[j, 0].item(), neigh[j, 1].item(), m, scene_id)
-                                    myfile.write(trajnetplusplustools.writers.trajnet(track))
-                                    myfile.write('\n')
+            cache_file = cache.prediction_file(keys[dataset])
+            if os.path.exists(cache_file + '.tmp'):
+                os.remove(cache_file + '.tmp')
+            with PredictionWriter(cache_file + '.tmp', args.obs_length, seq_length,
+                                  background=args.background_write) as writer:
+                if pool is None:
+                    ## Get predictions of batch_size scenes (or of the whole file) in one forward pass. Faster!
+                    batch_size = max(len(scenes), 1) if getattr(predictor, 'whole_file', False) else args.batch_size
+                    for i in tqdm(range(0, len(scenes), batch_size)):
+                        chunk = scenes[i:i + batch_size]
+                        pred_list = predictor.predict_batch([paths for _, _, paths in chunk],
+                                                            scene_goals[i:i + batch_size], n_predict=args.pred_length,
+                                                            obs_length=args.obs_length, modes=args.modes, args=args)
+                        ## Write Predictions of the chunk
+                        for (predictions, (_, scene_id, paths)) in zip(pred_list, chunk):
+                            writer.write(scene_id, paths, predictions)
+                else:
+                    ## Get all predictions in parallel, streamed as they are computed. Faster!
+                    pred_list = pool.predict(scene_file, [scene_id for _, scene_id, _ in scenes], goal_file)
+                    ## Write All Predictions
+                    for (predictions, (_, scene_id, paths)) in zip(tqdm(pred_list, total=len(scenes)), scenes):
+                        writer.write(scene_id, paths, predictions)
+            ## Only complete prediction files enter the cache
+            os.replace(cache_file + '.tmp', cache_file)
+            shutil.copyfile(cache_file, args.path + '{}/{}'.format(model_name, name))
         print('')
+        if pool is not None:
+            pool.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -22,7 +22,6 @@ setup(
 
     install_requires=[
         'numpy',
-        'pykalman',
         'python-json-logger',
         'scipy',
         'torch',
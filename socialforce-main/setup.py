@@ -30,6 +30,9 @@ setup(
         'plot': [
             'matplotlib',
         ],
+        'kdtree': [
+            'scipy',
+        ],
     },
 
     classifiers=[
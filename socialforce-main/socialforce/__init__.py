@@ -2,6 +2,6 @@
 
 __version__ = '0.1.0'
 
-from .simulator import Simulator
+from .simulator import Simulator, BatchSimulator
 from .potentials import PedPedPotential, PedSpacePotential
 from . import show
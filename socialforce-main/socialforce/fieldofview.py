@@ -2,6 +2,8 @@
 
 import numpy as np
 
+from . import stateutils
+
 
 class FieldOfView(object):
     """Compute field of view prefactors.
@@ -18,9 +20,19 @@ class FieldOfView(object):
 
         e is rank 2 and normalized in the last index.
         f is a rank 3 tensor.
+        Leading (scene) dimensions are broadcast.
         """
-        in_sight = np.einsum('aj,abj->ab', e, f) > np.linalg.norm(f, axis=-1) * self.cosphi
+        in_sight = np.einsum('...aj,...abj->...ab', e, f) > np.linalg.norm(f, axis=-1) * self.cosphi
         out = self.out_of_view_factor * np.ones_like(in_sight)
         out[in_sight] = 1.0
-        np.fill_diagonal(out, 0.0)
+        stateutils.fill_diagonal(out, 0.0)
         return out
+
+    def pairs(self, e_a, f_ab):
+        """Weighting factor for field of view of a list of pairs (a, b).
+
+        e_a [n_pairs, 2] are the desired directions of the pedestrians a and
+        f_ab [n_pairs, 2] the corresponding forces.
+        """
+        in_sight = np.einsum('ij,ij->i', e_a, f_ab) > np.linalg.norm(f_ab, axis=-1) * self.cosphi
+        return np.where(in_sight, 1.0, self.out_of_view_factor)
@@ -0,0 +1,49 @@
+"""Neighbour search on a uniform grid (spatial hash)."""
+
+import numpy as np
+
+# (dx, dy) offsets of a grid cell and its 8 neighbouring cells
+CELL_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+def pairs(positions, radius, groups=None):
+    """Ordered pairs (a, b), a != b, of points closer than radius.
+
+    positions is [n, 2]. Points of different groups (e.g. scenes) are never
+    paired. The points are hashed into square cells of size radius, so only
+    the points of the 9 cells around every point are compared.
+
+    Returns two index arrays a and b of the same length.
+    """
+    if groups is None:
+        groups = np.zeros(len(positions), dtype=np.int64)
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # integer cell coordinates, shifted to leave room for the offsets
+    cells = np.floor(positions / radius).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    n_x, n_y = cells.max(axis=0) + 2
+
+    def cell_key(group, cell_x, cell_y):
+        return (group * n_x + cell_x) * n_y + cell_y
+
+    keys = cell_key(groups, cells[:, 0], cells[:, 1])
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    a, b = [], []
+    for dx, dy in CELL_OFFSETS:
+        neighbour_keys = cell_key(groups, cells[:, 0] + dx, cells[:, 1] + dy)
+        start = np.searchsorted(sorted_keys, neighbour_keys, side='left')
+        counts = np.searchsorted(sorted_keys, neighbour_keys, side='right') - start
+        # expand the ranges [start, start + count) of every point
+        first = np.cumsum(counts) - counts
+        a.append(np.repeat(np.arange(len(positions)), counts))
+        b.append(order[np.repeat(start - first, counts) + np.arange(counts.sum())])
+    a = np.concatenate(a)
+    b = np.concatenate(b)
+
+    r_ab = positions[a] - positions[b]
+    close = (a != b) & (np.einsum('ij,ij->i', r_ab, r_ab) < radius**2)
+    return a[close], b[close]
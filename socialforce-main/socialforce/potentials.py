@@ -2,8 +2,15 @@
 
 import numpy as np
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 from . import stateutils
 
+EPSILON = 1e-12  # lower bound of the denominators of the analytic gradients
+
 
 class PedPedPotential(object):
     """Ped-ped interaction potential.
@@ -19,15 +26,15 @@ class PedPedPotential(object):
 
     def b(self, r_ab, speeds, desired_directions):
         """Calculate b."""
-        speeds_b = np.expand_dims(speeds, axis=0)
-        speeds_b_abc = np.expand_dims(speeds_b, axis=2)  # abc = alpha, beta, coordinates
-        e_b = np.expand_dims(desired_directions, axis=0)
+        speeds_b = np.expand_dims(speeds, axis=-2)
+        speeds_b_abc = np.expand_dims(speeds_b, axis=-1)  # abc = alpha, beta, coordinates
+        e_b = np.expand_dims(desired_directions, axis=-3)
 
         in_sqrt = (
             np.linalg.norm(r_ab, axis=-1) +
             np.linalg.norm(r_ab - self.delta_t * speeds_b_abc * e_b, axis=-1)
         )**2 - (self.delta_t * speeds_b)**2
-        np.fill_diagonal(in_sqrt, 0.0)
+        stateutils.fill_diagonal(in_sqrt, 0.0)
 
         return 0.5 * np.sqrt(in_sqrt)
 
@@ -38,16 +45,59 @@ class PedPedPotential(object):
     @staticmethod
     def r_ab(state):
         """r_ab"""
-        r = state[:, 0:2]
-        r_a = np.expand_dims(r, 1)
-        r_b = np.expand_dims(r, 0)
+        r = state[..., 0:2]
+        r_a = np.expand_dims(r, -2)
+        r_b = np.expand_dims(r, -3)
         return r_a - r_b
 
     def __call__(self, state):
         speeds = stateutils.speeds(state)
         return self.value_r_ab(self.r_ab(state), speeds, stateutils.desired_directions(state))
 
-    def grad_r_ab(self, state, delta=1e-3):
+    def grad_r_ab(self, state, delta=None):
+        """Compute gradient wrt r_ab.
+
+        The gradient is analytic unless a finite difference step delta is
+        given (to validate the analytic gradient).
+        """
+        if delta is not None:
+            return self.grad_r_ab_finite_difference(state, delta)
+
+        r_ab = self.r_ab(state)
+        speeds = stateutils.speeds(state)
+        desired_directions = stateutils.desired_directions(state)
+
+        grad = self.grad_value_r_ab(r_ab, np.expand_dims(speeds, -2),
+                                    np.expand_dims(desired_directions, -3))
+
+        # remove gradients from self-intereactions
+        diagonal = np.arange(grad.shape[-2])
+        grad[..., diagonal, diagonal, :] = 0.0
+        return grad
+
+    def grad_value_r_ab(self, r_ab, speeds_b, desired_directions_b):
+        """Analytic gradient of the potential wrt r_ab [..., 2].
+
+        speeds_b [...] and desired_directions_b [..., 2] are the ones of the
+        pedestrians b and broadcast with r_ab: this computes dense [..., N, N]
+        gradients as well as the gradients of lists of pairs.
+        """
+        # b = 0.5 * sqrt((|r_ab| + |r_ab - s_b|)^2 - |s_b|^2) with s_b = delta_t * v_b * e_b
+        r_ab_s = r_ab - self.delta_t * np.expand_dims(speeds_b, -1) * desired_directions_b
+        norm_r_ab = np.sqrt(np.einsum('...i,...i->...', r_ab, r_ab))
+        norm_r_ab_s = np.sqrt(np.einsum('...i,...i->...', r_ab_s, r_ab_s))
+        length = norm_r_ab + norm_r_ab_s
+        in_sqrt = np.maximum(length**2 - (self.delta_t * speeds_b)**2, 0.0)
+        b = 0.5 * np.sqrt(in_sqrt)
+
+        # grad b = (|r_ab| + |r_ab - s_b|) / (4 b) * (unit(r_ab) + unit(r_ab - s_b))
+        # b vanishes for self-interactions, and otherwise only when a lies on the next step s_b of b
+        factor = -self.v0 / self.sigma * np.exp(-b / self.sigma) * length / np.maximum(4.0 * b, EPSILON)
+        units = (r_ab / np.expand_dims(np.maximum(norm_r_ab, EPSILON), -1) +
+                 r_ab_s / np.expand_dims(np.maximum(norm_r_ab_s, EPSILON), -1))
+        return np.expand_dims(factor, -1) * units
+
+    def grad_r_ab_finite_difference(self, state, delta=1e-3):
         """Compute gradient wrt r_ab using finite difference differentiation."""
         r_ab = self.r_ab(state)
         speeds = stateutils.speeds(state)
@@ -61,8 +111,8 @@ class PedPedPotential(object):
         dvdy = (self.value_r_ab(r_ab + dy, speeds, desired_directions) - v) / delta
 
         # remove gradients from self-intereactions
-        np.fill_diagonal(dvdx, 0.0)
-        np.fill_diagonal(dvdy, 0.0)
+        stateutils.fill_diagonal(dvdx, 0.0)
+        stateutils.fill_diagonal(dvdy, 0.0)
 
         return np.stack((dvdx, dvdy), axis=-1)
 
@@ -71,6 +121,8 @@ class PedSpacePotential(object):
     """Pedestrian-space interaction potential.
 
     space is a list of numpy arrays containing points of boundaries.
+    When scipy is installed, the points of every boundary are indexed once in
+    a KD-tree to find the closest points of the pedestrians.
 
     u0 is in m^2 / s^2.
     r is in m
@@ -80,6 +132,7 @@ class PedSpacePotential(object):
         self.space = space or []
         self.u0 = u0
         self.r = r
+        self.trees = [cKDTree(B) for B in self.space] if cKDTree is not None else None
 
     def value_r_aB(self, r_aB):
         """Compute value parametrized with r_aB."""
@@ -88,22 +141,39 @@ class PedSpacePotential(object):
     def r_aB(self, state):
         """r_aB"""
         if not self.space:
-            return np.zeros((state.shape[0], 0, 2))
-
-        r_a = np.expand_dims(state[:, 0:2], 1)
-        closest_i = [
-            np.argmin(np.linalg.norm(r_a - np.expand_dims(B, 0), axis=-1), axis=1)
-            for B in self.space
-        ]
-        closest_points = np.swapaxes(
-            np.stack([B[i] for B, i in zip(self.space, closest_i)]),
-            0, 1)  # index order: pedestrian, boundary, coordinates
+            return np.zeros(state.shape[:-1] + (0, 2))
+
+        r_a = np.expand_dims(state[..., 0:2], -2)
+        if self.trees is not None:
+            closest_i = [tree.query(state[..., 0:2])[1] for tree in self.trees]
+        else:
+            closest_i = [
+                np.argmin(np.linalg.norm(r_a - B, axis=-1), axis=-1)
+                for B in self.space
+            ]
+        closest_points = np.stack(
+            [B[i] for B, i in zip(self.space, closest_i)],
+            axis=-2)  # index order: pedestrian, boundary, coordinates
         return r_a - closest_points
 
     def __call__(self, state):
         return self.value_r_aB(self.r_aB(state))
 
-    def grad_r_aB(self, state, delta=1e-3):
+    def grad_r_aB(self, state, delta=None):
+        """Compute gradient wrt r_aB.
+
+        The gradient is analytic unless a finite difference step delta is
+        given (to validate the analytic gradient).
+        """
+        if delta is not None:
+            return self.grad_r_aB_finite_difference(state, delta)
+
+        r_aB = self.r_aB(state)
+        norm_r_aB = np.sqrt(np.einsum('...i,...i->...', r_aB, r_aB))[..., np.newaxis]
+        factor = -self.u0 / self.r * np.exp(-1.0 * norm_r_aB / self.r)
+        return factor * r_aB / np.maximum(norm_r_aB, EPSILON)
+
+    def grad_r_aB_finite_difference(self, state, delta=1e-3):
         """Compute gradient wrt r_aB using finite difference differentiation."""
         r_aB = self.r_aB(state)
 
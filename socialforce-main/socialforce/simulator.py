@@ -9,6 +9,7 @@ import numpy as np
 
 from .potentials import PedPedPotential
 from .fieldofview import FieldOfView
+from . import neighbours
 from . import stateutils
 
 MAX_SPEED_MULTIPLIER = 1.3  # with respect to initial speed
@@ -19,25 +20,32 @@ class Simulator(object):
 
     Main interface is the state. Every pedestrian is an entry in the state and
     represented by a vector (x, y, v_x, v_y, d_x, d_y, [tau]).
-    tau is optional in this vector.
+    tau is optional in this vector. The state can have leading dimensions,
+    see BatchSimulator.
 
     ped_space is an instance of PedSpacePotential.
     ped_ped is an instance of PedPedPotential.
 
     delta_t in seconds.
     tau in seconds: either float or numpy array of shape[n_ped].
+
+    cutoff in m: if given, only the pedestrians closer than cutoff interact.
+    The interacting pairs are found on a uniform grid and the ped-ped forces
+    are computed on these pairs only, instead of all n_ped x n_ped pairs.
+    The potential decays like exp(-|r_ab| / sigma): a cutoff of 10 sigma
+    changes the trajectories by less than a millimeter.
     """
     def __init__(self, initial_state, ped_space=None, ped_ped=None,
-                 field_of_view=None, delta_t=0.4, tau=0.5):
+                 field_of_view=None, delta_t=0.4, tau=0.5, cutoff=None):
         self.state = initial_state
         self.initial_speeds = stateutils.speeds(initial_state)
         self.max_speeds = MAX_SPEED_MULTIPLIER * self.initial_speeds
 
         self.delta_t = delta_t
 
-        if self.state.shape[1] < 7:
+        if self.state.shape[-1] < 7:
             if not hasattr(tau, 'shape'):
-                tau = tau * np.ones(self.state.shape[0])
+                tau = tau * np.ones(self.state.shape[:-1])
             self.state = np.concatenate((self.state, np.expand_dims(tau, -1)), axis=-1)
 
         # potentials
@@ -47,6 +55,12 @@ class Simulator(object):
         # field of view
         self.w = field_of_view or FieldOfView()
 
+        self.cutoff = cutoff
+
+    def pedestrian_mask(self):
+        """Pedestrians taking part in the interactions."""
+        return np.ones(self.state.shape[:-1], dtype=bool)
+
     def f_ab(self):
         """Compute f_ab."""
         return -1.0 * self.V.grad_r_ab(self.state)
@@ -54,9 +68,30 @@ class Simulator(object):
     def f_aB(self):
         """Compute f_aB."""
         if self.U is None:
-            return np.zeros((self.state.shape[0], 0, 2))
+            return np.zeros(self.state.shape[:-1] + (0, 2))
         return -1.0 * self.U.grad_r_aB(self.state)
 
+    def F_ab_cutoff(self, e):
+        """Sum of the ped-ped forces, over the pairs closer than cutoff.
+
+        e are the desired directions. Pedestrians of different scenes
+        (leading dimensions of the state) do not interact.
+        """
+        n_ped = self.state.shape[-2]
+        state = self.state.reshape(-1, self.state.shape[-1])
+        e = e.reshape(-1, 2)
+        index = np.flatnonzero(self.pedestrian_mask())
+        a, b = neighbours.pairs(state[index, 0:2], self.cutoff, groups=index // n_ped)
+        a, b = index[a], index[b]
+
+        # repulsive terms between the pairs of pedestrians
+        f_ab = -1.0 * self.V.grad_value_r_ab(state[a, 0:2] - state[b, 0:2],
+                                             stateutils.speeds(state[b]), e[b])
+        F_ab = np.expand_dims(self.w.pairs(e[a], -f_ab), -1) * f_ab
+
+        F = np.stack([np.bincount(a, weights=F_ab[:, i], minlength=len(state)) for i in range(2)], axis=-1)
+        return F.reshape(self.state.shape[:-1] + (2,))
+
     def capped_velocity(self, desired_velocity):
         """Scale down a desired velocity to its capped speed."""
         desired_speeds = np.linalg.norm(desired_velocity, axis=-1)
@@ -68,27 +103,62 @@ class Simulator(object):
         """Do one step in the simulation and update the state in place."""
         # accelerate to desired velocity
         e = stateutils.desired_directions(self.state)
-        vel = self.state[:, 2:4]
-        tau = self.state[:, 6:7]
+        vel = self.state[..., 2:4]
+        tau = self.state[..., 6:7]
         F0 = 1.0 / tau * (np.expand_dims(self.initial_speeds, -1) * e - vel)
 
         # repulsive terms between pedestrians
-        f_ab = self.f_ab()
-        w = np.expand_dims(self.w(e, -f_ab), -1)
-        F_ab = w * f_ab
+        if self.cutoff is None:
+            f_ab = self.f_ab()
+            w = np.expand_dims(self.w(e, -f_ab), -1)
+            F_ab = np.sum(w * f_ab, axis=-2)
+        else:
+            F_ab = self.F_ab_cutoff(e)
 
         # repulsive terms between pedestrians and boundaries
         F_aB = self.f_aB()
 
         # social force
-        F = F0 + np.sum(F_ab, axis=1) + np.sum(F_aB, axis=1)
+        F = F0 + F_ab + np.sum(F_aB, axis=-2)
         # desired velocity
-        w = self.state[:, 2:4] + self.delta_t * F
+        w = self.state[..., 2:4] + self.delta_t * F
         # velocity
         v = self.capped_velocity(w)
 
         # update state
-        self.state[:, 0:2] += v * self.delta_t
-        self.state[:, 2:4] = v
+        self.state[..., 0:2] += v * self.delta_t
+        self.state[..., 2:4] = v
 
         return self
+
+
+class BatchSimulator(Simulator):
+    """Simulate many independent scenes at once.
+
+    The scenes are padded to the same number of pedestrians: the state is
+    [n_scenes, n_ped, 6 or 7] and mask [n_scenes, n_ped] is True for the
+    pedestrians present in each scene. Padded pedestrians neither exert nor
+    feel forces and stay at rest.
+
+    ped_space is shared by all scenes.
+    """
+    def __init__(self, initial_state, mask, ped_space=None, ped_ped=None,
+                 field_of_view=None, delta_t=0.4, tau=0.5, cutoff=None):
+        initial_state = np.where(np.expand_dims(mask, -1), initial_state, 0.0)
+        super(BatchSimulator, self).__init__(initial_state, ped_space, ped_ped,
+                                             field_of_view, delta_t, tau, cutoff)
+        self.state[~mask, 6] = 1.0  # any relaxation time, padded pedestrians have no force
+        self.mask = mask
+        self.pair_mask = np.expand_dims(mask, -1) & np.expand_dims(mask, -2)
+
+    def pedestrian_mask(self):
+        """Pedestrians taking part in the interactions."""
+        return self.mask
+
+    def f_ab(self):
+        """Compute f_ab between the pedestrians of the same scene."""
+        return super(BatchSimulator, self).f_ab() * np.expand_dims(self.pair_mask, -1)
+
+    def f_aB(self):
+        """Compute f_aB of the present pedestrians."""
+        return super(BatchSimulator, self).f_aB() * np.expand_dims(self.mask, (-1, -2))
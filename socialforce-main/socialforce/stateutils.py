@@ -5,7 +5,7 @@ import numpy as np
 
 def desired_directions(state):
     """Given the current state and destination, compute desired direction."""
-    destination_vectors = state[:, 4:6] - state[:, 0:2]
+    destination_vectors = state[..., 4:6] - state[..., 0:2]
     norm_factors = np.linalg.norm(destination_vectors, axis=-1)
     directions = destination_vectors / np.expand_dims(norm_factors, -1)
     directions[norm_factors == 0] = [0, 0]
@@ -14,4 +14,10 @@ def desired_directions(state):
 
 def speeds(state):
     """Return the speeds corresponding to a given state."""
-    return np.linalg.norm(state[:, 2:4], axis=-1)
+    return np.linalg.norm(state[..., 2:4], axis=-1)
+
+
+def fill_diagonal(a, value):
+    """Fill the diagonal of the last two (pedestrian) axes of a in place."""
+    diagonal = np.arange(a.shape[-1])
+    a[..., diagonal, diagonal] = value
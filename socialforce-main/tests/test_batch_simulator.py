@@ -0,0 +1,27 @@
+import numpy as np
+import socialforce
+
+
+def test_scenes_equal_separate_simulations():
+    rng = np.random.RandomState(0)
+    initial_states = [np.concatenate((rng.uniform(-2, 2, (n, 2)),
+                                      rng.uniform(-1, 1, (n, 2)),
+                                      rng.uniform(-5, 5, (n, 2))), axis=1)
+                      for n in (1, 4, 2)]
+
+    padded = np.zeros((3, 4, 6))
+    mask = np.zeros((3, 4), dtype=bool)
+    for i, state in enumerate(initial_states):
+        padded[i, :len(state)] = state
+        mask[i, :len(state)] = True
+    padded[~mask] = 1.0  # padding must not interact
+
+    space = [np.array([[x, 1.0] for x in np.linspace(-3, 3, 50)])]
+    s = socialforce.BatchSimulator(padded, mask, ped_space=socialforce.PedSpacePotential(space))
+    states = np.stack([s.step().state.copy() for _ in range(10)])
+
+    for i, state in enumerate(initial_states):
+        s = socialforce.Simulator(state.copy(), ped_space=socialforce.PedSpacePotential(space))
+        expected = np.stack([s.step().state.copy() for _ in range(10)])
+        assert np.allclose(states[:, i, :len(state)], expected)
+    assert np.all(states[:, ~mask, 0:4] == 0.0)
@@ -0,0 +1,33 @@
+import numpy as np
+import socialforce
+from socialforce import neighbours
+
+
+def test_neighbour_pairs():
+    rng = np.random.RandomState(0)
+    positions = rng.uniform(-10.0, 10.0, (300, 2))
+    groups = rng.randint(0, 3, 300)
+    a, b = neighbours.pairs(positions, 1.5, groups)
+
+    distances = np.linalg.norm(positions[:, np.newaxis] - positions[np.newaxis], axis=-1)
+    expected = (distances < 1.5) & (groups[:, np.newaxis] == groups[np.newaxis]) & ~np.eye(300, dtype=bool)
+    assert sorted(zip(a.tolist(), b.tolist())) == sorted(zip(*np.nonzero(expected)))
+
+
+def test_large_cutoff_equals_dense():
+    rng = np.random.RandomState(1)
+    initial_state = np.concatenate((rng.uniform(0.0, 5.0, (20, 2)),
+                                    rng.uniform(-1.0, 1.0, (20, 2)),
+                                    rng.uniform(0.0, 5.0, (20, 2))), axis=1)
+    dense = socialforce.Simulator(initial_state.copy())
+    sparse = socialforce.Simulator(initial_state.copy(), cutoff=100.0)
+    for _ in range(10):
+        dense.step()
+        sparse.step()
+    assert np.allclose(dense.state, sparse.state)
+
+    mask = np.array([[True] * 20, [True] * 5 + [False] * 15])
+    batch = socialforce.BatchSimulator(np.stack([initial_state] * 2), mask, cutoff=100.0)
+    for _ in range(10):
+        batch.step()
+    assert np.allclose(batch.state[0], dense.state)
@@ -49,3 +49,13 @@ def test_b_zero_vel():
         [0.0, 1.0],
         [1.0, 0.0],
     ]
+
+
+def test_grad_r_ab_finite_difference():
+    state = np.array([
+        [0.0, 0.0, 0.5, 0.5, 3.0, 3.0],
+        [1.0, 0.0, -1.0, 0.0, -3.0, 0.0],
+        [0.5, 1.5, 0.0, -1.2, 0.5, -3.0],
+    ])
+    V = socialforce.PedPedPotential(0.4)
+    assert V.grad_r_ab(state) == pytest.approx(V.grad_r_ab(state, delta=1e-6), abs=1e-5)
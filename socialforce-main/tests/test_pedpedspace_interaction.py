@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 import socialforce
 
 
@@ -15,3 +16,31 @@ def test_r_aB():
         [[0.0, -0.5]],
         [[1.0, -0.5]],
     ]
+
+
+def test_grad_r_aB_finite_difference():
+    state = np.array([
+        [0.0, 0.0, 0.0, 0.0, 0.0, 1.0],
+        [1.0, 0.0, 0.0, 0.0, 1.0, 1.0],
+    ])
+    space = [
+        np.array([[0.0, 100.0], [0.0, 0.5]]),
+        np.array([[0.8, 0.1], [2.0, 2.0]]),
+    ]
+    U = socialforce.PedSpacePotential(space)
+    assert U.grad_r_aB(state) == pytest.approx(U.grad_r_aB(state, delta=1e-6), abs=1e-4)
+
+
+def test_r_aB_kdtree():
+    rng = np.random.RandomState(0)
+    state = np.concatenate((rng.uniform(-5.0, 5.0, (3, 20, 2)), np.zeros((3, 20, 4))), axis=-1)
+    space = [
+        np.array([(x, 1.0) for x in np.linspace(-10, 10, 333)]),
+        rng.uniform(-10.0, 10.0, (500, 2)),
+    ]
+    U = socialforce.PedSpacePotential(space)
+    assert U.trees is not None
+    r_aB = U.r_aB(state)
+
+    U.trees = None  # brute force search
+    assert r_aB.tolist() == U.r_aB(state).tolist()
@@ -0,0 +1,20 @@
+import pytest
+import torch
+
+
+@pytest.fixture
+def random_batch():
+    """ Factory of seeded random batches of scenes
+
+    Returns the random walks xy [21, num_tracks, 2] of the scenes of sizes
+    'scene_sizes' (neighbour 5 enters the scene at the fourth frame) and
+    the batch_split [batch_size + 1] of the batch.
+    """
+    def make(scene_sizes=(1, 3, 6, 2)):
+        torch.manual_seed(0)
+        batch_split = torch.LongTensor([0] + list(scene_sizes)).cumsum(dim=0)
+        steps = torch.rand(21, int(batch_split[-1]), 2) * 0.4
+        xy = torch.rand(1, int(batch_split[-1]), 2) * 4.0 + steps.cumsum(dim=0)
+        xy[:3, 5] = float('nan')  # neighbour entering the scene
+        return xy, batch_split
+    return make
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import trajnetplusplustools
+from trajnetplusplustools import TrackRow
+
+from evaluator.array_metrics import track_positions, stack_tracks, l2_errors, collisions
+
+
+def random_track(rng, pedestrian, frames, start):
+    xy = start + np.cumsum(rng.uniform(-0.15, 0.15, (len(frames), 2)), axis=0)
+    return [TrackRow(f, pedestrian, x, y) for f, (x, y) in zip(frames, xy)]
+
+
+def test_matches_trajnetplusplustools():
+    rng = np.random.RandomState(0)
+    frames = list(range(12))
+    frame_index = {f: i for i, f in enumerate(frames)}
+    primaries, positions, presents, expected = [], [], [], []
+    for _ in range(20):
+        primary = random_track(rng, 0, frames, rng.uniform(0, 1, 2))
+        # neighbours with missing frames, close enough to collide sometimes
+        neighbours = [random_track(rng, j, sorted(rng.choice(frames, rng.randint(1, 13), replace=False)),
+                                   rng.uniform(0, 1, 2))
+                      for j in range(1, rng.randint(1, 5))]
+        primaries.append(track_positions([primary], frame_index)[0][0])
+        position, present = track_positions(neighbours, frame_index)
+        positions.append(position)
+        presents.append(present)
+        expected.append(any(trajnetplusplustools.metrics.collision(primary, n) for n in neighbours))
+
+    primaries = np.stack(primaries)
+    others, present = stack_tracks(positions, presents)
+    assert collisions(primaries, others, present).tolist() == expected
+    assert any(expected) and not all(expected)
+
+    ground_truth = primaries[1:]
+    predictions = primaries[:-1, None]
+    ade, fde = l2_errors(ground_truth, predictions)
+    for i in range(len(ground_truth)):
+        gt = [TrackRow(f, 0, x, y) for f, (x, y) in zip(frames, ground_truth[i])]
+        pred = [TrackRow(f, 0, x, y) for f, (x, y) in zip(frames, predictions[i, 0])]
+        assert ade[i, 0] == pytest.approx(trajnetplusplustools.metrics.average_l2(gt, pred))
+        assert fde[i, 0] == pytest.approx(trajnetplusplustools.metrics.final_l2(gt, pred))
@@ -0,0 +1,178 @@
+import io
+
+import pytest
+import torch
+import trajnetbaselines
+from trajnetbaselines.lstm.utils import pool_scenes
+from trajnetbaselines.lstm.non_gridbased_pooling import nearest_neighbours
+
+
+class PerScene(object):
+    """Hides forward_batch so that pool_scenes iterates over scenes."""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __call__(self, hidden_states, obs1, obs2):
+        self.pool.track_mask = self.track_mask
+        return self.pool(hidden_states, obs1, obs2)
+
+
+def pool_inputs(random_batch):
+    """ Hidden states and positions of a random batch at one time-step """
+    xy, batch_split = random_batch()
+    obs1, obs2 = xy[8], xy[9].clone()
+    obs2[4] = float('nan')  # absent neighbour
+    hidden_states = torch.rand(xy.size(1), 16)
+    track_mask = ~torch.isnan(obs2[:, 0])
+    return hidden_states, obs1, obs2, track_mask, batch_split
+
+
+@pytest.mark.parametrize('pool', [
+    trajnetbaselines.lstm.NN_Pooling(n=2, out_dim=8),
+    trajnetbaselines.lstm.NN_Pooling(n=4, out_dim=8, no_vel=True),
+    trajnetbaselines.lstm.NN_LSTM(n=2, hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.TrajectronPooling(hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.HiddenStateMLPPooling(hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.AttentionMLPPooling(hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.DirectionalMLPPooling(out_dim=8),
+    trajnetbaselines.lstm.NMMP(hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.NMMP(hidden_dim=16, out_dim=8, radius=1.5),
+    trajnetbaselines.lstm.NMMP(hidden_dim=16, out_dim=8, neigh=2),
+    trajnetbaselines.lstm.GridBasedPooling(type_='occupancy', n=4, hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.GridBasedPooling(type_='directional', n=4, pool_size=2, hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.GridBasedPooling(type_='occupancy', n=4, front=True, hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.GridBasedPooling(type_='occupancy', n=4, hidden_dim=16, out_dim=8, embedding_arch='lstm_layer'),
+    trajnetbaselines.lstm.GridBasedPooling(type_='dir_social', n=4, hidden_dim=16, out_dim=8),
+])
+def test_batch_equals_per_scene(pool, random_batch):
+    hidden_states, obs1, obs2, track_mask, batch_split = pool_inputs(random_batch)
+    pool.reset(len(obs1), device=obs1.device)
+    batched = pool_scenes(pool, hidden_states, obs1, obs2, track_mask, batch_split)
+    batched_state = getattr(pool, 'hidden_cell_state', None)
+    pool.reset(len(obs1), device=obs1.device)
+    per_scene = pool_scenes(PerScene(pool), hidden_states, obs1, obs2, track_mask, batch_split)
+    if batched_state is not None:
+        assert torch.allclose(batched_state[0], pool.hidden_cell_state[0], atol=1e-6)
+    assert batched.shape == (int(track_mask.sum()), 8)
+    assert batched.detach().numpy() == pytest.approx(per_scene.detach().numpy(), abs=1e-5)
+
+
+def test_normalize_along_motion():
+    ## The neighbours are rotated so that the direction of motion is +y
+    obs = torch.Tensor([[1.0, 0.0], [0.0, 0.0]])
+    past_obs = torch.Tensor([[0.0, 0.0], [0.0, -1.0]])
+    relative = torch.Tensor([[[2.0, 0.0]], [[2.0, 0.0]]])
+    normalized = trajnetbaselines.lstm.GridBasedPooling.normalize(relative, obs, past_obs)
+    assert normalized.numpy() == pytest.approx(torch.Tensor([[[0.0, 2.0]], [[2.0, 0.0]]]).numpy(), abs=1e-6)
+
+
+def test_occupancy_upsampled_cells():
+    pool = trajnetbaselines.lstm.GridBasedPooling(type_='occupancy', cell_side=2.0, n=2, pool_size=2)
+    ## neighbours 1 and 2 share an upsampled cell, neighbour 3 is in another one of the same cell
+    obs = torch.Tensor([[0.0, 0.0], [0.5, 0.5], [0.6, 0.6], [1.5, 0.5]])
+    grid = pool.occupancy(obs)
+    assert grid[0, 0].tolist() == [[0.0, 0.0], [0.0, 2.0]]
+
+
+@pytest.mark.parametrize('type_', ['occupancy', 'directional'])
+def test_make_grid_batch(type_):
+    torch.manual_seed(0)
+    pool = trajnetbaselines.lstm.GridBasedPooling(type_=type_, n=4, cell_side=1.0)
+    obs = torch.rand(5, 9, 2) * 4.0
+    obs[2, 1] = float('nan')
+    obs[3:, 7] = float('nan')
+    batch_split = torch.LongTensor([0, 3, 4, 9])
+
+    grids = pool.make_grid(obs, batch_split)
+    assert len(grids) == 4
+    for t, grid in enumerate(grids):
+        expected = torch.cat([pool.make_grid(obs[t:t + 2, start:end])[0]
+                              for start, end in zip(batch_split[:-1], batch_split[1:])])
+        assert grid.numpy() == pytest.approx(expected.numpy())
+
+
+def test_nearest_neighbours_ties():
+    ## agents 1, 2 and 4 are at the same distance of agent 0, ties are broken by index
+    obs = torch.Tensor([[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [3.0, 0.0], [-1.0, 0.0], [0.5, 0.0]]])
+    mask = torch.ones(1, 6, dtype=torch.bool)
+    neigh_index, neigh_valid = nearest_neighbours(obs, mask, 4)
+    assert neigh_index[0, 0].tolist() == [5, 1, 2, 4]
+    assert neigh_valid.all()
+
+    ## less than n neighbours: all neighbours in index order, then padding
+    mask[0, 3:] = False
+    neigh_index, neigh_valid = nearest_neighbours(obs, mask, 4)
+    assert neigh_index[0, 2, :2].tolist() == [0, 1]
+    assert neigh_valid[0, 2].tolist() == [True, True, False, False]
+
+
+@pytest.mark.parametrize('sparse_args', [dict(radius=100.0), dict(neigh=10)])
+def test_sparse_nmmp_equals_dense(sparse_args, random_batch):
+    hidden_states, obs1, obs2, track_mask, batch_split = pool_inputs(random_batch)
+    dense = trajnetbaselines.lstm.NMMP(hidden_dim=16, out_dim=8)
+    sparse = trajnetbaselines.lstm.NMMP(hidden_dim=16, out_dim=8, **sparse_args)
+    sparse.load_state_dict(dense.state_dict())
+    expected = pool_scenes(dense, hidden_states, obs1, obs2, track_mask, batch_split)
+    pooled = pool_scenes(sparse, hidden_states, obs1, obs2, track_mask, batch_split)
+    assert pooled.detach().numpy() == pytest.approx(expected.detach().numpy(), abs=1e-6)
+
+
+def test_sparse_nmmp_isolated_agents(random_batch):
+    hidden_states, obs1, obs2, track_mask, batch_split = pool_inputs(random_batch)
+    sparse = trajnetbaselines.lstm.NMMP(hidden_dim=16, out_dim=8, radius=1e-3)
+    pooled = pool_scenes(sparse, hidden_states, obs1, obs2, track_mask, batch_split)
+    assert (pooled == 0).all()
+
+
+def test_nmmp_saved_before_sparse_message_passing(random_batch):
+    hidden_states, obs1, obs2, track_mask, batch_split = pool_inputs(random_batch)
+    pool = trajnetbaselines.lstm.NMMP(hidden_dim=16, out_dim=8)
+    expected = pool_scenes(pool, hidden_states, obs1, obs2, track_mask, batch_split)
+    for name in ('radius', 'neigh', 'sparse'):
+        delattr(pool, name)
+    buffer = io.BytesIO()
+    torch.save(pool, buffer)
+    buffer.seek(0)
+    pool = torch.load(buffer, weights_only=False)
+    pooled = pool_scenes(pool, hidden_states, obs1, obs2, track_mask, batch_split)
+    assert torch.equal(pooled, expected)
+
+
+def baseline_social_grid(pool, hidden_state, obs):
+    """Social grid of the upsampled fill + lp_pool2d implementation of GridBasedPooling.occupancy"""
+    num_tracks = obs.size(0)
+    off_diagonal = ~torch.eye(num_tracks).bool()
+    relative = (obs.unsqueeze(0) - obs.unsqueeze(1))[off_diagonal].reshape(num_tracks, num_tracks - 1, 2)
+    other_values = pool.hidden_dim_encoding(
+        hidden_state.repeat(num_tracks, 1).view(num_tracks, num_tracks, -1)[off_diagonal].reshape(num_tracks, num_tracks - 1, -1))
+    side = pool.n * pool.pool_size
+    oij = relative / (pool.cell_side / pool.pool_size) + side / 2
+    range_mask = torch.sum((oij < 0) + (oij >= side), dim=2) == 0
+    oij[~range_mask] = 0
+    other_values[~range_mask] = pool.constant
+    oij = oij.long()
+    occ = pool.constant * torch.ones(num_tracks, side**2, pool.pooling_dim)
+    occ[torch.arange(num_tracks).unsqueeze(1), oij[:, :, 0] * side + oij[:, :, 1]] = other_values
+    occ_2d = torch.transpose(occ, 1, 2).view(num_tracks, -1, side, side)
+    return torch.nn.functional.lp_pool2d(occ_2d, 1, pool.pool_size)
+
+
+@pytest.mark.parametrize('pool_size', [1, 2])
+def test_social_grid_gradients_equal_baseline(pool_size):
+    torch.manual_seed(0)
+    pool = trajnetbaselines.lstm.GridBasedPooling(type_='social', cell_side=1.0, n=4, pool_size=pool_size,
+                                                  hidden_dim=16, out_dim=8)
+    ## for agent 0, neighbour 1 is in cell (0, 0), overwritten by the out-of-range neighbour 2
+    obs = torch.Tensor([[0.0, 0.0], [-1.9, -1.9], [5.0, 5.0], [0.5, 0.5], [1.2, -0.7]])
+    weights = torch.rand(len(obs), pool.pooling_dim, pool.n, pool.n)
+
+    gradients = []
+    for grid_function in (lambda h: pool.social(h, obs.clone(), obs.clone()),
+                          lambda h: baseline_social_grid(pool, h, obs.clone())):
+        hidden_state = torch.rand(len(obs), 16, generator=torch.Generator().manual_seed(1)).requires_grad_()
+        grid = grid_function(hidden_state)
+        (grid * weights).sum().backward()
+        gradients.append((grid.detach(), hidden_state.grad))
+
+    assert gradients[0][0].numpy() == pytest.approx(gradients[1][0].numpy(), abs=1e-6)
+    assert gradients[0][1].numpy() == pytest.approx(gradients[1][1].numpy(), abs=1e-6)
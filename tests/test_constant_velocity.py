@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from trajnetbaselines.classical import constant_velocity
+
+
+def test_batch_matches_single_scenes():
+    rng = np.random.RandomState(0)
+    scenes = [np.cumsum(rng.uniform(-0.3, 0.5, (9, n, 2)), axis=0) for n in (1, 4, 2)]
+    outputs = constant_velocity.predict_batch(scenes, n_predict=3)
+
+    for xy, output in zip(scenes, outputs):
+        primary, neighbours = output[0]
+        expected = xy[-1] + np.arange(1, 4)[:, np.newaxis, np.newaxis] * (xy[-1] - xy[-2])
+        assert primary == pytest.approx(expected[:, 0])
+        assert neighbours.shape == (3, xy.shape[1] - 1, 2)
+        assert neighbours == pytest.approx(expected[:, 1:])
@@ -0,0 +1,38 @@
+import math
+
+import torch
+from trajnetbaselines.lstm.contrastive import SocialNCE, sample_negatives, spatial_samples
+
+
+def test_negatives_follow_neighbours(random_batch):
+    batch_scene, batch_split = random_batch()
+    batch_scene[:, 5] = float('nan')  # absent neighbour
+    nce = SocialNCE(9, 12, None, None, 0.07, 4, 'single')
+    gt_future = batch_scene[9:]
+    sample_neg = sample_negatives(gt_future, batch_split, nce.agent_zone, 0.0)
+    num_directions = len(nce.agent_zone)
+    assert sample_neg.shape == (12, 4, 5 * num_directions, 2)
+
+    for i in range(len(batch_split) - 1):
+        neighbours = gt_future[:, batch_split[i] + 1:batch_split[i + 1]]
+        expected = (neighbours[:, :, None] + nce.agent_zone).reshape(12, -1, 2)
+        assert torch.allclose(sample_neg[:, i, :expected.shape[1]], expected, equal_nan=True)
+        assert torch.isnan(sample_neg[:, i, expected.shape[1]:]).all()
+
+
+def test_spatial_samples(random_batch):
+    batch_scene, batch_split = random_batch()
+    batch_scene[:, 5] = float('nan')  # absent neighbour
+    nce = SocialNCE(9, 12, None, None, 0.07, 4, 'single')
+    gt_future = batch_scene[9]
+    sample_pos, sample_neg = spatial_samples(gt_future, batch_split, nce.agent_zone, 0.05, 1.0)
+    assert sample_pos.shape == (4, 2)
+    assert (sample_pos - gt_future[batch_split[:-1]]).abs().max() < 5 * math.sqrt(0.05)
+
+    ## Negatives too close to the primary pedestrian are discarded
+    dist = torch.norm(sample_neg - gt_future[batch_split[:-1]][:, None], dim=-1)
+    assert not (dist <= 1.0).any()
+    assert (~torch.isnan(dist)).any()
+
+    _, sample_neg = nce._sampling_event(batch_scene, batch_split)
+    assert sample_neg.shape == (12, 4, 5 * len(nce.agent_zone), 2)
@@ -0,0 +1,117 @@
+import json
+import os
+import pickle
+import random
+
+import numpy as np
+import pytest
+import torch
+import trajnetplusplustools
+from trajnetbaselines.lstm.data_load_utils import (BucketBatchSampler, _cache_valid, compile_scene_cache,
+                                                   load_scene_cache, prepare_data)
+
+
+def write_dataset(folder, file, num_scenes, seed=0):
+    """ Writes the ndjson file and the goal file of num_scenes random scenes
+
+    Scenes of 21 frames overlap in time, some neighbours leave before the end.
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(folder + '/train', exist_ok=True)
+    os.makedirs('goal_files/train', exist_ok=True)
+    lines = []
+    for scene_id in range(num_scenes):
+        start = 10 * scene_id
+        lines.append({'scene': {'id': scene_id, 'p': scene_id, 's': start, 'e': start + 200,
+                                'fps': 2.5, 'tag': [1, []]}})
+    for ped in range(num_scenes + 2):
+        start = 10 * min(ped, num_scenes - 1)
+        length = 21 if ped < num_scenes else 12
+        xy = rng.uniform(0.0, 5.0, size=2) + np.cumsum(rng.uniform(-0.5, 0.5, size=(length, 2)), axis=0)
+        for t in range(length):
+            lines.append({'track': {'f': start + 10 * t, 'p': ped, 'x': round(xy[t, 0], 2), 'y': round(xy[t, 1], 2)}})
+    with open(folder + '/train/' + file + '.ndjson', 'w') as f:
+        f.write(''.join(json.dumps(line) + '\n' for line in lines))
+    with open('goal_files/train/' + file + '.pkl', 'wb') as f:
+        pickle.dump({ped: [float(ped), -1.0] for ped in range(num_scenes + 2)}, f)
+
+
+def test_scene_cache_equals_ndjson(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_dataset('data', 'first', 4, seed=0)
+    write_dataset('data', 'second', 3, seed=1)
+    compile_scene_cache('data', '/train/', goals=True)
+    scenes, goals = load_scene_cache('data', '/train/', goals=True)
+    assert [(file, s_id) for file, s_id, _ in scenes] == [('first', i) for i in range(4)] + [('second', i) for i in range(3)]
+
+    for file, s_id, xy in scenes:
+        reader = trajnetplusplustools.Reader('data/train/' + file + '.ndjson', scene_type='paths')
+        _, paths = reader.scene(s_id)
+        np.testing.assert_array_equal(xy, trajnetplusplustools.Reader.paths_to_xy(paths).astype(np.float32))
+        goal_dict = pickle.load(open('goal_files/train/' + file + '.pkl', 'rb'))
+        np.testing.assert_array_equal(goals[file][s_id], [goal_dict[path[0].pedestrian] for path in paths])
+    assert np.isnan(scenes[0][2]).any()
+
+
+def test_scene_cache_invalidation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_dataset('data', 'first', 4)
+    assert not _cache_valid('data', '/train/', goals=False)
+    compile_scene_cache('data', '/train/', goals=False)
+    assert _cache_valid('data', '/train/', goals=False)
+    ## goals were not compiled
+    assert not _cache_valid('data', '/train/', goals=True)
+
+    ## touched source file
+    stat = os.stat('data/train/first.ndjson')
+    os.utime('data/train/first.ndjson', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not _cache_valid('data', '/train/', goals=False)
+    compile_scene_cache('data', '/train/', goals=False)
+    assert _cache_valid('data', '/train/', goals=False)
+
+    ## changed source file: recompiled by prepare_data
+    write_dataset('data', 'first', 5)
+    assert not _cache_valid('data', '/train/', goals=True)
+    scenes, goals, _ = prepare_data('data', '/train/', goals=True, cache=True)
+    assert _cache_valid('data', '/train/', goals=True)
+    assert len(scenes) == 5 and len(goals['first']) == 5
+
+
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_bucket_sampler_batch_size(shuffle):
+    random.seed(0)
+    num_agents = [random.randint(1, 40) for _ in range(103)]
+    batches = list(BucketBatchSampler(num_agents, batch_size=8, bucket_size=4, shuffle=shuffle))
+    assert sorted(i for batch in batches for i in batch) == list(range(103))
+    assert sorted(len(batch) for batch in batches)[1:] == [8] * 12
+    for batch in batches:
+        agents = [num_agents[i] for i in batch]
+        assert agents == sorted(agents)
+
+
+def test_bucket_sampler_max_agents():
+    random.seed(0)
+    num_agents = [random.randint(1, 40) for _ in range(103)] + [70]
+    batches = list(BucketBatchSampler(num_agents, max_agents=64, bucket_size=4))
+    assert sorted(i for batch in batches for i in batch) == list(range(104))
+    for batch in batches:
+        assert len(batch) == 1 or sum(num_agents[i] for i in batch) <= 64
+
+
+@pytest.mark.parametrize('max_agents', [None, 64])
+def test_bucket_sampler_len(max_agents):
+    random.seed(0)
+    num_agents = [random.randint(1, 40) for _ in range(103)]
+    sampler = BucketBatchSampler(num_agents, batch_size=8, max_agents=max_agents, bucket_size=4)
+    loader = torch.utils.data.DataLoader(list(range(103)), batch_sampler=sampler)
+    if max_agents is None:
+        assert len(loader) == 13
+
+    ## len() does not change the batches drawn, and is exact once they are drawn
+    random.seed(1)
+    expected = list(sampler)
+    random.seed(1)
+    len(loader)
+    batches = iter(loader)
+    assert len(loader) == len(expected)
+    assert [batch.tolist() for batch in batches] == expected
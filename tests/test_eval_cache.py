@@ -0,0 +1,97 @@
+import argparse
+
+import pytest
+from evaluator import eval_cache
+from evaluator.eval_cache import EvalCache, prediction_key, result_key
+
+
+def write(path, content):
+    path.write_text(content)
+    return str(path)
+
+
+@pytest.fixture
+def cell(tmp_path):
+    """ Checkpoint, dataset, goal and ground truth files of one (model, dataset) cell """
+    return dict(
+        model=write(tmp_path / 'lstm_model.pkl', 'checkpoint'),
+        scene_file=write(tmp_path / 'test.ndjson', '{"scene": 1}\n'),
+        goal_file=write(tmp_path / 'goals.pkl', 'goals'),
+        gt_file=write(tmp_path / 'test_private.ndjson', '{"track": 1}\n'),
+    )
+
+
+def keys(cell, **options):
+    args = argparse.Namespace(obs_length=9, pred_length=12, modes=1, normalize_scene=False,
+                              disable_collision=False)
+    vars(args).update(options)
+    pred_key = prediction_key(cell['model'], 'lstm_model_modes1', cell['scene_file'], cell['goal_file'], args)
+    return pred_key, result_key(pred_key, cell['gt_file'], args)
+
+
+def test_cache_hits_unchanged_cell(tmp_path, cell):
+    cache = EvalCache(str(tmp_path / 'eval_cache'))
+    pred_key, res_key = keys(cell)
+    assert not cache.has_predictions(pred_key)
+    assert cache.load_result(res_key) is None
+
+    open(cache.prediction_file(pred_key), 'w').close()
+    cache.save_result(res_key, {'ade': 0.5})
+    pred_key, res_key = keys(cell)
+    assert cache.has_predictions(pred_key)
+    assert cache.load_result(res_key) == {'ade': 0.5}
+
+
+@pytest.mark.parametrize('changed', ['model', 'scene_file', 'goal_file'])
+def test_cache_misses_changed_file(tmp_path, cell, changed):
+    cache = EvalCache(str(tmp_path / 'eval_cache'))
+    pred_key, res_key = keys(cell)
+    open(cache.prediction_file(pred_key), 'w').close()
+    cache.save_result(res_key, {'ade': 0.5})
+
+    with open(cell[changed], 'a') as f:
+        f.write('changed')
+    pred_key, res_key = keys(cell)
+    assert not cache.has_predictions(pred_key)
+    assert cache.load_result(res_key) is None
+
+
+def test_cache_misses_changed_model_sources(tmp_path, cell, monkeypatch):
+    ## Checkpoints load the classes of the current trajnetbaselines sources
+    source = write(tmp_path / 'lstm.py', 'class LSTM: pass')
+    monkeypatch.setattr(eval_cache, 'module_files', lambda name: [source])
+    pred_key = keys(cell)[0]
+    with open(source, 'a') as f:
+        f.write('  # changed')
+    assert keys(cell)[0] != pred_key
+
+
+def test_result_misses_changed_ground_truth(tmp_path, cell):
+    cache = EvalCache(str(tmp_path / 'eval_cache'))
+    pred_key, res_key = keys(cell)
+    cache.save_result(res_key, {'ade': 0.5})
+
+    with open(cell['gt_file'], 'a') as f:
+        f.write('changed')
+    assert keys(cell)[0] == pred_key
+    assert cache.load_result(keys(cell)[1]) is None
+
+
+@pytest.mark.parametrize('option', [
+    dict(obs_length=8), dict(pred_length=11), dict(modes=3), dict(normalize_scene=True),
+    dict(disable_collision=True),
+])
+def test_cache_misses_changed_option(tmp_path, cell, option):
+    cache = EvalCache(str(tmp_path / 'eval_cache'))
+    res_key = keys(cell)[1]
+    cache.save_result(res_key, {'ade': 0.5})
+    assert keys(cell, **option)[1] != res_key
+    assert cache.load_result(keys(cell, **option)[1]) is None
+
+
+def test_baseline_keys_differ():
+    args = argparse.Namespace(obs_length=9, pred_length=12, modes=1, normalize_scene=False)
+    scene_file = __file__
+    baseline_keys = {prediction_key(name, name + '_modes1', scene_file, None, args)
+                     for name in ['kf', 'sf', 'sf_opt', 'orca', 'cv']}
+    assert len(baseline_keys) == 5
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from trajnetbaselines.classical import kalman
+
+
+def test_smoothed_states_match_pykalman():
+    pykalman = pytest.importorskip('pykalman')
+    rng = np.random.RandomState(0)
+    observations = np.cumsum(rng.uniform(-0.3, 0.5, (5, 9, 2)), axis=1)
+    smoothed = kalman.smooth_tracks(observations)
+
+    for track, states in zip(observations, smoothed):
+        kf = pykalman.KalmanFilter(transition_matrices=kalman.TRANSITION_MATRIX,
+                                   observation_matrices=kalman.OBSERVATION_MATRIX,
+                                   transition_covariance=1e-5 * np.eye(4),
+                                   observation_covariance=0.05**2 * np.eye(2),
+                                   initial_state_mean=[track[0, 0], 0, track[0, 1], 0])
+        kf.em(track)
+        expected, _ = kf.smooth(track)
+        assert states == pytest.approx(expected, abs=1e-6)
+
+
+def test_constant_velocity_propagation():
+    observations = np.stack([np.arange(9) * 0.4, np.arange(9) * -0.2], axis=-1)[np.newaxis]
+    predictions = kalman.predict_tracks(observations, n_predict=3)
+    assert predictions[0] == pytest.approx(np.array([[3.6, -1.8], [4.0, -2.0], [4.4, -2.2]]), abs=1e-3)
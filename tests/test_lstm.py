@@ -0,0 +1,57 @@
+import torch
+from trajnetbaselines.lstm.lstm import LSTM
+
+
+def list_step(model, lstm, hidden_cell_state, obs1, obs2, goals):
+    """ Step of the LSTM keeping the states of the tracks as lists of Tensors [hidden_dim] """
+    track_mask = (torch.isnan(obs1[:, 0]) + torch.isnan(obs2[:, 0])) == 0
+    hidden_cell_stacked = [
+        torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
+        torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+    ]
+    input_emb = model.input_embedding((obs2 - obs1)[track_mask])
+    norm_factors = torch.norm(obs2 - goals, dim=1)
+    goal_direction = (obs2 - goals) / norm_factors.unsqueeze(1)
+    input_emb = torch.cat([input_emb, model.goal_embedding(goal_direction[track_mask])], dim=1)
+
+    hidden_cell_stacked = lstm(input_emb, hidden_cell_stacked)
+    normal_masked = model.hidden2normal(hidden_cell_stacked[0])
+
+    normal = torch.full((track_mask.size(0), 5), float('nan'))
+    for i, h, c, n in zip(track_mask.nonzero()[:, 0], hidden_cell_stacked[0], hidden_cell_stacked[1], normal_masked):
+        hidden_cell_state[0][i] = h
+        hidden_cell_state[1][i] = c
+        normal[i] = n
+    return hidden_cell_state, normal
+
+
+def unroll(model, step, hidden_cell_state, xy, goals):
+    normals = []
+    for t, (obs1, obs2) in enumerate(zip(xy[:-1], xy[1:])):
+        lstm = model.encoder if t < 8 else model.decoder
+        hidden_cell_state, normal = step(lstm, hidden_cell_state, obs1, obs2, goals)
+        normals.append(normal)
+    normals = torch.stack(normals)
+    model.zero_grad()
+    normals[~torch.isnan(normals)].sum().backward()
+    return normals, [param.grad.clone() for param in model.parameters()]
+
+
+def test_step_equals_list_states(random_batch):
+    xy, batch_split = random_batch()
+    goals = xy[-1] + 1.0
+    xy[15:, 4] = float('nan')  # neighbour leaving the scene
+    model = LSTM(embedding_dim=8, hidden_dim=16, goal_flag=True)
+    num_tracks = xy.size(1)
+
+    normals, grads = unroll(
+        model, lambda *inputs: model.step(*inputs, batch_split),
+        (torch.zeros(num_tracks, 16), torch.zeros(num_tracks, 16)), xy, goals)
+    list_normals, list_grads = unroll(
+        model, lambda *inputs: list_step(model, *inputs),
+        ([torch.zeros(16) for _ in range(num_tracks)], [torch.zeros(16) for _ in range(num_tracks)]), xy, goals)
+
+    assert torch.isnan(normals[:3, 5]).all() and torch.isnan(normals[14:, 4]).all()
+    assert torch.allclose(normals, list_normals, equal_nan=True)
+    for grad, list_grad in zip(grads, list_grads):
+        assert torch.allclose(grad, list_grad, atol=1e-6)
@@ -0,0 +1,71 @@
+import pytest
+import torch
+import trajnetbaselines
+from trajnetbaselines.sgan.sgan import SGAN, LSTMGenerator
+
+
+@pytest.mark.parametrize('pool', [
+    None,
+    trajnetbaselines.lstm.NN_Pooling(n=2, out_dim=8),
+    trajnetbaselines.lstm.NN_LSTM(n=2, hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.TrajectronPooling(hidden_dim=16, out_dim=8),
+    trajnetbaselines.lstm.GridBasedPooling(type_='occupancy', n=4, hidden_dim=16, out_dim=8, embedding_arch='lstm_layer'),
+])
+@pytest.mark.parametrize('teacher_forcing', [True, False])
+def test_modes_equal_separate_generator_calls(pool, teacher_forcing, random_batch):
+    xy, batch_split = random_batch()
+    goals = torch.zeros(xy.size(1), 2)
+    generator = LSTMGenerator(embedding_dim=8, hidden_dim=16, pool=pool, noise_type='uniform')
+    model = SGAN(generator=generator, k=3, d_steps=0)
+    kwargs = dict(prediction_truth=xy[9:-1].clone()) if teacher_forcing else dict(n_predict=12)
+
+    torch.manual_seed(1)
+    rel_pred_list, pred_list, _, _, _ = model(xy[:9].clone(), goals, batch_split, **kwargs)
+
+    torch.manual_seed(1)
+    for rel_pred, pred in zip(rel_pred_list, pred_list):
+        kwargs_mode = dict(prediction_truth=xy[9:-1].clone()) if teacher_forcing else kwargs
+        rel_pred_mode, pred_mode, _ = generator(xy[:9].clone(), goals, batch_split, **kwargs_mode)
+        assert torch.allclose(rel_pred, rel_pred_mode, equal_nan=True, atol=1e-6)
+        assert torch.allclose(pred, pred_mode, equal_nan=True, atol=1e-6)
+    assert not torch.allclose(pred_list[0][-1], pred_list[1][-1])
+
+
+@pytest.mark.parametrize('pool', [
+    None,
+    trajnetbaselines.lstm.NN_LSTM(n=2, hidden_dim=16, out_dim=8),
+])
+def test_stacked_modes_equal_mode_list(pool, random_batch):
+    xy, batch_split = random_batch()
+    goals = torch.zeros(xy.size(1), 2)
+    generator = LSTMGenerator(embedding_dim=8, hidden_dim=16, pool=pool, noise_type='uniform')
+    model = SGAN(generator=generator, k=3, d_steps=0)
+
+    torch.manual_seed(1)
+    rel_pred_list, pred_list, _, _, _ = model(xy[:9].clone(), goals, batch_split, n_predict=12)
+    torch.manual_seed(1)
+    rel_pred_modes, pred_modes, _, _, _ = model(xy[:9].clone(), goals, batch_split, n_predict=12, stacked=True)
+    assert rel_pred_modes.shape == (3, 19, xy.size(1), 5)
+    assert torch.allclose(torch.stack(rel_pred_list), rel_pred_modes, rtol=0, atol=0, equal_nan=True)
+    assert torch.allclose(torch.stack(pred_list), pred_modes, rtol=0, atol=0, equal_nan=True)
+
+
+@pytest.mark.parametrize('criterion', [
+    trajnetbaselines.lstm.PredictionLoss(keep_batch_dim=True),
+    trajnetbaselines.lstm.L2Loss(keep_batch_dim=True),
+])
+def test_variety_loss_equals_loss_per_mode(criterion, random_batch):
+    from trajnetbaselines.sgan.trainer import Trainer
+    xy, batch_split = random_batch()
+    targets = xy[9:] - xy[8:-1]
+    torch.manual_seed(2)
+    inputs = [torch.cat([torch.randn(12, xy.size(1), 2) * 0.2,
+                         torch.rand(12, xy.size(1), 2) + 0.1,
+                         torch.rand(12, xy.size(1), 1) * 0.5], dim=2) for _ in range(4)]
+    trainer = Trainer.__new__(Trainer)
+    trainer.criterion, trainer.pred_length = criterion, 12
+
+    losses = torch.stack([criterion(sample, targets, batch_split) for sample in inputs])
+    assert losses.shape == (4, 4)
+    assert torch.allclose(trainer.variety_loss(inputs, targets, batch_split), losses.min(dim=0)[0].sum())
+    assert torch.allclose(trainer.variety_loss(torch.stack(inputs), targets, batch_split), losses.min(dim=0)[0].sum())
@@ -0,0 +1,30 @@
+import pytest
+import torch
+import trajnetbaselines
+from trajnetbaselines.vae.vae import VAE
+
+
+@pytest.mark.parametrize('pool', [
+    None,
+    trajnetbaselines.lstm.NN_Pooling(n=2, out_dim=8),
+    trajnetbaselines.lstm.NN_LSTM(n=2, hidden_dim=16, out_dim=8),
+])
+@pytest.mark.parametrize('training', [True, False])
+def test_modes_equal_single_mode_calls(pool, training, random_batch):
+    xy, batch_split = random_batch()
+    goals = torch.zeros(xy.size(1), 2)
+    model = VAE(embedding_dim=8, hidden_dim=16, pool=pool, latent_dim=8, num_modes=3)
+    model.train(training)
+    kwargs = dict(prediction_truth=xy[9:-1].clone()) if training else dict(n_predict=12)
+
+    torch.manual_seed(1)
+    rel_pred_list, pred_list, _, _ = model(xy[:9].clone(), goals, batch_split, **kwargs)
+    assert len(rel_pred_list) == len(pred_list) == 3
+
+    model.num_modes = 1
+    torch.manual_seed(1)
+    for rel_pred, pred in zip(rel_pred_list, pred_list):
+        kwargs_mode = dict(prediction_truth=xy[9:-1].clone()) if training else kwargs
+        (rel_pred_mode,), (pred_mode,), _, _ = model(xy[:9].clone(), goals, batch_split, **kwargs_mode)
+        assert torch.allclose(rel_pred, rel_pred_mode, equal_nan=True, atol=1e-6)
+        assert torch.allclose(pred, pred_mode, equal_nan=True, atol=1e-6)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import trajnetplusplustools
+from evaluator.write import PredictionWriter, format_scene
+
+
+def scene_paths(num_tracks=3, seq_length=21, first_frame=100, frame_diff=10):
+    return [[trajnetplusplustools.TrackRow(first_frame + t * frame_diff, 7 + p, 0.0, 0.0)
+             for t in range(seq_length)] for p in range(num_tracks)]
+
+
+def trajnet_lines(scene_id, paths, predictions, obs_length=9, seq_length=21):
+    """ Predictions serialized row by row with trajnetplusplustools.writers.trajnet """
+    observed_path = paths[0]
+    frame_diff = observed_path[1].frame - observed_path[0].frame
+    first_frame = observed_path[obs_length-1].frame + frame_diff
+    ped_id = observed_path[0].pedestrian
+    scenerow = trajnetplusplustools.SceneRow(scene_id, ped_id, observed_path[0].frame,
+                                             observed_path[0].frame + (seq_length - 1) * frame_diff, 2.5, 0)
+    lines = [trajnetplusplustools.writers.trajnet(scenerow)]
+    for m in range(len(predictions)):
+        prediction, neigh_predictions = predictions[m]
+        for i in range(len(prediction)):
+            track = trajnetplusplustools.TrackRow(first_frame + i * frame_diff, ped_id,
+                                                  prediction[i, 0].item(), prediction[i, 1].item(), m, scene_id)
+            lines.append(trajnetplusplustools.writers.trajnet(track))
+        if len(neigh_predictions):
+            for n in range(neigh_predictions.shape[1]):
+                neigh = neigh_predictions[:, n]
+                for j in range(len(neigh)):
+                    track = trajnetplusplustools.TrackRow(first_frame + j * frame_diff, paths[n + 1][0].pedestrian,
+                                                          neigh[j, 0].item(), neigh[j, 1].item(), m, scene_id)
+                    lines.append(trajnetplusplustools.writers.trajnet(track))
+    return '\n'.join(lines) + '\n'
+
+
+def random_predictions(modes=2, num_tracks=3, seed=0):
+    rng = np.random.RandomState(seed)
+    predictions = {}
+    for m in range(modes):
+        tracks = rng.uniform(-20.0, 20.0, size=(12, num_tracks, 2))
+        ## values at (and next to) the ties of rounding to 2 decimals
+        tracks[:4, 0] = [[0.125, -0.375], [1.005, 2.675], [-1.115, 0.005], [3.14159, -0.0]]
+        tracks[:3, -1] = [[0.285, 1.045], [-2.345, 10.005], [-29.945, 29.865]]
+        tracks[5:, -1] = np.nan  # neighbour leaving the scene
+        predictions[m] = [tracks[:, 0], tracks[:, 1:]]
+    return predictions
+
+
+@pytest.mark.parametrize('num_tracks', [1, 3])
+def test_format_scene_equals_trajnet_writer(num_tracks):
+    paths = scene_paths(num_tracks)
+    predictions = random_predictions(num_tracks=num_tracks)
+    if num_tracks == 1:
+        ## no neighbour predictions
+        predictions = {m: [prediction, []] for m, (prediction, _) in predictions.items()}
+    assert format_scene(42, paths, predictions, 9, 21) == trajnet_lines(42, paths, predictions)
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_prediction_writer(tmp_path, background):
+    filename = str(tmp_path / 'test.ndjson')
+    scenes = [(scene_id, scene_paths(), random_predictions(seed=scene_id)) for scene_id in range(20)]
+    with PredictionWriter(filename, 9, 21, background=background) as writer:
+        for scene_id, paths, predictions in scenes:
+            writer.write(scene_id, paths, predictions)
+    with open(filename) as f:
+        assert f.read() == ''.join(trajnet_lines(*scene) for scene in scenes)
@@ -1,20 +1,50 @@
 import numpy as np
 import trajnetplusplustools
 
-def predict(input_paths, predict_all=True, n_predict=12, obs_length=9):
-    multimodal_outputs = {}
-    pred_length = n_predict
 
-    xy = trajnetplusplustools.Reader.paths_to_xy(input_paths)
-    curr_position = xy[-1]
-    curr_velocity = xy[-1] - xy[-2]
-    output_rel_scenes = np.array([i * curr_velocity for i in range(1, n_predict+1)])
-    output_scenes = curr_position + output_rel_scenes
+def predict_xy(xy, n_predict=12):
+    """ Constant velocity predictions [..., n_predict, N, 2] of scenes xy [..., T, N, 2] """
+    curr_position = xy[..., -1:, :, :]
+    curr_velocity = xy[..., -1:, :, :] - xy[..., -2:-1, :, :]
+    steps = np.arange(1, n_predict+1)[:, np.newaxis, np.newaxis]
+    return curr_position + steps * curr_velocity
+
+
+def predict_batch(scenes, predict_all=True, n_predict=12, obs_length=9):
+    """ Constant velocity predictions of several scenes
 
-    output_primary = output_scenes[-n_predict:, 0]
-    output_neighs = output_scenes[-n_predict:, 1:]
+    The last two observations of the scenes (given as paths or as [T, N, 2]
+    arrays) are stacked into a NaN-padded [n_scenes, 2, max_N, 2] array and
+    predicted at once.
+
+    Returns
+    -------
+    List of dictionaries of predictions (see predict), one per scene
+    """
+    last_xy = [(paths if isinstance(paths, np.ndarray) else trajnetplusplustools.Reader.paths_to_xy(paths))[-2:]
+               for paths in scenes]
+    n_tracks = [xy.shape[1] for xy in last_xy]
+    padded = np.full((len(scenes), 2, max(n_tracks, default=0), 2), np.nan)
+    for i, xy in enumerate(last_xy):
+        padded[i, :, :n_tracks[i]] = xy
+    output_scenes = predict_xy(padded, n_predict)
 
     # Unimodal Prediction
-    multimodal_outputs[0] = output_primary, output_neighs
+    return [{0: (output_scenes[i, :, 0], output_scenes[i, :, 1:n_tracks[i]])} for i in range(len(scenes))]
+
+
+def predict(input_paths, predict_all=True, n_predict=12, obs_length=9):
+    return predict_batch([input_paths], predict_all, n_predict, obs_length)[0]
+
+
+class ConstantVelocityPredictor(object):
+    """ Constant velocity predictor of the evaluator, predicting whole dataset files at once """
+
+    ## The evaluator passes all the scenes of a dataset file to predict_batch
+    whole_file = True
+
+    def __call__(self, paths, n_predict=12, obs_length=9):
+        return predict(paths, n_predict=n_predict, obs_length=obs_length)
 
-    return multimodal_outputs
\ No newline at end of file
+    def predict_batch(self, scenes, scene_goals=None, n_predict=12, obs_length=9, modes=1, args=None):
+        return predict_batch(scenes, n_predict=n_predict, obs_length=obs_length)
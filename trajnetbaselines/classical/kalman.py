@@ -1,74 +1,177 @@
+""" Constant velocity Kalman filter, vectorized over tracks
+
+The state of a track is (x, v_x, y, v_y). As in pykalman.KalmanFilter.em
+(default em_vars), the transition covariance, the observation covariance and
+the initial state distribution of every track are fitted with EM. The tracks
+with the same number of observations are filtered, smoothed and fitted
+together as stacked [n_tracks, ...] matrices.
+"""
+
 import numpy as np
-import pykalman
-import trajnetplusplustools
 
+TRANSITION_MATRIX = np.array([[1, 1, 0, 0],
+                              [0, 1, 0, 0],
+                              [0, 0, 1, 1],
+                              [0, 0, 0, 1]], dtype=float)
 
-def predict(paths, predict_all=True, n_predict=12, obs_length=9):
-    multimodal_outputs = {}
-    neighbours_tracks = []
-
-    primary = paths[0]
-    start_frame = primary[obs_length-1].frame
-    frame_diff = primary[1].frame - primary[0].frame
-    first_frame = start_frame + frame_diff
-
-    ## Primary Prediction
-    if not predict_all:
-        paths = paths[0:1]
-
-    for i, path in enumerate(paths):
-        path = paths[i]
-        ped_id = path[0].pedestrian
-        past_path = [t for t in path if t.frame <= start_frame]
-        past_frames = [t.frame for t in path if t.frame <= start_frame]
-
-        ## To consider agent or not consider.
-        if start_frame not in past_frames:
-            continue
-        if len(past_path) < 2:
-            continue
-
-        initial_state_mean = [path[0].x, 0, path[0].y, 0]
-        transition_matrix = [[1, 1, 0, 0],
-                             [0, 1, 0, 0],
-                             [0, 0, 1, 1],
-                             [0, 0, 0, 1]]
-
-        observation_matrix = [[1, 0, 0, 0],
-                              [0, 0, 1, 0]]
-
-        kf = pykalman.KalmanFilter(transition_matrices=transition_matrix,
-                                   observation_matrices=observation_matrix,
-                                   transition_covariance=1e-5 * np.eye(4),
-                                   observation_covariance=0.05**2 * np.eye(2),
-                                   initial_state_mean=initial_state_mean)
-        # kf.em([(r.x, r.y) for r in path[:9]], em_vars=['transition_matrices',
-        #                                                'observation_matrices'])
-        kf.em([(r.x, r.y) for r in past_path])
-        observed_states, _ = kf.smooth([(r.x, r.y) for r in past_path])
-
-
-        # sample predictions (first sample corresponds to last state)
-        # average 5 sampled predictions
-        predictions = None
-        for _ in range(5):
-            _, pred = kf.sample(n_predict + 1, initial_state=observed_states[-1])
-            if predictions is None:
-                predictions = pred
-            else:
-                predictions += pred
-        predictions /= 5.0
-
-        #write
-        if i == 0:
-            primary_track = predictions[1:]
+OBSERVATION_MATRIX = np.array([[1, 0, 0, 0],
+                               [0, 0, 1, 0]], dtype=float)
+
+
+def transpose(matrices):
+    return np.swapaxes(matrices, -1, -2)
+
+
+def outer(a, b):
+    return a[..., :, np.newaxis] * b[..., np.newaxis, :]
+
+
+def kalman_filter(observations, transition_covariance, observation_covariance,
+                  initial_state_mean, initial_state_covariance):
+    """ Filter the observations [n_tracks, n_timesteps, 2] of the tracks
+
+    Returns
+    -------
+    predicted_means, predicted_covariances, filtered_means, filtered_covariances :
+        [n_tracks, n_timesteps, 4] and [n_tracks, n_timesteps, 4, 4] arrays
+    """
+    A, H = TRANSITION_MATRIX, OBSERVATION_MATRIX
+    predicted_means, predicted_covariances = [], []
+    filtered_means, filtered_covariances = [], []
+    for t in range(observations.shape[1]):
+        if t == 0:
+            mean, covariance = initial_state_mean, initial_state_covariance
         else:
-            neighbours_tracks.append(np.array(predictions[1:]))
+            mean = filtered_means[-1] @ A.T
+            covariance = A @ filtered_covariances[-1] @ A.T + transition_covariance
+        predicted_means.append(mean)
+        predicted_covariances.append(covariance)
+
+        ## Correct with the observation
+        innovation_covariance = H @ covariance @ H.T + observation_covariance
+        kalman_gain = covariance @ H.T @ np.linalg.pinv(innovation_covariance)
+        innovation = observations[:, t] - mean @ H.T
+        filtered_means.append(mean + np.einsum('bij,bj->bi', kalman_gain, innovation))
+        filtered_covariances.append(covariance - kalman_gain @ H @ covariance)
+
+    return (np.stack(predicted_means, axis=1), np.stack(predicted_covariances, axis=1),
+            np.stack(filtered_means, axis=1), np.stack(filtered_covariances, axis=1))
+
+
+def kalman_smoother(predicted_means, predicted_covariances, filtered_means, filtered_covariances):
+    """ Rauch-Tung-Striebel smoother of the output of kalman_filter
+
+    Returns
+    -------
+    smoothed_means : [n_tracks, n_timesteps, 4]
+    smoothed_covariances : [n_tracks, n_timesteps, 4, 4]
+    pairwise_covariances : [n_tracks, n_timesteps, 4, 4]
+        Covariances between the states at times t and t - 1 (zero at t = 0)
+    """
+    A = TRANSITION_MATRIX
+    n_timesteps = filtered_means.shape[1]
+    smoothed_means = [filtered_means[:, -1]]
+    smoothed_covariances = [filtered_covariances[:, -1]]
+    pairwise_covariances = []
+    for t in reversed(range(n_timesteps - 1)):
+        gain = filtered_covariances[:, t] @ A.T @ np.linalg.pinv(predicted_covariances[:, t + 1])
+        pairwise_covariances.append(smoothed_covariances[-1] @ transpose(gain))
+        smoothed_means.append(filtered_means[:, t] + np.einsum(
+            'bij,bj->bi', gain, smoothed_means[-1] - predicted_means[:, t + 1]))
+        smoothed_covariances.append(filtered_covariances[:, t] + gain @ (
+            smoothed_covariances[-1] - predicted_covariances[:, t + 1]) @ transpose(gain))
+    pairwise_covariances.append(np.zeros_like(filtered_covariances[:, 0]))
+
+    return (np.stack(smoothed_means[::-1], axis=1), np.stack(smoothed_covariances[::-1], axis=1),
+            np.stack(pairwise_covariances[::-1], axis=1))
+
+
+def smooth_tracks(observations, n_iter=10):
+    """ Smoothed states [n_tracks, n_timesteps, 4] of tracks with observations [n_tracks, n_timesteps, 2]
+
+    The parameters of every track are first fitted with n_iter EM iterations.
+    """
+    A, H = TRANSITION_MATRIX, OBSERVATION_MATRIX
+    n_tracks, n_timesteps, _ = observations.shape
+    transition_covariance = np.tile(1e-5 * np.eye(4), (n_tracks, 1, 1))
+    observation_covariance = np.tile(0.05**2 * np.eye(2), (n_tracks, 1, 1))
+    initial_state_mean = np.zeros((n_tracks, 4))
+    initial_state_mean[:, 0::2] = observations[:, 0]
+    initial_state_covariance = np.tile(np.eye(4), (n_tracks, 1, 1))
+
+    def smooth():
+        filtered = kalman_filter(observations, transition_covariance, observation_covariance,
+                                 initial_state_mean, initial_state_covariance)
+        return kalman_smoother(*filtered)
+
+    for _ in range(n_iter):
+        means, covariances, pairwise_covariances = smooth()
+
+        ## Maximization step
+        error = observations - means @ H.T
+        observation_covariance = np.mean(outer(error, error) + H @ covariances @ H.T, axis=1)
+
+        error = means[:, 1:] - means[:, :-1] @ A.T
+        pairwise = pairwise_covariances[:, 1:] @ A.T
+        transition_covariance = np.mean(outer(error, error) + A @ covariances[:, :-1] @ A.T
+                                        + covariances[:, 1:] - pairwise - transpose(pairwise), axis=1)
+
+        initial_state_mean = means[:, 0]
+        initial_state_covariance = covariances[:, 0]
+
+    return smooth()[0]
+
+
+def predict_tracks(observations, n_predict=12):
+    """ Predicted positions [n_tracks, n_predict, 2] of tracks with observations [n_tracks, n_timesteps, 2]
+
+    The last smoothed state is propagated with the constant velocity model.
+    """
+    state = smooth_tracks(observations)[:, -1]
+    steps = np.arange(1, n_predict + 1)[:, np.newaxis]
+    positions = state[:, np.newaxis, 0::2] + steps * state[:, np.newaxis, 1::2]
+    return positions
+
+
+def predict_batch(scenes, predict_all=True, n_predict=12, obs_length=9):
+    """ Kalman filter predictions of the primary pedestrians of several scenes
+
+    The primary tracks with the same number of observations are predicted
+    together.
+
+    Returns
+    -------
+    List of dictionaries of predictions, one per scene
+    """
+    observations = []
+    for paths in scenes:
+        primary = paths[0]
+        start_frame = primary[obs_length-1].frame
+        observations.append(np.array([(r.x, r.y) for r in primary if r.frame <= start_frame]))
+
+    primary_tracks = [None] * len(scenes)
+    for length in set(len(obs) for obs in observations):
+        index = [i for i, obs in enumerate(observations) if len(obs) == length]
+        predictions = predict_tracks(np.stack([observations[i] for i in index]), n_predict)
+        for i, prediction in zip(index, predictions):
+            primary_tracks[i] = prediction
+
+    ## Unimodal Ouput (the neighbours are not predicted)
+    return [{0: (primary_track, [])} for primary_track in primary_tracks]
+
+
+def predict(paths, predict_all=True, n_predict=12, obs_length=9):
+    return predict_batch([paths], predict_all, n_predict, obs_length)[0]
+
+
+class KalmanPredictor(object):
+    """ Kalman filter predictor of the evaluator, predicting whole dataset files at once """
+
+    ## The evaluator passes all the scenes of a dataset file to predict_batch
+    whole_file = True
 
-    ## Unimodal Ouput
-    neighbours_tracks = []
-    if len(np.array(neighbours_tracks)):
-        neighbours_tracks = np.array(neighbours_tracks).transpose(1, 0, 2)
+    def __call__(self, paths, n_predict=12, obs_length=9):
+        return predict(paths, n_predict=n_predict, obs_length=obs_length)
 
-    multimodal_outputs[0] = primary_track, neighbours_tracks
-    return multimodal_outputs
+    def predict_batch(self, scenes, scene_goals=None, n_predict=12, obs_length=9, modes=1, args=None):
+        return predict_batch(scenes, n_predict=n_predict, obs_length=obs_length)
@@ -7,105 +7,182 @@ import socialforce
 from socialforce.potentials import PedPedPotential
 from socialforce.fieldofview import FieldOfView
 
+FPS = 20
+SAMPLING_RATE = int(FPS / 2.5)
+
+## Bound on n_scenes * n_ped**2 of one padded batch of the simulator
+MAX_PAIRS = 1 << 19
+## Bound on the ratio of the largest to the smallest scene of one padded batch
+MAX_PADDING = 1.25
+
+
+def vel_state(prev, curr, stride):
+    if stride == 0:
+        return [0, 0]
+    diff = np.array([curr.x - prev.x, curr.y - prev.y])
+    theta = np.arctan2(diff[1], diff[0])
+    speed = np.linalg.norm(diff) / (stride * 0.4)
+    return [speed*np.cos(theta), speed*np.sin(theta)]
+
+
+def dest_state(path, length, pred_length):
+    if length == 1:
+        return [path[-1].x, path[-1].y]
+    x = [t.x for t in path]
+    y = [t.y for t in path]
+    time = list(range(length))
+    f = interp1d(x=time, y=[x, y], fill_value='extrapolate')
+    return f(time[-1] + pred_length)
+
+
+def init_states(input_paths, start_frame, dest_dict, dest_type, pred_length):
+    initial_state = []
+    for i, _ in enumerate(input_paths):
+        path = input_paths[i]
+        ped_id = path[0].pedestrian
+        past_path = [t for t in path if t.frame <= start_frame]
+        past_frames = [t.frame for t in path if t.frame <= start_frame]
+        future_path = [t for t in path if t.frame > start_frame]
+        len_path = len(past_path)
+
+        ## To consider agent or not consider.
+        if start_frame in past_frames:
+            curr = past_path[-1]
+
+            ## Velocity
+            if len_path >= 4:
+                stride = 3
+                prev = past_path[-4]
+            else:
+                stride = len_path - 1
+                prev = past_path[-len_path]
+            [v_x, v_y] = vel_state(prev, curr, stride)
+
+            ## Destination
+            if dest_type == 'true':
+                if dest_dict is not None:
+                    [d_x, d_y] = dest_dict[ped_id]
+                else:
+                    raise ValueError
+            elif dest_type == 'interp':
+                [d_x, d_y] = dest_state(past_path, len_path, pred_length)
+            elif dest_type == 'vel':
+                [d_x, d_y] = [pred_length*v_x, pred_length*v_y]
+            elif dest_type == 'pred_end':
+                [d_x, d_y] = [future_path[-1].x, future_path[-1].y]
+            else:
+                raise NotImplementedError
+
+            ## Initialize State
+            initial_state.append([curr.x, curr.y, v_x, v_y, d_x, d_y])
+    return np.array(initial_state)
+
+
+def simulate(initial_states, sf_params, pred_length):
+    """ Simulate independent scenes together with one padded BatchSimulator
+
+    Returns
+    -------
+    positions : numpy array [pred_length, n_scenes, max_ped, 2]
+    """
+    max_ped = max(len(state) for state in initial_states)
+    padded = np.zeros((len(initial_states), max_ped, 6))
+    mask = np.zeros((len(initial_states), max_ped), dtype=bool)
+    for i, state in enumerate(initial_states):
+        padded[i, :len(state)] = state
+        mask[i, :len(state)] = True
+
+    ped_ped = PedPedPotential(1./FPS, v0=sf_params[1], sigma=sf_params[2])
+    field_of_view = FieldOfView()
+    s = socialforce.BatchSimulator(padded, mask, ped_ped=ped_ped, field_of_view=field_of_view,
+                                   delta_t=1./FPS, tau=sf_params[0])
+    positions = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for num in range(pred_length*SAMPLING_RATE):
+            s.step()
+            if num % SAMPLING_RATE == 0:
+                positions.append(s.state[..., 0:2].copy())
+    return np.stack(positions)
+
+
+def predict_batch(scenes, dest_dicts=None, dest_type='interp', sf_params=[0.5, 2.1, 0.3],
+                  predict_all=True, n_predict=12, obs_length=9):
+    """ Social force predictions of several scenes
+
+    The scenes are sorted by number of pedestrians and simulated together in
+    padded batches of at most MAX_PAIRS pedestrian pairs, each batch holding
+    scenes of similar sizes (see MAX_PADDING).
+
+    Returns
+    -------
+    List of dictionaries of predictions (see predict), one per scene
+    """
+    pred_length = n_predict
+
+    initial_states = []
+    for i, input_paths in enumerate(scenes):
+        start_frame = input_paths[0][obs_length-1].frame
+        dest_dict = dest_dicts[i] if dest_dicts is not None else None
+        initial_states.append(init_states(input_paths, start_frame, dest_dict, dest_type, pred_length))
+
+    ## Group the scenes of similar sizes
+    order = sorted((i for i, state in enumerate(initial_states) if len(state) != 0),
+                   key=lambda i: len(initial_states[i]))
+    groups = []
+    for i in order:
+        n_ped = len(initial_states[i])
+        if groups and (len(groups[-1]) + 1) * n_ped ** 2 <= MAX_PAIRS \
+                and n_ped <= MAX_PADDING * len(initial_states[groups[-1][0]]):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+
+    states = {}
+    for group in groups:
+        positions = simulate([initial_states[i] for i in group], sf_params, pred_length)
+        for j, i in enumerate(group):
+            ## states : pred_length x num_ped x 2
+            states[i] = positions[:, j, :len(initial_states[i])]
+
+    outputs = []
+    for i, input_paths in enumerate(scenes):
+        if i not in states:
+            ## Stationary
+            start_frame = input_paths[0][obs_length-1].frame
+            past_path = [t for t in input_paths[0] if t.frame == start_frame]
+            states[i] = np.stack([[[past_path[0].x, past_path[0].y]] for _ in range(pred_length)])
+
+        # predictions
+        primary_track = states[i][:, 0, 0:2]
+        neighbours_tracks = states[i][:, 1:, 0:2]
+
+        ## Primary Prediction Only
+        if not predict_all:
+            neighbours_tracks = []
+
+        # Unimodal Prediction
+        outputs.append({0: (primary_track, neighbours_tracks)})
+    return outputs
+
+
 def predict(input_paths, dest_dict=None, dest_type='interp', sf_params=[0.5, 2.1, 0.3],
             predict_all=True, n_predict=12, obs_length=9):
-    
-    pred_length = n_predict
+    dest_dicts = [dest_dict] if dest_dict is not None else None
+    return predict_batch([input_paths], dest_dicts, dest_type, sf_params,
+                         predict_all, n_predict, obs_length)[0]
 
-    def init_states(input_paths, start_frame, dest_dict, dest_type):
-        initial_state = []
-        for i, _ in enumerate(input_paths):
-            path = input_paths[i]
-            ped_id = path[0].pedestrian
-            past_path = [t for t in path if t.frame <= start_frame]
-            past_frames = [t.frame for t in path if t.frame <= start_frame]
-            future_path = [t for t in path if t.frame > start_frame]
-            len_path = len(past_path)
-
-            ## To consider agent or not consider.
-            if start_frame in past_frames:
-                curr = past_path[-1]
-
-                ## Velocity
-                if len_path >= 4:
-                    stride = 3
-                    prev = past_path[-4]
-                else:
-                    stride = len_path - 1
-                    prev = past_path[-len_path]
-                [v_x, v_y] = vel_state(prev, curr, stride)
-
-                ## Destination
-                if dest_type == 'true':
-                    if dest_dict is not None:
-                        [d_x, d_y] = dest_dict[ped_id]
-                    else:
-                        raise ValueError
-                elif dest_type == 'interp':
-                    [d_x, d_y] = dest_state(past_path, len_path)
-                elif dest_type == 'vel':
-                    [d_x, d_y] = [pred_length*v_x, pred_length*v_y]
-                elif dest_type == 'pred_end':
-                    [d_x, d_y] = [future_path[-1].x, future_path[-1].y]
-                else:
-                    raise NotImplementedError
-
-                ## Initialize State
-                initial_state.append([curr.x, curr.y, v_x, v_y, d_x, d_y])
-        return np.array(initial_state)
-
-    def vel_state(prev, curr, stride):
-        if stride == 0:
-            return [0, 0]
-        diff = np.array([curr.x - prev.x, curr.y - prev.y])
-        theta = np.arctan2(diff[1], diff[0])
-        speed = np.linalg.norm(diff) / (stride * 0.4)
-        return [speed*np.cos(theta), speed*np.sin(theta)]
-
-    def dest_state(path, length):
-        if length == 1:
-            return [path[-1].x, path[-1].y]
-        x = [t.x for t in path]
-        y = [t.y for t in path]
-        time = list(range(length))
-        f = interp1d(x=time, y=[x, y], fill_value='extrapolate')
-        return f(time[-1] + pred_length)
-
-    multimodal_outputs = {}
-    primary = input_paths[0]
-    neighbours_tracks = []
-    frame_diff = primary[1].frame - primary[0].frame
-    start_frame = primary[obs_length-1].frame
-    first_frame = primary[obs_length-1].frame + frame_diff
-
-    # initialize
-    initial_state = init_states(input_paths, start_frame, dest_dict, dest_type)
-
-    fps = 20
-    sampling_rate = int(fps / 2.5)
-
-    if len(initial_state) != 0:
-        # run  
-        ped_ped = PedPedPotential(1./fps, v0=sf_params[1], sigma=sf_params[2])
-        field_of_view = FieldOfView()
-        s = socialforce.Simulator(initial_state, ped_ped=ped_ped, field_of_view=field_of_view,
-                                  delta_t=1./fps, tau=sf_params[0])
-        states = np.stack([s.step().state.copy() for _ in range(pred_length*sampling_rate)])
-        ## states : pred_length x num_ped x 7
-        states = np.array([s for num, s in enumerate(states) if num % sampling_rate == 0])
-    else:
-        ## Stationary
-        past_path = [t for t in input_paths[0] if t.frame == start_frame]
-        states = np.stack([[[past_path[0].x, past_path[0].y]] for _ in range(pred_length)])
-
-    # predictions
-    primary_track = states[:, 0, 0:2]
-    neighbours_tracks = states[:, 1:, 0:2]
-
-    ## Primary Prediction Only
-    if not predict_all:
-        neighbours_tracks = []
-
-    # Unimodal Prediction
-    multimodal_outputs[0] = primary_track, neighbours_tracks
-    return multimodal_outputs
+
+class SocialForcePredictor(object):
+    """ Social force predictor of the evaluator, simulating whole dataset files at once """
+
+    ## The evaluator passes all the scenes of a dataset file to predict_batch
+    whole_file = True
+
+    def __init__(self, sf_params=[0.5, 2.1, 0.3]):
+        self.sf_params = sf_params
+
+    def __call__(self, paths, n_predict=12, obs_length=9, sf_params=None):
+        return predict(paths, sf_params=sf_params or self.sf_params, n_predict=n_predict, obs_length=obs_length)
+
+    def predict_batch(self, scenes, scene_goals=None, n_predict=12, obs_length=9, modes=1, args=None):
+        return predict_batch(scenes, sf_params=self.sf_params, n_predict=n_predict, obs_length=obs_length)
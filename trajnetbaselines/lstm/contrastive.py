@@ -1,5 +1,4 @@
 import math
-import numpy as np
 import torch
 import torch.nn as nn
 
@@ -184,7 +183,7 @@ class SocialNCE():
         #                       NCE Loss
         # -----------------------------------------------------
         # labels: 8 (= number of primary pedestrians)
-        labels = torch.zeros(logits.size(0), dtype=torch.long)
+        labels = torch.zeros(logits.size(0), dtype=torch.long, device=logits.device)
         loss = self.criterion(logits, labels) # computing the "CrossEntropyLoss" loss with a labels being a tensor of zero values is a hack to implement the loss used in the paper (equation 1, p.3)
         #print(f"the contrast loss is {loss}")
         return loss
@@ -236,7 +235,7 @@ class SocialNCE():
         # -----------------------------------------------------
         #                       NCE Loss
         # -----------------------------------------------------
-        labels = torch.zeros(logits.size(0), dtype=torch.long)
+        labels = torch.zeros(logits.size(0), dtype=torch.long, device=logits.device)
         loss = self.criterion(logits, labels)
         #print(f"the contrast loss is {loss}")
         return loss
@@ -249,41 +248,15 @@ class SocialNCE():
         #positive sample
         c_e = self.noise_local
         # Retrieving the location of the pedestrians of interest only
-        personOfInterestLocation = gt_future[:, batch_split[0:-1], :] # (persons of interest x coordinates) --> for instance: 8 x 2
-        noise_pos = np.random.multivariate_normal([0, 0], np.array([[c_e, 0], [0, c_e]]), (self.pred_length, 8))  # (2,)
-        #                      8 x 2                   1 x 2
-        # sample_pos = personOfInterestLocation + noise.reshape(1, 2)
-        #                      8 x 2             (2,)
-        sample_pos = personOfInterestLocation + noise_pos
-
-
+        # (time x persons of interest x coordinates) --> for instance: 12 x 8 x 2
+        personOfInterestLocation = gt_future[:, batch_split[0:-1], :]
+        # noise ~ N(0, c_e * I)
+        sample_pos = personOfInterestLocation + math.sqrt(c_e) * torch.randn_like(personOfInterestLocation)
 
         #_______negative sample____________
-        nDirection = self.agent_zone.shape[0]
-        nMaxNeighbour = 80
-
-        # sample_neg: (#persons of interest, #neigboor for this person of interest * #directions, #coordinates)
-        # --> for instance: 8 x 12*9 x 2 = 8 x 108 x 2
-        sample_neg = np.empty((self.pred_length, batch_split.shape[0] - 1, nDirection * nMaxNeighbour, 2))
-        sample_neg[:] = np.NaN  # populating sample_neg with NaN values
-        for i in range(batch_split.shape[0] - 1):
-
-            traj_neighbour = gt_future[:, batch_split[i] + 1:batch_split[i + 1]]  # (number of neigbours x coordinates) --> for instance: 3 x 2
-
-            noise_neg = np.random.multivariate_normal([0, 0], np.array([[c_e, 0], [0, c_e]]), (self.pred_length, traj_neighbour.shape[1], self.agent_zone.shape[0])) # (2,)
-            # negSampleNonSqueezed: (time x number of neighbours x directions x coordinates)
-            #                            12x 3 x 1 x 2                     12x 3 x 9 x 2                (12,3,9,2)
-            negSampleNonSqueezed = traj_neighbour[:,:, None, :] + self.agent_zone[None, None, :, :] + noise_neg
-
-            # negSampleSqueezed: (time x number of neighbours * directions x coordinates)
-            negSampleSqueezed = negSampleNonSqueezed.reshape((self.pred_length,-1, negSampleNonSqueezed.shape[-1]))
-
-            # Filling only the first part in the second dimension of sample_neg (leaving the rest as NaN values)
-            sample_neg[:, i, 0:negSampleSqueezed.shape[1], :] = negSampleSqueezed
-
-        sample_pos = sample_pos.float()
-        sample_neg = torch.tensor(sample_neg).float()
-        return sample_pos, sample_neg
+        # sample_neg: (time x persons of interest x max #neighbours * #directions x coordinates)
+        sample_neg = sample_negatives(gt_future, batch_split, self.agent_zone, math.sqrt(c_e))
+        return sample_pos.float(), sample_neg.float()
 
 
     def _sampling_spatial(self, batch_scene, batch_split):
@@ -291,9 +264,6 @@ class SocialNCE():
         # batch_split : 9 (ID of the persons we want to select (except the last element which marks the end of the batch))
         # batch_scene : (time x persons x coordinates) --> for instance: 21 x 39 x 2
 
-        # gt_future : (time x person x coord)
-        # gt_future = batch_scene[self.obs_length: self.obs_length+self.pred_length]
-
         # Selecting only the first pred sample (i.e. the prediction for the first timestamp)
         # (persons x coordinates) --> gt_future is for instance of size 39 x 2
         gt_future = batch_scene[self.obs_length]
@@ -301,77 +271,72 @@ class SocialNCE():
         # and since Python uses zero-based indexing, the first location prediction
         # sample (i.e. the 10th element in batch_scene) is accessed as
         # "batch_scene[9]" (i.e. "batch_scene[self.obs_length]")
+        return spatial_samples(gt_future, batch_split, self.agent_zone, self.noise_local, self.min_seperation)
 
-        # #####################################################
-        #           TODO: fill the following code
-        # #####################################################
-
-        # -----------------------------------------------------
-        #                  Positive Samples
-        # -----------------------------------------------------
-        # cf. equ. 7 in paper "Social NCE: Contrastive Learning of Socially-aware
-        # Motion Representations" (https://arxiv.org/abs/2012.11717):
-
-        # positive sample ≡ ground truth + N(0, c_e * I )
-        # positive sample: (persons of interest x coordinates)
-
-        c_e = self.noise_local
-        # Retrieving the location of the pedestrians of interest only
-        personOfInterestLocation = gt_future[batch_split[0:-1], :]  # (persons of interest x coordinates) --> for instance: 8 x 2
-        noise_pos = np.random.multivariate_normal([0, 0], np.array([[c_e, 0], [0, c_e]]), (personOfInterestLocation.shape[0]))  # (2,)
-        #                      8 x 2                   1 x 2
-        # sample_pos = personOfInterestLocation + noise.reshape(1, 2)
-        #                      8 x 2             (2,)
-        sample_pos = personOfInterestLocation + noise_pos
-
-        # Retrieving the location of all pedestrians
-        # sample_pos = gt_future[:, :, :] + np.random.multivariate_normal([0,0], np.array([[c_e, 0], [0, c_e]]))
 
-        # -----------------------------------------------------
-        #                  Negative Samples
-        # -----------------------------------------------------
-        # cf. fig 4b and eq. 6 in paper "Social NCE: Contrastive Learning of
-        # Socially-aware Motion Representations" (https://arxiv.org/abs/2012.11717):
-
-        nDirection = self.agent_zone.shape[0]
-        nMaxNeighbour = 80 # with 50 it was not enough and had to increase it
-
-        # sample_neg: (#persons of interest, #neigboor for this person of interest * #directions, #coordinates)
-        # --> for instance: 8 x 12*9 x 2 = 8 x 108 x 2
-        sample_neg = np.empty((batch_split.shape[0] - 1, nDirection * nMaxNeighbour, 2))
-        sample_neg[:] = np.NaN  # populating the whole sample_neg with NaN values everywhere
-        for i in range(batch_split.shape[0] - 1):
-            # traj_primary = gt_future[batch_split[i]]
-            traj_neighbour = gt_future[batch_split[i] + 1:batch_split[i + 1]]  # (number of neigbours x coordinates) --> for instance: 3 x 2
-
-            noise_neg = np.random.multivariate_normal([0, 0], np.array([[c_e**2, 0], [0, c_e**2]]), (traj_neighbour.shape[0], self.agent_zone.shape[0])) # (2,)
-            # negSampleNonSqueezed: (number of neighbours x directions x coordinates) --> for instance: 3 x 9 x 2
-            #                            3 x 1 x 2                     1 x 9 x 2                (2,)
-            negSampleNonSqueezed = traj_neighbour[:, None, :] + self.agent_zone[None, :, :] + noise_neg
-
-            # negSampleSqueezed: (number of neighbours * directions x coordinates) --> for instance: 27 x 2
-            negSampleSqueezed = negSampleNonSqueezed.reshape((-1, negSampleNonSqueezed.shape[2]))
-
-            # -----------------------------------------------------
-            #       Remove negatives that are too close to person of interrest
-            # -----------------------------------------------------
-
-            # Getting rid of too close negative samples to the primary pedestrian
-            # (Those negative samples would be too close by default --> no need to analyze the output)
-            dist = np.linalg.norm(negSampleSqueezed - personOfInterestLocation[i, :].reshape(-1, 2))
-            log_array = np.less_equal(dist, self.min_seperation)
-            negSampleSqueezed[log_array] = np.nan
-
-            # Filling only the first part in the second dimension of sample_neg (leaving the rest as NaN values)
-            sample_neg[i, 0:negSampleSqueezed.shape[0], :] = negSampleSqueezed
-
-            # -----------------------------------------------------
-            #       Remove negatives that are too easy (optional)
-            # -----------------------------------------------------
-
-        sample_pos = sample_pos.float()
-        sample_neg = torch.tensor(sample_neg).float()
-        return sample_pos, sample_neg
+def sample_negatives(gt_future, batch_split, agent_zone, noise_std):
+    """
+        Negative samples around the neighbours of every primary pedestrian, for the whole batch at once
+        (cf. fig 4b and eq. 6 in paper "Social NCE: Contrastive Learning of Socially-aware Motion Representations")
+        Input:
+            gt_future: coordinates of all agents of the batch, tensor of shape [..., total num of agents in the batch, 2]
+            batch_split: index of scene split in the batch, tensor of shape [batch_size + 1]
+            agent_zone: displacements around each neighbour, tensor of shape [num_directions, 2]
+            noise_std: standard deviation of the gaussian noise added to every sample
+        Output:
+            sample_neg: tensor of shape [..., batch_size, max num of neighbours * num_directions, 2],
+                        neighbour after neighbour, NaN-padded (and NaN for absent neighbours)
+    """
+    device = gt_future.device
+    num_scenes = batch_split.shape[0] - 1
+    num_directions = agent_zone.shape[0]
+    batch_split = batch_split.to(device)
+
+    ## Scene of every agent, and index of every neighbour within its scene
+    scene_sizes = batch_split[1:] - batch_split[:-1]
+    scene_index = torch.repeat_interleave(torch.arange(num_scenes, device=device), scene_sizes)
+    neighbour_index = torch.arange(gt_future.shape[-2], device=device) - batch_split[scene_index] - 1
+    is_neighbour = neighbour_index >= 0
+    max_neighbours = int(scene_sizes.max()) - 1 if num_scenes else 0
+
+    ## (... x neighbours x directions x coordinates)
+    neighbours = gt_future[..., is_neighbour, :]
+    samples = neighbours[..., None, :] + agent_zone.to(device) \
+        + noise_std * torch.randn(neighbours.shape[:-1] + (num_directions, 2), device=device, dtype=gt_future.dtype)
+
+    ## Scatter into a NaN-padded buffer (... x scenes x max neighbours x directions x coordinates)
+    sample_neg = torch.full(gt_future.shape[:-2] + (num_scenes, max_neighbours, num_directions, 2), float('nan'),
+                            device=device, dtype=gt_future.dtype)
+    sample_neg[..., scene_index[is_neighbour], neighbour_index[is_neighbour], :, :] = samples
+    return sample_neg.reshape(gt_future.shape[:-2] + (num_scenes, max_neighbours * num_directions, 2))
+
+
+def spatial_samples(gt_future, batch_split, agent_zone, noise_local, min_seperation):
+    """
+        Positive and negative samples at one time step of the future, for the whole batch at once
+        Input:
+            gt_future: coordinates of all agents of the batch, tensor of shape [total num of agents in the batch, 2]
+            batch_split: index of scene split in the batch, tensor of shape [batch_size + 1]
+            agent_zone: displacements around each neighbour, tensor of shape [num_directions, 2]
+            noise_local: variance of the positive sample noise (its square for the negative samples)
+            min_seperation: negatives closer than this to the primary pedestrian are discarded (set to NaN)
+        Output:
+            sample_pos: tensor of shape [batch_size, 2]
+            sample_neg: tensor of shape [batch_size, max num of neighbours * num_directions, 2]
+    """
+    # positive sample ≡ ground truth + N(0, c_e * I ) (cf. equ. 7 in paper)
+    # Retrieving the location of the pedestrians of interest only
+    personOfInterestLocation = gt_future[batch_split[0:-1], :]  # (persons of interest x coordinates) --> for instance: 8 x 2
+    sample_pos = personOfInterestLocation + math.sqrt(noise_local) * torch.randn_like(personOfInterestLocation)
+
+    # negative samples around the neighbours, noise ~ N(0, c_e**2 * I)
+    sample_neg = sample_negatives(gt_future, batch_split, agent_zone, noise_local)
+
+    # Getting rid of too close negative samples to the primary pedestrian
+    # (Those negative samples would be too close by default --> no need to analyze the output)
+    dist = torch.norm(sample_neg - personOfInterestLocation[:, None, :], dim=-1)
+    sample_neg[dist <= min_seperation] = float('nan')
+    return sample_pos.float(), sample_neg.float()
 
 
 class EventEncoder(nn.Module):
@@ -1,10 +1,154 @@
+"""Loading of train/val scenes, optionally through a binary scene cache.
+
+Compile the cache of a dataset once with:
+python -m trajnetbaselines.lstm.data_load_utils --path DATA_BLOCK/trajdata --goals
+"""
+
+import argparse
+import json
 import trajnetplusplustools
+import numpy as np
 import os
 import pickle
+import random
+import torch
+
+from .. import augmentation
+from .lstm import drop_distant
+from .utils import center_scene, random_rotation
+
+CACHE_VERSION = 1
+
+
+def cache_dir(path, subset):
+    """ Directory of the scene cache of a subset, e.g. 'DATA_BLOCK/trajdata/train_cache/' """
+    return path + '/' + subset.strip('/') + '_cache/'
+
+
+def _source_files(path, subset):
+    """ Sorted ndjson file names (without extension) of a subset, with their size and mtime """
+    files = sorted(f.split('.')[-2] for f in os.listdir(path + subset) if f.endswith('.ndjson'))
+    stats = {file: [os.path.getsize(path + subset + file + '.ndjson'),
+                    os.path.getmtime(path + subset + file + '.ndjson')] for file in files}
+    return files, stats
+
+
+def compile_scene_cache(path, subset='/train/', goals=True):
+    """ Compiles all scenes of a subset into a binary cache
+
+    The cache directory holds
+    xy.npy : float32 [sum_s T_s * N_s, 2], all scenes concatenated
+    goals.npy : float32 [sum_s N_s, 2], goals of every track (only if goals)
+    index.npz : scene offsets into xy.npy and goals.npy, scene shapes,
+                scene ids and file names
+    meta.json : cache version, goal flag and size/mtime of the source files
+
+    Scene i is xy[offsets[i]:offsets[i+1]].reshape(shapes[i][0], shapes[i][1], 2).
+
+    Parameters
+    ----------
+    subset: String ['/train/', '/val/']
+        Determines the subset of data to be processed
+    goals: Bool
+        If true, the goals of each track are stored as well
+        The corresponding goal file must be present in the 'goal_files' folder
+
+    Returns
+    -------
+    directory: String
+        Directory of the compiled cache
+    """
+    directory = cache_dir(path, subset)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    files, stats = _source_files(path, subset)
+    all_xy, all_goals = [], []
+    offsets, goal_offsets, shapes, scene_ids, file_index = [0], [0], [], [], []
+    for file_i, file in enumerate(files):
+        reader = trajnetplusplustools.Reader(path + subset + file + '.ndjson', scene_type='paths')
+        goal_dict = pickle.load(open('goal_files/' + subset + file + '.pkl', "rb")) if goals else None
+        for s_id, paths in reader.scenes():
+            xy = trajnetplusplustools.Reader.paths_to_xy(paths).astype(np.float32)
+            all_xy.append(xy.reshape(-1, 2))
+            offsets.append(offsets[-1] + xy.shape[0] * xy.shape[1])
+            shapes.append(xy.shape[:2])
+            scene_ids.append(s_id)
+            file_index.append(file_i)
+            if goals:
+                all_goals.append(np.array([goal_dict[path[0].pedestrian] for path in paths], dtype=np.float32))
+                goal_offsets.append(goal_offsets[-1] + len(paths))
+
+    np.save(directory + 'xy.npy', np.concatenate(all_xy) if all_xy else np.zeros((0, 2), dtype=np.float32))
+    if goals:
+        np.save(directory + 'goals.npy', np.concatenate(all_goals) if all_goals else np.zeros((0, 2), dtype=np.float32))
+    np.savez(directory + 'index.npz',
+             offsets=np.array(offsets, dtype=np.int64),
+             goal_offsets=np.array(goal_offsets, dtype=np.int64),
+             shapes=np.array(shapes, dtype=np.int64).reshape(-1, 2),
+             scene_ids=np.array(scene_ids, dtype=np.int64),
+             file_index=np.array(file_index, dtype=np.int64),
+             files=np.array(files, dtype=str))
+    with open(directory + 'meta.json', 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'goals': goals, 'sources': stats}, f)
+    return directory
+
+
+def _cache_valid(path, subset, goals):
+    """ True if the cache exists, contains goals if required and matches the source files """
+    meta_file = cache_dir(path, subset) + 'meta.json'
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    _, stats = _source_files(path, subset)
+    return meta['version'] == CACHE_VERSION and (meta['goals'] or not goals) and meta['sources'] == stats
+
+
+def load_scene_cache(path, subset='/train/', sample=1.0, goals=True):
+    """ Loads the scenes of a subset from its memory-mapped cache
+
+    Scenes are returned as (filename, scene_id, xy) where xy is a read-only
+    float32 view [T, N, 2] into the cache instead of a list of paths.
+    See prepare_data for parameters and return values.
+    """
+    directory = cache_dir(path, subset)
+    xy = np.load(directory + 'xy.npy', mmap_mode='r')
+    goal_xy = np.load(directory + 'goals.npy', mmap_mode='r') if goals else None
+    index = np.load(directory + 'index.npz')
+    offsets, goal_offsets, shapes = index['offsets'], index['goal_offsets'], index['shapes']
+    scene_ids, file_index, files = index['scene_ids'], index['file_index'], index['files']
+
+    ## Sample per file, as done for the ndjson files
+    selected = []
+    for file_i in range(len(files)):
+        scene_indices = np.flatnonzero(file_index == file_i).tolist()
+        if sample is not None and sample < 1.0:
+            scene_indices = random.sample(scene_indices, int(len(scene_indices) * sample))
+        selected += scene_indices
+
+    all_scenes = []
+    all_goals = {str(file): {} for file in files} if goals else None
+    for i in selected:
+        file, s_id = str(files[file_index[i]]), int(scene_ids[i])
+        scene = xy[offsets[i]:offsets[i + 1]].reshape(shapes[i][0], shapes[i][1], 2)
+        all_scenes.append((file, s_id, scene))
+        if goals:
+            all_goals[file][s_id] = goal_xy[goal_offsets[i]:goal_offsets[i + 1]]
+
+    return all_scenes, all_goals
+
+
+def scene_xy(paths):
+    """ [T, N, 2] array of a scene given either as paths or as a cached array """
+    if isinstance(paths, np.ndarray):
+        return paths
+    return trajnetplusplustools.Reader.paths_to_xy(paths)
+
+
+def prepare_data(path, subset='/train/', sample=1.0, goals=True, cache=False):
+    """ Prepares the train/val scenes and corresponding goals
 
-def prepare_data(path, subset='/train/', sample=1.0, goals=True):
-    """ Prepares the train/val scenes and corresponding goals 
-    
     Parameters
     ----------
     subset: String ['/train/', '/val/']
@@ -15,6 +159,9 @@ def prepare_data(path, subset='/train/', sample=1.0, goals=True):
         If true, the goals of each track are extracted
         The corresponding goal file must be present in the 'goal_files' folder
         The name of the goal file must be the same as the name of the training file
+    cache: Bool
+        If true, the scenes are memory-mapped from the binary scene cache
+        (compiled first if missing or outdated) and returned as arrays
 
     Returns
     -------
@@ -36,6 +183,13 @@ def prepare_data(path, subset='/train/', sample=1.0, goals=True):
             print("Validation folder does NOT exist")
             return None, None, False
 
+    if cache:
+        if not _cache_valid(path, subset, goals):
+            print("Compiling scene cache of", path + subset)
+            compile_scene_cache(path, subset, goals)
+        all_scenes, all_goals = load_scene_cache(path, subset, sample, goals)
+        return all_scenes, all_goals, True
+
     ## read goal files
     all_goals = {}
     all_scenes = []
@@ -56,3 +210,215 @@ def prepare_data(path, subset='/train/', sample=1.0, goals=True):
     if goals:
         return all_scenes, all_goals, True
     return all_scenes, None, True
+
+
+class SceneDataset(torch.utils.data.Dataset):
+    """ Scenes of prepare_data, ready to be batched
+
+    Each item is the scene [seq_length, num_tracks, 2] and the goals of its
+    tracks [num_tracks, 2] after dropping distant neighbours, normalizing
+    and augmenting the scene as requested.
+
+    Parameters
+    ----------
+    scenes: List
+        Scenes (filename, scene_id, paths) returned by prepare_data
+    goals: Dictionary
+        Goals returned by prepare_data. None if no goals are used.
+    normalize_scene: Bool
+        If true, the scene is rotated so primary pedestrian moves northwards at end of observation
+    augment: Bool
+        If true, the scene is randomly rotated
+    augment_noise: Bool
+        If true, noise is added to the neighbour observations
+    """
+    def __init__(self, scenes, goals=None, obs_length=9, normalize_scene=False, augment=False, augment_noise=False):
+        self.scenes = scenes
+        self.goals = goals
+        self.obs_length = obs_length
+        self.normalize_scene = normalize_scene
+        self.augment = augment
+        self.augment_noise = augment_noise
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def __getitem__(self, index):
+        filename, scene_id, paths = self.scenes[index]
+
+        ## make new scene
+        scene = scene_xy(paths)
+
+        ## get goals
+        if self.goals is not None:
+            scene_goal = np.array(self.goals[filename][scene_id])
+        else:
+            scene_goal = np.zeros((scene.shape[1], 2))
+
+        ## Drop Distant
+        scene, mask = drop_distant(scene)
+        scene_goal = scene_goal[mask]
+
+        ##process scene
+        if self.normalize_scene:
+            scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
+        if self.augment:
+            scene, scene_goal = random_rotation(scene, goals=scene_goal)
+        if self.augment_noise:
+            scene = augmentation.add_noise(scene, thresh=0.02, ped='neigh')
+
+        return scene, scene_goal
+
+
+def scene_collate(batch):
+    """ Concatenates the scenes of a batch along the track dimension
+
+    Returns
+    -------
+    batch_scene : Tensor [seq_length, num_tracks, 2]
+        Tensor of batch of scenes.
+    batch_scene_goal : Tensor [num_tracks, 2]
+        Tensor of goals of each track in batch
+    batch_split : Tensor [batch_size + 1]
+        Tensor defining the split of the batch.
+        Required to identify the tracks of to the same scene
+    """
+    batch_scene, batch_scene_goal = zip(*batch)
+    batch_split = np.cumsum([0] + [scene.shape[1] for scene in batch_scene])
+    return (torch.Tensor(np.concatenate(batch_scene, axis=1)),
+            torch.Tensor(np.concatenate(batch_scene_goal, axis=0)),
+            torch.Tensor(batch_split).long())
+
+
+def seed_worker(_):
+    """ Different numpy noise in every loader worker (python and torch are seeded by the DataLoader) """
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+def num_agents(scenes):
+    """ Number of tracks of each scene that are kept after dropping distant neighbours """
+    return [int(drop_distant(scene_xy(paths))[1].sum()) for _, _, paths in scenes]
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """ Batches of scenes with a similar number of agents
+
+    The scenes are split into buckets of 'bucket_size' batches. Within a bucket,
+    scenes are sorted by number of agents before being cut into batches,
+    so that a crowded scene is batched with other crowded scenes.
+    The scenes (and the order of the batches) are shuffled every epoch.
+
+    Parameters
+    ----------
+    num_agents: List
+        Number of agents of each scene
+    batch_size: Int
+        Number of scenes per batch
+    max_agents: Int
+        If given, batches are filled up to 'max_agents' agents in total
+        instead of 'batch_size' scenes. Larger scenes form a batch on their own.
+    bucket_size: Int
+        Number of batches per bucket
+    shuffle: Bool
+        If false, all scenes are sorted by number of agents
+    """
+    def __init__(self, num_agents, batch_size=8, max_agents=None, bucket_size=100, shuffle=True):
+        self.num_agents = num_agents
+        self.batch_size = batch_size
+        self.max_agents = max_agents
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        ## Batches of the current (last drawn) epoch
+        self.epoch = None
+
+    def batches(self, indices):
+        """ Cuts the sorted scene indices into batches """
+        if self.max_agents is None:
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        batches = [[]]
+        batch_agents = 0
+        for index in indices:
+            if batches[-1] and batch_agents + self.num_agents[index] > self.max_agents:
+                batches.append([])
+                batch_agents = 0
+            batches[-1].append(index)
+            batch_agents += self.num_agents[index]
+        return batches if batches[-1] else []
+
+    def epoch_batches(self):
+        """ Batches of one epoch """
+        indices = list(range(len(self.num_agents)))
+        if not self.shuffle:
+            return self.batches(sorted(indices, key=lambda index: self.num_agents[index]))
+
+        random.shuffle(indices)
+        if self.max_agents is None:
+            bucket_length = self.bucket_size * self.batch_size
+        else:
+            bucket_length = max(1, self.bucket_size * self.max_agents * len(indices) // max(1, sum(self.num_agents)))
+        all_batches = []
+        for i in range(0, len(indices), bucket_length):
+            bucket = sorted(indices[i:i + bucket_length], key=lambda index: self.num_agents[index])
+            all_batches += self.batches(bucket)
+        random.shuffle(all_batches)
+        return all_batches
+
+    def __len__(self):
+        if self.epoch is not None:
+            return len(self.epoch)
+        ## Before the first epoch: exact without 'max_agents' (every bucket but the last
+        ## one holds whole batches), else estimated by the batches of the sorted scenes
+        if self.max_agents is None:
+            return (len(self.num_agents) + self.batch_size - 1) // self.batch_size
+        return len(self.batches(sorted(range(len(self.num_agents)), key=lambda index: self.num_agents[index])))
+
+    def __iter__(self):
+        self.epoch = self.epoch_batches()
+        return iter(self.epoch)
+
+
+def scene_loader(dataset, batch_size=8, shuffle=False, workers=0, prefetch=2, pin_memory=False,
+                 batch_sampler=None):
+    """ DataLoader yielding (batch_scene, batch_scene_goal, batch_split) of a SceneDataset
+
+    Parameters
+    ----------
+    workers: Int
+        Number of worker processes preparing the batches. 0 prepares them in the main process.
+    prefetch: Int
+        Number of batches prepared in advance by each worker
+    pin_memory: Bool
+        If true, batches are placed in pinned memory (faster transfer to GPU)
+    batch_sampler: Sampler
+        If given, defines the scenes of each batch (e.g. BucketBatchSampler)
+        and replaces 'batch_size' and 'shuffle'
+
+    The workers are kept alive (with their copy of the dataset) across epochs.
+    """
+    kwargs = {'prefetch_factor': prefetch, 'persistent_workers': True} if workers > 0 else {}
+    if batch_sampler is not None:
+        kwargs['batch_sampler'] = batch_sampler
+    else:
+        kwargs.update(batch_size=batch_size, shuffle=shuffle)
+    return torch.utils.data.DataLoader(dataset, collate_fn=scene_collate, num_workers=workers,
+                                       pin_memory=pin_memory, worker_init_fn=seed_worker, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='DATA_BLOCK/trajdata',
+                        help='dataset folder containing the train/val subsets')
+    parser.add_argument('--subsets', nargs='*', default=['/train/', '/val/'],
+                        help='subsets to compile')
+    parser.add_argument('--goals', action='store_true',
+                        help='flag to also cache the goals of pedestrians')
+    args = parser.parse_args()
+
+    for subset in args.subsets:
+        if os.path.isdir(args.path + subset):
+            print("Cache written to", compile_scene_cache(args.path, subset, args.goals))
+
+
+if __name__ == '__main__':
+    main()
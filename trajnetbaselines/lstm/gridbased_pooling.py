@@ -12,6 +12,15 @@ def one_cold(i, n):
     x[i] = 0
     return x
 
+_OFF_DIAGONAL = {}
+
+def off_diagonal(n, device=None):
+    """Mask of the off-diagonal entries of a [n, n] matrix (cached per size and device)."""
+    key = (n, str(device))
+    if key not in _OFF_DIAGONAL:
+        _OFF_DIAGONAL[key] = ~torch.eye(n, dtype=torch.bool, device=device)
+    return _OFF_DIAGONAL[key]
+
 class GridBasedPooling(torch.nn.Module):
     def __init__(self, cell_side=2.0, n=4, hidden_dim=128, out_dim=None,
                  type_='occupancy', pool_size=1, blur_size=1, front=False,
@@ -107,7 +116,7 @@ class GridBasedPooling(torch.nn.Module):
         ## Encode grid using pre-trained autoencoder (reduce dimensionality)
         if self.pretrained_model is not None:
             if not isinstance(self.pretrained_model[0], torch.nn.Conv2d):
-                grid = grid.view(num_tracks, -1)
+                grid = grid.reshape(num_tracks, -1)
             mean, std = grid.mean(), grid.std()
             if std == 0:
                 std = 0.03
@@ -115,7 +124,7 @@ class GridBasedPooling(torch.nn.Module):
             grid = self.pretrained_model(grid)
 
         ## Normalize Grid (if necessary)
-        grid = grid.view(num_tracks, -1)
+        grid = grid.reshape(num_tracks, -1)
         ## Normalization schemes
         if self.norm == 1:
             # "Global Norm"
@@ -156,6 +165,61 @@ class GridBasedPooling(torch.nn.Module):
         ## Forward Grid
         return self.forward_grid(grid)
 
+    def forward_batch(self, hidden_state, obs1, obs2, mask):
+        """ Forward function for a padded batch of scenes
+
+        Parameters
+        ----------
+        hidden_state :  Tensor [batch_size, max_agents, hidden_dim]
+            LSTM hidden state of all agents at current time-step t
+        obs1 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at previous time-step t-1
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
+
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size, max_agents, self.out_dim]
+        """
+        batch_size, max_agents = mask.shape
+
+        ## Make chosen grid for all scenes
+        grid = self.occupancy_batch(hidden_state, obs1, obs2, mask)
+
+        ## Forward Grid. Each row is encoded independently, except for
+        ## grid normalizations over the scene
+        if self.pretrained_model is None and self.norm in (0, 3):
+            if self.embedding_arch != 'lstm_layer':
+                return self.forward_grid(grid).view(batch_size, max_agents, -1)
+
+            ## The interaction-encoder LSTM is only updated for the tracks of
+            ## the scenes with more than one present track (see lstm_forward)
+            rows = (mask & (mask.sum(dim=1, keepdim=True) > 1)).view(-1)
+            pooled = torch.zeros(batch_size * max_agents, self.out_dim, device=obs2.device)
+            if rows.any():
+                track_mask = self.track_mask.clone()
+                track_mask[self.track_mask] = rows[mask.view(-1)]
+                self.track_mask = track_mask
+                pooled = pooled.index_put((rows,), self.forward_grid(grid[rows]))
+            return pooled.view(batch_size, max_agents, -1)
+
+        grid = grid.view(batch_size, max_agents, *grid.shape[1:])
+        track_mask = self.track_mask
+        present = torch.nonzero(track_mask, as_tuple=True)[0]
+        pooled = []
+        start = 0
+        for scene, count in enumerate(mask.sum(dim=1).tolist()):
+            ## Only the tracks of the scene are present for the interaction encoder
+            self.track_mask = torch.zeros_like(track_mask)
+            self.track_mask[present[start:start + count]] = True
+            start += count
+            scene_pooled = self.forward_grid(grid[scene, :count]) if count else None
+            padding = torch.zeros(max_agents - count, self.out_dim, device=obs2.device)
+            pooled.append(torch.cat([scene_pooled, padding]) if count else padding)
+        return torch.stack(pooled)
+
     def occupancies(self, obs1, obs2):
         ## Generate the Occupancy Map
         return self.occupancy(obs2, past_obs=obs1)
@@ -176,7 +240,7 @@ class GridBasedPooling(torch.nn.Module):
         relative = unfolded - vel.unsqueeze(1)
         ## Deleting Diagonal (Ped wrt itself)
         ## [num_tracks, num_tracks, 2] --> [num_tracks, num_tracks-1, 2]
-        relative = relative[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, 2)
+        relative = relative[off_diagonal(num_tracks, obs2.device)].reshape(num_tracks, num_tracks-1, 2)
 
         ## Generate Occupancy Map
         return self.occupancy(obs2, relative, past_obs=obs1)
@@ -193,7 +257,7 @@ class GridBasedPooling(torch.nn.Module):
         ## Generate values to input in hiddenstate grid tensor (compressed hidden-states in this case) 
         ## [num_tracks, hidden_dim] --> [num_tracks, num_tracks-1, pooling_dim]
         hidden_state_grid = hidden_state.repeat(num_tracks, 1).view(num_tracks, num_tracks, -1)
-        hidden_state_grid = hidden_state_grid[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, -1)
+        hidden_state_grid = hidden_state_grid[off_diagonal(num_tracks, obs2.device)].reshape(num_tracks, num_tracks-1, -1)
         hidden_state_grid = self.hidden_dim_encoding(hidden_state_grid)
         
         ## Generate Occupancy Map
@@ -215,12 +279,12 @@ class GridBasedPooling(torch.nn.Module):
         relative = unfolded - vel.unsqueeze(1)
         ## Deleting Diagonal (Ped wrt itself)
         ## [num_tracks, num_tracks, 2] --> [num_tracks, num_tracks-1, 2]
-        relative = relative[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, 2)
+        relative = relative[off_diagonal(num_tracks, obs2.device)].reshape(num_tracks, num_tracks-1, 2)
 
         ## Generate values to input in hiddenstate grid tensor (compressed hidden-states in this case) 
         ## [num_tracks, hidden_dim] --> [num_tracks, num_tracks-1, pooling_dim]
         hidden_state_grid = hidden_state.repeat(num_tracks, 1).view(num_tracks, num_tracks, -1)
-        hidden_state_grid = hidden_state_grid[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, -1)
+        hidden_state_grid = hidden_state_grid[off_diagonal(num_tracks, obs2.device)].reshape(num_tracks, num_tracks-1, -1)
         hidden_state_grid = self.hidden_dim_encoding(hidden_state_grid)
 
         dir_social_rep = torch.cat([relative, hidden_state_grid], dim=2)
@@ -231,15 +295,14 @@ class GridBasedPooling(torch.nn.Module):
     @staticmethod
     def normalize(relative, obs, past_obs):
         ## Normalize pooling grid along direction of pedestrian motion
-        diff = torch.cat([obs[:, 1:] - past_obs[:, 1:], obs[:, 0:1] - past_obs[:, 0:1]], dim=1)
-        velocity = np.arctan2(diff[:, 0].clone(), diff[:, 1].clone())
+        diff = obs - past_obs
+        velocity = torch.atan2(diff[:, 1], diff[:, 0])
         theta = (np.pi / 2) - velocity
         ct = torch.cos(theta)
         st = torch.sin(theta)
-        ## Cleaner?
-        relative = torch.stack([torch.einsum('tc,ci->ti', pos_instance, torch.Tensor([[ct[i], st[i]], [-st[i], ct[i]]])) for
-                                i, pos_instance in enumerate(relative)], dim=0)
-        return relative
+        ## Rotation matrices of all pedestrians [num_tracks, 2, 2]
+        rotation = torch.stack([torch.stack([ct, st], dim=1), torch.stack([-st, ct], dim=1)], dim=1)
+        return torch.bmm(relative, rotation)
 
     def occupancy(self, obs, other_values=None, past_obs=None):
         """Returns the occupancy map filled with respective attributes.
@@ -274,7 +337,7 @@ class GridBasedPooling(torch.nn.Module):
         relative = unfolded - obs.unsqueeze(1)
         ## Deleting Diagonal (Ped wrt itself)
         ## [num_tracks, num_tracks, 2] --> [num_tracks, num_tracks-1, 2]
-        relative = relative[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, 2)
+        relative = relative[off_diagonal(num_tracks, obs.device)].reshape(num_tracks, num_tracks-1, 2)
 
         ## In case of 'occupancy' pooling
         if other_values is None:
@@ -296,22 +359,132 @@ class GridBasedPooling(torch.nn.Module):
         other_values[~range_mask] = self.constant
         oij = oij.long()
 
-        ## Flatten
-        oi = oij[:, :, 0] * self.n * self.pool_size + oij[:, :, 1]
+        return self.fill_grid(oij, other_values)
+
+    def occupancy_batch(self, hidden_state, obs1, obs2, mask):
+        """Returns the grids of the chosen pooling type for a padded batch of scenes.
+        Equivalent to building the grid of each scene separately (see occupancy).
+
+        Parameters
+        ----------
+        hidden_state :  Tensor [batch_size, max_agents, hidden_dim]
+            LSTM hidden state of all agents at current time-step t
+        obs1 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at previous time-step t-1
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
+
+        Returns
+        -------
+        grid: Tensor [batch_size * max_agents, self.pooling_dim, self.n, self.n]
+        """
+        batch_size, max_agents = mask.shape
+        num_rows = batch_size * max_agents
+        neigh_mask = mask.unsqueeze(1) & mask.unsqueeze(2) & off_diagonal(max_agents, obs2.device)
+
+        ## Attributes of the neighbours [batch_size, max_agents, max_agents, self.pooling_dim]
+        if self.type_ == 'occupancy':
+            other_values = torch.ones(batch_size, max_agents, max_agents, self.pooling_dim, device=obs2.device)
+        else:
+            other_values = []
+            if self.type_ in ('directional', 'dir_social'):
+                ## Relative velocities
+                vel = obs2 - obs1
+                other_values.append(vel.unsqueeze(1) - vel.unsqueeze(2))
+            if self.type_ in ('social', 'dir_social'):
+                ## Compressed hidden-states
+                hidden_state = self.hidden_dim_encoding(hidden_state)
+                other_values.append(hidden_state.unsqueeze(1).expand(-1, max_agents, -1, -1))
+            other_values = torch.cat(other_values, dim=3)
+
+        ## Get relative position
+        ## [batch_size, max_agents, 2] --> [batch_size, max_agents, max_agents, 2]
+        relative = obs2.unsqueeze(1) - obs2.unsqueeze(2)
+
+        ## Normalize pooling grid along direction of pedestrian motion
+        if self.norm_pool:
+            relative = self.normalize(relative.view(num_rows, max_agents, 2),
+                                      obs2.view(num_rows, 2), obs1.view(num_rows, 2))
+            relative = relative.view(batch_size, max_agents, max_agents, 2)
+
+        if self.front:
+            oij = (relative / (self.cell_side / self.pool_size) + torch.Tensor([self.n * self.pool_size / 2, 0]))
+        else:
+            oij = (relative / (self.cell_side / self.pool_size) + self.n * self.pool_size / 2)
+
+        range_violations = torch.sum((oij < 0) + (oij >= self.n * self.pool_size), dim=3)
+        range_mask = range_violations == 0
+
+        oij[~range_mask] = 0
+        other_values = other_values.masked_fill(~range_mask.unsqueeze(3), self.constant)
+        oij = oij.long()
+
+        ## Agents themselves and padded agents are not filled in
+        occ_summed = self.fill_grid(oij.view(num_rows, max_agents, 2),
+                                    other_values.reshape(num_rows, max_agents, self.pooling_dim),
+                                    neigh_mask.view(num_rows, max_agents))
+
+        ## if only primary pedestrian present
+        only_primary = (mask.sum(dim=1) == 1).repeat_interleave(max_agents)
+        return occ_summed.masked_fill(only_primary.view(-1, 1, 1, 1), self.constant)
+
+    def fill_grid(self, oij, other_values, neigh_mask=None):
+        """Fills the grids of the pedestrians with the attributes of their neighbours.
+
+        Parameters
+        ----------
+        oij: Long Tensor [num_rows, num_neighbours, 2]
+            Cells of the neighbours in the grid of each pedestrian, upsampled by self.pool_size.
+            Out-of-range neighbours are in cell (0, 0) with attributes self.constant.
+        other_values: Tensor [num_rows, num_neighbours, self.pooling_dim]
+            Attributes of the neighbours
+        neigh_mask: Bool Tensor [num_rows, num_neighbours]
+            Mask of the neighbours to fill in [Default: all]
+        Returns
+        -------
+        grid: Tensor [num_rows, self.pooling_dim, self.n, self.n]
+        """
+        num_rows, num_neighbours = oij.shape[:2]
+        side = self.n * self.pool_size
+        rows = torch.arange(num_rows, device=oij.device).unsqueeze(1).expand(-1, num_neighbours)
+        if neigh_mask is not None:
+            rows, oij, other_values = rows[neigh_mask], oij[neigh_mask], other_values[neigh_mask]
+        else:
+            rows, oij, other_values = rows.reshape(-1), oij.reshape(-1, 2), other_values.reshape(-1, self.pooling_dim)
+
+        if self.blur_size == 1:
+            ## Bin directly at the grid resolution. An upsampled cell holds the attributes of the
+            ## last neighbour in it, so the other neighbours of the cell are dropped first
+            ## (they neither contribute to the grid nor receive gradients)
+            upsampled_cells = (rows * side + oij[:, 0]) * side + oij[:, 1]
+            order = torch.sort(upsampled_cells, stable=True)[1]
+            last = torch.ones_like(order, dtype=torch.bool)
+            last[:-1] = upsampled_cells[order[:-1]] != upsampled_cells[order[1:]]
+            kept = order[last]
+
+            occ = torch.full((num_rows * self.n**2, self.pooling_dim), self.constant * self.pool_size**2,
+                             dtype=other_values.dtype, device=oij.device)
+            if self.pool_size == 1:
+                occ = occ.index_put((upsampled_cells[kept],), other_values[kept])
+            else:
+                ## Sum of the pool_size x pool_size upsampled cells
+                cells = (rows[kept] * self.n + oij[kept, 0] // self.pool_size) * self.n + oij[kept, 1] // self.pool_size
+                occ = occ.index_add(0, cells, other_values[kept] - self.constant)
+            occ = torch.transpose(occ.view(num_rows, self.n**2, self.pooling_dim), 1, 2)
+            return occ.reshape(num_rows, self.pooling_dim, self.n, self.n)
 
         # faster occupancy
-        occ = self.constant*torch.ones(num_tracks, self.n**2 * self.pool_size**2, self.pooling_dim, device=obs.device)
+        occ = self.constant*torch.ones(num_rows, side**2, self.pooling_dim, device=oij.device)
 
         ## Fill occupancy map with attributes
-        occ[torch.arange(occ.size(0)).unsqueeze(1), oi] = other_values
+        occ[rows, oij[:, 0] * side + oij[:, 1]] = other_values
         occ = torch.transpose(occ, 1, 2)
-        occ_2d = occ.view(num_tracks, -1, self.n * self.pool_size, self.n * self.pool_size)
+        occ_2d = occ.reshape(num_rows, -1, side, side)
 
-        if self.blur_size == 1:
-            occ_blurred = occ_2d
-        else:
-            occ_blurred = torch.nn.functional.avg_pool2d(
-                occ_2d, self.blur_size, 1, int(self.blur_size / 2), count_include_pad=True)
+        occ_blurred = torch.nn.functional.avg_pool2d(
+            occ_2d, self.blur_size, 1, int(self.blur_size / 2), count_include_pad=True)
 
         occ_summed = torch.nn.functional.lp_pool2d(occ_blurred, 1, self.pool_size)
         # occ_summed = torch.nn.functional.avg_pool2d(occ_blurred, self.pool_size)  # faster?
@@ -359,8 +532,8 @@ class GridBasedPooling(torch.nn.Module):
         self.track_mask = None
         if self.embedding_arch == 'lstm_layer':
             self.hidden_cell_state = (
-                [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-                [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
+                torch.zeros(num_tracks, self.hidden_dim, device=device),
+                torch.zeros(num_tracks, self.hidden_dim, device=device),
             )
 
     def lstm_forward(self, grid):
@@ -373,8 +546,8 @@ class GridBasedPooling(torch.nn.Module):
             return torch.zeros(num_tracks, self.out_dim, device=grid.device)
 
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(self.track_mask, self.hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(self.track_mask, self.hidden_cell_state[1]) if m], dim=0),
+            self.hidden_cell_state[0][self.track_mask],
+            self.hidden_cell_state[1][self.track_mask],
         ]
 
         ## Update interaction-encoder LSTM
@@ -382,32 +555,48 @@ class GridBasedPooling(torch.nn.Module):
         interaction_vector = self.hidden2pool(hidden_cell_stacked[0])
 
         ## Save hidden-cell-states
-        mask_index = [i for i, m in enumerate(self.track_mask) if m]
-        for i, h, c in zip(mask_index,
-                           hidden_cell_stacked[0],
-                           hidden_cell_stacked[1]):
-            self.hidden_cell_state[0][i] = h
-            self.hidden_cell_state[1][i] = c
+        self.hidden_cell_state[0][self.track_mask] = hidden_cell_stacked[0]
+        self.hidden_cell_state[1][self.track_mask] = hidden_cell_stacked[1]
 
         return interaction_vector
 
-    def make_grid(self, obs):
-        """ Make the grids for all time-steps together 
+    def make_grid(self, obs, batch_split=None):
+        """ Make the grids for all time-steps (and all scenes of a batch) together
             Only supports Occupancy and Directional pooling
+
+        Parameters
+        ----------
+        obs: Tensor [timesteps, num_tracks, 2]
+            x-y positions of all tracks
+        batch_split: Tensor [batch_size + 1]
+            Tensor defining the split of the batch [Default: a single scene]
+        Returns
+        -------
+        grid: List of timesteps-1 Tensors [num_present, self.pooling_dim, self.n, self.n]
+            Grids of the tracks present at both time-steps t-1 and t
         """
         if obs.ndim == 2:
             obs = obs.unsqueeze(0)
-        timesteps = obs.size(0)
-
-        grid = []
-        for i in range(1, timesteps):
-            obs1 = obs[i-1]
-            obs2 = obs[i]
-            ## Remove NANs
-            track_mask = (torch.isnan(obs1[:, 0]) + torch.isnan(obs2[:, 0])) == 0
-            obs1, obs2 = obs1[track_mask], obs2[track_mask]
-            if self.type_ == 'occupancy':
-                grid.append(self.occupancies(obs1, obs2))
-            elif self.type_ == 'directional':
-                grid.append(self.directional(obs1, obs2))
-        return grid
+        timesteps, num_tracks = obs.shape[:2]
+        if batch_split is None:
+            batch_split = torch.tensor([0, num_tracks], device=obs.device)
+
+        ## Remove NANs
+        track_mask = ~(torch.isnan(obs[:-1, :, 0]) | torch.isnan(obs[1:, :, 0]))
+        obs = obs.masked_fill(torch.isnan(obs), 0)
+
+        ## Each scene at each time-step is a separate scene of one padded batch
+        ## [timesteps-1, num_tracks, ...] --> [timesteps-1, batch_size, max_agents, ...]
+        scene_sizes = batch_split[1:] - batch_split[:-1]
+        scene_index = torch.repeat_interleave(torch.arange(len(scene_sizes), device=obs.device), scene_sizes)
+        agent_index = torch.arange(num_tracks, device=obs.device) - batch_split[scene_index]
+        max_agents = int(scene_sizes.max())
+
+        def padded(values):
+            padded_values = values.new_zeros((timesteps - 1, len(scene_sizes), max_agents) + values.shape[2:])
+            padded_values[:, scene_index, agent_index] = values
+            return padded_values.view((-1, max_agents) + values.shape[2:])
+
+        grid = self.occupancy_batch(None, padded(obs[:-1]), padded(obs[1:]), padded(track_mask))
+        grid = grid.view(timesteps - 1, len(scene_sizes), max_agents, *grid.shape[1:])[:, scene_index, agent_index]
+        return [grid_t[mask_t] for grid_t, mask_t in zip(grid, track_mask)]
@@ -63,20 +63,22 @@ class PredictionLoss(torch.nn.Module):
         return exponential_loss.sum()
 
     def forward(self, inputs, targets, batch_split):
-        
-        pred_length, batch_size = targets.size(0), batch_split[:-1].size(0)
+        """ Loss of the primary pedestrians
+
+        inputs : Tensor [..., pred_length, num_tracks, 5]
+            The leading dimensions (e.g. the k modes of the variety loss) are kept
+            with keep_batch_dim and share the same targets
+        targets : Tensor [pred_length, num_tracks, 2]
+        """
         ## Extract primary pedestrians
         # [pred_length, num_tracks, 2] --> [pred_length, batch_size, 2]
-        targets = targets.transpose(0, 1)
-        targets = targets[batch_split[:-1]]
-        targets = targets.transpose(0, 1)
-
-        # [pred_length, num_tracks, 5] --> [pred_length, batch_size, 5]
-        inputs = inputs.transpose(0, 1)
-        inputs = inputs[batch_split[:-1]]
-        inputs = inputs.transpose(0, 1)
+        targets = targets[:, batch_split[:-1]]
+        # [..., pred_length, num_tracks, 5] --> [..., pred_length, batch_size, 5]
+        inputs = inputs[..., batch_split[:-1], :]
+        targets = targets.expand(inputs.shape[:-1] + (2,))
 
         ## Loss calculation
+        values_shape = inputs.shape[:-1]
         inputs = inputs.reshape(-1, 5)
         targets = targets.reshape(-1, 2)
         inputs_bg = inputs.clone()
@@ -92,8 +94,8 @@ class PredictionLoss(torch.nn.Module):
 
         ## Used in variety loss (SGAN)
         if self.keep_batch_dim:
-            values = values.reshape(pred_length, batch_size)
-            return values.mean(dim=0) * self.loss_multiplier
+            values = values.reshape(values_shape)
+            return values.mean(dim=-2) * self.loss_multiplier
         
         return torch.mean(values) * self.loss_multiplier
 
@@ -128,21 +130,24 @@ class L2Loss(torch.nn.Module):
         return exponential_loss.sum()
 
     def forward(self, inputs, targets, batch_split):
+        """ Loss of the primary pedestrians
+
+        inputs : Tensor [..., pred_length, num_tracks, 5]
+            The leading dimensions (e.g. the k modes of the variety loss) are kept
+            with keep_batch_dim and share the same targets
+        targets : Tensor [pred_length, num_tracks, 2]
+        """
         ## Extract primary pedestrians
         # [pred_length, num_tracks, 2] --> [pred_length, batch_size, 2]
-        targets = targets.transpose(0, 1)
-        targets = targets[batch_split[:-1]]
-        targets = targets.transpose(0, 1)
-        # [pred_length, num_tracks, 5] --> [pred_length, batch_size, 5]
-        inputs = inputs.transpose(0, 1)
-        inputs = inputs[batch_split[:-1]]
-        inputs = inputs.transpose(0, 1)
+        targets = targets[:, batch_split[:-1]]
+        # [..., pred_length, num_tracks, 5] --> [..., pred_length, batch_size, 5]
+        inputs = inputs[..., batch_split[:-1], :]
 
-        loss = self.loss(inputs[:, :, :2], targets)
+        loss = self.loss(inputs[..., :2], targets.expand(inputs.shape[:-1] + (2,)))
 
         ## Used in variety loss (SGAN)
         if self.keep_batch_dim:
-            return loss.mean(dim=0).mean(dim=1) * self.loss_multiplier
+            return loss.mean(dim=-3).mean(dim=-1) * self.loss_multiplier
         
         return torch.mean(loss) * self.loss_multiplier
 
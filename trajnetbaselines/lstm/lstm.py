@@ -8,7 +8,7 @@ import trajnetplusplustools
 from .modules import Hidden2Normal, InputEmbedding
 
 from .. import augmentation
-from .utils import center_scene
+from .utils import center_scene, pool_scenes
 
 NAN = float('nan')
 
@@ -74,7 +74,7 @@ class LSTM(torch.nn.Module):
         ----------
         lstm: torch nn module [Encoder / Decoder]
             The module responsible for prediction
-        hidden_cell_state : tuple (hidden_state, cell_state)
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [num_tracks, hidden_dim]
             Current hidden_cell_state of the pedestrians
         obs1 : Tensor [num_tracks, 2]
             Previous x-y positions of the pedestrians
@@ -85,7 +85,7 @@ class LSTM(torch.nn.Module):
         
         Returns
         -------
-        hidden_cell_state : tuple (hidden_state, cell_state)
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [num_tracks, hidden_dim]
             Updated hidden_cell_state of the pedestrians
         normals : Tensor [num_tracks, 5]
             Parameters of a multivariate normal of the predicted position 
@@ -98,8 +98,8 @@ class LSTM(torch.nn.Module):
 
         ## Masked Hidden Cell State
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+            hidden_cell_state[0][track_mask],
+            hidden_cell_state[1][track_mask],
         ]
 
         ## Mask current velocity & embed
@@ -119,27 +119,8 @@ class LSTM(torch.nn.Module):
 
         ## Mask & Pool per scene
         if self.pool is not None:
-            hidden_states_to_pool = torch.stack(hidden_cell_state[0]).clone() # detach?
-            batch_pool = []
-            ## Iterate over scenes
-            for (start, end) in zip(batch_split[:-1], batch_split[1:]):
-                ## Mask for the scene
-                scene_track_mask = track_mask[start:end]
-                ## Get observations and hidden-state for the scene
-                prev_position = obs1[start:end][scene_track_mask]
-                curr_position = obs2[start:end][scene_track_mask]
-                curr_hidden_state = hidden_states_to_pool[start:end][scene_track_mask]
-
-                ## Provide track_mask to the interaction encoders
-                ## Everyone absent by default. Only those visible in current scene are present
-                interaction_track_mask = torch.zeros(num_tracks, device=obs1.device).bool()
-                interaction_track_mask[start:end] = track_mask[start:end]
-                self.pool.track_mask = interaction_track_mask
-
-                pool_sample = self.pool(curr_hidden_state, prev_position, curr_position)
-                batch_pool.append(pool_sample)
-
-            pooled = torch.cat(batch_pool)
+            hidden_states_to_pool = hidden_cell_state[0].clone() # detach?
+            pooled = pool_scenes(self.pool, hidden_states_to_pool, obs1, obs2, track_mask, batch_split)
             if self.pool_to_input:
                 input_emb = torch.cat([input_emb, pooled], dim=1)
             else:
@@ -150,15 +131,14 @@ class LSTM(torch.nn.Module):
         normal_masked = self.hidden2normal(hidden_cell_stacked[0])
 
         # unmask [Update hidden-states and next velocities of pedestrians]
+        # out-of-place index_put: absent tracks keep their state (and graph)
+        mask_index = track_mask.nonzero(as_tuple=True)
+        hidden_cell_state = (
+            hidden_cell_state[0].index_put(mask_index, hidden_cell_stacked[0]),
+            hidden_cell_state[1].index_put(mask_index, hidden_cell_stacked[1]),
+        )
         normal = torch.full((track_mask.size(0), 5), NAN, device=obs1.device)
-        mask_index = [i for i, m in enumerate(track_mask) if m]
-        for i, h, c, n in zip(mask_index,
-                              hidden_cell_stacked[0],
-                              hidden_cell_stacked[1],
-                              normal_masked):
-            hidden_cell_state[0][i] = h
-            hidden_cell_state[1][i] = c
-            normal[i] = n
+        normal = normal.index_put(mask_index, normal_masked)
 
         return hidden_cell_state, normal
 
@@ -194,14 +174,14 @@ class LSTM(torch.nn.Module):
             # -1 because one prediction is done by the encoder already
             prediction_truth = [None for _ in range(n_predict - 1)]
 
-        # initialize: Because of tracks with different lengths and the masked
-        # update, the hidden state for every LSTM needs to be a separate object
-        # in the backprop graph. Therefore: list of hidden states instead of
-        # a single higher rank Tensor.
+        # initialize: Tensor [num_tracks, hidden_dim] of hidden and cell states.
+        # Because of tracks with different lengths, every step only updates
+        # the rows of the tracks present (see step) without modifying the
+        # states of the previous step in place.
         num_tracks = observed.size(1)
         hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
         )
 
         ## Reset LSTMs of Interaction Encoders.
@@ -226,7 +206,7 @@ class LSTM(torch.nn.Module):
 
         # ----------- Social NCE -------------
         hidden_state_memory = []
-        hidden_state_memory.append(torch.stack([h for h in hidden_cell_state[0]], dim=0))
+        hidden_state_memory.append(hidden_cell_state[0])
 
         # initialize predictions with last position to form velocity
         prediction_truth = list(itertools.chain.from_iterable(
@@ -252,7 +232,7 @@ class LSTM(torch.nn.Module):
             positions.append(obs2 + normal[:, :2])  # no sampling, just mean
 
             # embedding
-            hidden_state_memory.append(torch.stack([h for h in hidden_cell_state[0]], dim=0))
+            hidden_state_memory.append(hidden_cell_state[0])
 
         # Pred_scene: Tensor [seq_length, num_tracks, 2]
         #    Absolute positions of all pedestrians
@@ -286,30 +266,53 @@ class LSTMPredictor(object):
 
 
     def __call__(self, paths, scene_goal, n_predict=12, modes=1, predict_all=True, obs_length=9, start_length=0, args=None):
+        return self.predict_batch([paths], [scene_goal], n_predict=n_predict, modes=modes, predict_all=predict_all,
+                                  obs_length=obs_length, start_length=start_length, args=args)[0]
+
+    def predict_batch(self, scenes, scene_goals, n_predict=12, modes=1, predict_all=True, obs_length=9, start_length=0, args=None):
+        """Predictions of several scenes in one forward pass per mode
+
+        Parameters
+        ----------
+        scenes : List
+            Paths of each scene
+        scene_goals : List
+            Goals [num_tracks, 2] of each scene
+
+        Returns
+        -------
+        List of dictionaries of predictions (see __call__), one per scene
+        """
         self.model.eval()
         # self.model.train()
         with torch.no_grad():
-            xy = trajnetplusplustools.Reader.paths_to_xy(paths)
-            batch_split = [0, xy.shape[1]]
-
-            if args.normalize_scene:
-                xy, rotation, center, scene_goal = center_scene(xy, obs_length, goals=scene_goal)
-            
-            xy = torch.Tensor(xy)  #.to(self.device)
-            scene_goal = torch.Tensor(scene_goal) #.to(device)
+            batch_xy, batch_goal, transforms = [], [], []
+            for paths, scene_goal in zip(scenes, scene_goals):
+                xy = paths if isinstance(paths, np.ndarray) else trajnetplusplustools.Reader.paths_to_xy(paths)
+                if args.normalize_scene:
+                    xy, rotation, center, scene_goal = center_scene(xy, obs_length, goals=scene_goal)
+                    transforms.append((rotation, center))
+                batch_xy.append(xy[start_length:obs_length])
+                batch_goal.append(scene_goal)
+            batch_split = np.cumsum([0] + [xy.shape[1] for xy in batch_xy])
+
+            xy = torch.Tensor(np.concatenate(batch_xy, axis=1))  #.to(self.device)
+            scene_goal = torch.Tensor(np.concatenate(batch_goal, axis=0)) #.to(device)
             batch_split = torch.Tensor(batch_split).long()
 
-            multimodal_outputs = {}
+            multimodal_outputs = [{} for _ in scenes]
             for num_p in range(modes):
                 # _, output_scenes = self.model(xy[start_length:obs_length], scene_goal, batch_split, xy[obs_length:-1].clone())
-                _, output_scenes, _ = self.model(xy[start_length:obs_length], scene_goal, batch_split, n_predict=n_predict)
+                _, output_scenes, _ = self.model(xy, scene_goal, batch_split, n_predict=n_predict)
                 output_scenes = output_scenes.numpy()
-                if args.normalize_scene:
-                    output_scenes = augmentation.inverse_scene(output_scenes, rotation, center)
-                output_primary = output_scenes[-n_predict:, 0]
-                output_neighs = output_scenes[-n_predict:, 1:]
-                ## Dictionary of predictions. Each key corresponds to one mode
-                multimodal_outputs[num_p] = [output_primary, output_neighs]
-
-        ## Return Dictionary of predictions. Each key corresponds to one mode
+                for i, (start, end) in enumerate(zip(batch_split[:-1], batch_split[1:])):
+                    output_scene = output_scenes[:, start:end]
+                    if args.normalize_scene:
+                        output_scene = augmentation.inverse_scene(output_scene, *transforms[i])
+                    output_primary = output_scene[-n_predict:, 0]
+                    output_neighs = output_scene[-n_predict:, 1:]
+                    ## Dictionary of predictions. Each key corresponds to one mode
+                    multimodal_outputs[i][num_p] = [output_primary, output_neighs]
+
+        ## Return Dictionary of predictions of each scene. Each key corresponds to one mode
         return multimodal_outputs
@@ -2,6 +2,8 @@ from collections import defaultdict
 
 import torch
 
+from .non_gridbased_pooling import neighbour_mask, neighbour_edges
+
 class NMMP(torch.nn.Module):
     """ Interaction vector is obtained by message passing between
         hidden-state of all neighbours. Proposed in NMMP, CVPR 2020
@@ -9,6 +11,8 @@ class NMMP(torch.nn.Module):
         mlp_dim: embedding size of hidden-state
         k: number of iterations of message passing
         out_dim: dimension of resultant interaction vector
+        radius: if given, messages are only passed between agents closer than radius
+        neigh: if given, messages are only passed from the neigh nearest neighbours
         
         Attributes
         ----------
@@ -18,8 +22,12 @@ class NMMP(torch.nn.Module):
             Number of iterations of message passing
         out_dim: Scalar
             Dimension of resultant interaction vector
+        radius : Scalar
+            Neighbourhood radius of the sparse message passing [Default: None]
+        neigh : Scalar
+            Number of nearest neighbours of the sparse message passing [Default: None]
     """
-    def __init__(self, hidden_dim=128, mlp_dim=32, k=5, out_dim=None):
+    def __init__(self, hidden_dim=128, mlp_dim=32, k=5, out_dim=None, radius=None, neigh=None):
         super(NMMP, self).__init__()
         self.out_dim = out_dim or hidden_dim
 
@@ -35,6 +43,18 @@ class NMMP(torch.nn.Module):
         self.out_projection = torch.nn.Linear(mlp_dim, self.out_dim)
         self.k = k
 
+        ## Sparse message passing over the edges of a neighbourhood graph
+        self.radius = radius
+        self.neigh = neigh
+        self.sparse = radius is not None or neigh is not None
+
+    def __setstate__(self, state):
+        super(NMMP, self).__setstate__(state)
+        ## Models saved before the sparse message passing are dense
+        for name in ('radius', 'neigh'):
+            self.__dict__.setdefault(name, None)
+        self.__dict__.setdefault('sparse', False)
+
     def message_pass(self, node_embeddings):
         # Perform a single iteration of message passing
         n = node_embeddings.size(0)
@@ -60,10 +80,86 @@ class NMMP(torch.nn.Module):
         refined_embeddings = self.edge_to_node_embedding(concat_nodes)
         return refined_embeddings
 
+    def message_pass_batch(self, node_embeddings, neigh_mask):
+        """ Single iteration of message passing for a padded batch of scenes
+
+        Parameters
+        ----------
+        node_embeddings :  Tensor [batch_size, max_agents, mlp_dim]
+        neigh_mask :  Bool Tensor [batch_size, max_agents, max_agents]
+            True if both agents are valid and distinct
+
+        Returns
+        -------
+        refined_embeddings : Tensor [batch_size, max_agents, mlp_dim]
+        """
+        ## node_to_edge_embedding([h_a; h_b]) = W_1 h_a + W_2 h_b + bias: embed nodes instead of edges
+        weight_first, weight_second = self.node_to_edge_embedding.weight.chunk(2, dim=1)
+        embed_first = torch.matmul(node_embeddings, weight_first.t())
+        embed_second = torch.matmul(node_embeddings, weight_second.t())
+        bias = self.node_to_edge_embedding.bias
+        num_neighbours = neigh_mask.sum(dim=2, keepdim=True).clamp(min=1).float()
+        edge_mask = neigh_mask.unsqueeze(3).float()
+
+        ## e_out [i, j] = [h_i; h_j]
+        e_out_edges = embed_first.unsqueeze(2) + embed_second.unsqueeze(1) + bias
+        e_out_sumpool = (e_out_edges * edge_mask).sum(dim=2) / num_neighbours
+
+        ## e_in [i, j] = [h_j; h_i]
+        e_in_edges = embed_first.unsqueeze(1) + embed_second.unsqueeze(2) + bias
+        e_in_sumpool = (e_in_edges * edge_mask).sum(dim=2) / num_neighbours
+
+        ## [e_in; e_out]
+        concat_nodes = torch.cat([e_in_sumpool, e_out_sumpool], dim=2)
+
+        ## refined node
+        refined_embeddings = self.edge_to_node_embedding(concat_nodes)
+        return refined_embeddings
+
+    def message_pass_edges(self, node_embeddings, agent, neigh, num_neighbours):
+        """ Single iteration of message passing along the edges of a graph
+
+        Parameters
+        ----------
+        node_embeddings :  Tensor [num_nodes, mlp_dim]
+        agent, neigh :  Tensors [num_edges,]
+            Nodes of each edge (node, neighbour)
+        num_neighbours :  Tensor [num_nodes, 1]
+            Number of edges of each node (clamped to at least 1)
+
+        Returns
+        -------
+        refined_embeddings : Tensor [num_nodes, mlp_dim]
+        """
+        ## node_to_edge_embedding([h_a; h_b]) = W_1 h_a + W_2 h_b + bias: embed nodes instead of edges
+        weight_first, weight_second = self.node_to_edge_embedding.weight.chunk(2, dim=1)
+        embed_first = torch.matmul(node_embeddings, weight_first.t())
+        embed_second = torch.matmul(node_embeddings, weight_second.t())
+        bias = self.node_to_edge_embedding.bias
+        zeros = torch.zeros_like(embed_first)
+
+        ## e_out [i, j] = [h_i; h_j]
+        e_out_edges = embed_first[agent] + embed_second[neigh] + bias
+        e_out_sumpool = zeros.index_add(0, agent, e_out_edges) / num_neighbours
+
+        ## e_in [i, j] = [h_j; h_i]
+        e_in_edges = embed_first[neigh] + embed_second[agent] + bias
+        e_in_sumpool = zeros.index_add(0, agent, e_in_edges) / num_neighbours
+
+        ## [e_in; e_out]
+        concat_nodes = torch.cat([e_in_sumpool, e_out_sumpool], dim=1)
+
+        ## refined node
+        refined_embeddings = self.edge_to_node_embedding(concat_nodes)
+        return refined_embeddings
+
     def reset(self, _, device):
         self.track_mask = None
 
     def forward(self, hidden_states, _, obs2):
+        if self.sparse:
+            mask = torch.ones(1, obs2.size(0), dtype=torch.bool, device=obs2.device)
+            return self.forward_batch(hidden_states.unsqueeze(0), None, obs2.unsqueeze(0), mask)[0]
 
         ## If only primary present
         num_tracks = obs2.size(0)
@@ -77,3 +173,46 @@ class NMMP(torch.nn.Module):
             node_embeddings = self.message_pass(node_embeddings)
 
         return self.out_projection(node_embeddings)
+
+    def forward_batch(self, hidden_states, _, obs2, mask):
+        """ Forward function for a padded batch of scenes
+
+        Parameters
+        ----------
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        hidden_states :  Tensor [batch_size, max_agents, hidden_dim]
+            LSTM hidden state of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
+
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size, max_agents, self.out_dim]
+            interaction vector of all agents in the batch
+        """
+        ## Embed hidden-state
+        node_embeddings = self.hidden_embedding(hidden_states)
+
+        ## Iterative Message Passing
+        if self.sparse:
+            ## The edges are built once and shared by all iterations
+            batch_size, max_agents = mask.shape
+            scene, agent, neigh = neighbour_edges(obs2, mask, self.radius, self.neigh)
+            agent, neigh = scene * max_agents + agent, scene * max_agents + neigh
+            num_neighbours = torch.bincount(agent, minlength=batch_size * max_agents)
+            ## Agents without neighbours get no message, as an agent alone in its scene
+            no_message = (num_neighbours == 0).view(batch_size, max_agents, 1)
+            num_neighbours = num_neighbours.clamp(min=1).unsqueeze(1).to(node_embeddings.dtype)
+            node_embeddings = node_embeddings.reshape(batch_size * max_agents, -1)
+            for _ in range(self.k):
+                node_embeddings = self.message_pass_edges(node_embeddings, agent, neigh, num_neighbours)
+            node_embeddings = node_embeddings.view(batch_size, max_agents, -1)
+        else:
+            neigh_mask = neighbour_mask(mask)
+            for _ in range(self.k):
+                node_embeddings = self.message_pass_batch(node_embeddings, neigh_mask)
+            ## If only primary present
+            no_message = (mask.sum(dim=1) == 1).view(-1, 1, 1)
+
+        return self.out_projection(node_embeddings).masked_fill(no_message, 0)
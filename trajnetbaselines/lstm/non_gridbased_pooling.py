@@ -1,4 +1,5 @@
 from collections import defaultdict
+import math
 import numpy as np
 
 import torch
@@ -38,15 +39,14 @@ def rel_obs(obs):
 
     Parameters
     ----------
-    obs :  Tensor [num_tracks, 2]
+    obs :  Tensor [(batch_size,) num_tracks, 2]
         x-y positions of all agents
 
     Returns
     -------
-    relative : Tensor [num_tracks, num_tracks, 2]
+    relative : Tensor [(batch_size,) num_tracks, num_tracks, 2]
     """
-    unfolded = obs.unsqueeze(0).repeat(obs.size(0), 1, 1)
-    relative = unfolded - obs.unsqueeze(1)
+    relative = obs.unsqueeze(-3) - obs.unsqueeze(-2)
     return relative
 
 def rel_directional(obs1, obs2):
@@ -54,20 +54,199 @@ def rel_directional(obs1, obs2):
 
     Parameters
     ----------
-    obs1 :  Tensor [num_tracks, 2]
+    obs1 :  Tensor [(batch_size,) num_tracks, 2]
         x-y positions of all agents at previous time-step t-1
-    obs2 :  Tensor [num_tracks, 2]
+    obs2 :  Tensor [(batch_size,) num_tracks, 2]
         x-y positions of all agents at current time-step t
 
     Returns
     -------
-    relative : Tensor [num_tracks, num_tracks, 2]
+    relative : Tensor [(batch_size,) num_tracks, num_tracks, 2]
     """
     vel = obs2 - obs1
-    unfolded = vel.unsqueeze(0).repeat(vel.size(0), 1, 1)
-    relative = unfolded - vel.unsqueeze(1)
+    relative = vel.unsqueeze(-3) - vel.unsqueeze(-2)
     return relative
 
+def scene_pairs(mask):
+    """ Provides all pairs of valid agents within the scenes of a padded batch,
+    including every agent paired with itself
+
+    Parameters
+    ----------
+    mask :  Bool Tensor [batch_size, max_agents]
+        Validity mask of the padded agents
+
+    Returns
+    -------
+    scene, agent, neigh : Tensors [num_pairs,]
+        Scene, agent and neighbour index of each pair, ordered by scene and agent
+    """
+    return torch.nonzero(mask.unsqueeze(2) & mask.unsqueeze(1), as_tuple=True)
+
+def segment_max(values, segments, num_segments):
+    """ Max of values [num_pairs, dim] over each segment --> [num_segments, dim] """
+    pooled = values.new_zeros(num_segments, values.size(1))
+    return pooled.scatter_reduce(0, segments.unsqueeze(1).expand_as(values), values, 'amax', include_self=False)
+
+def neighbour_mask(mask):
+    """ Provides the valid neighbours of every agent of a padded batch of scenes
+
+    Parameters
+    ----------
+    mask :  Bool Tensor [batch_size, max_agents]
+        Validity mask of the padded agents
+
+    Returns
+    -------
+    neigh_mask : Bool Tensor [batch_size, max_agents, max_agents]
+        True if both agents are valid and distinct
+    """
+    max_agents = mask.size(1)
+    eye = torch.eye(max_agents, dtype=torch.bool, device=mask.device)
+    return mask.unsqueeze(1) & mask.unsqueeze(2) & ~eye
+
+def nearest_neighbours(obs, mask, n):
+    """ Provides the n nearest neighbours of every agent of a padded batch of scenes
+
+    The neighbours are ordered by distance, ties broken by neighbour index.
+    In scenes with less than n neighbours, all neighbours are kept in index order.
+
+    Parameters
+    ----------
+    obs :  Tensor [batch_size, max_agents, 2]
+        x-y positions of all agents
+    mask :  Bool Tensor [batch_size, max_agents]
+        Validity mask of the padded agents
+    n : Scalar
+        Number of neighbours to select
+
+    Returns
+    -------
+    neigh_index : Long Tensor [batch_size, max_agents, n]
+        Index of the selected neighbours in their scene
+    neigh_valid : Bool Tensor [batch_size, max_agents, n]
+        False for the padding of the agents with less than n neighbours
+    """
+    batch_size, max_agents = mask.shape
+    neigh_mask = neighbour_mask(mask)
+    rel_position = rel_obs(obs)
+    sq_distance = rel_position[..., 0] * rel_position[..., 0] + rel_position[..., 1] * rel_position[..., 1]
+    few_neighbours = (mask.sum(dim=1) - 1) < n
+    sq_distance = sq_distance.masked_fill(few_neighbours.view(-1, 1, 1), 0).masked_fill(~neigh_mask, float('inf'))
+
+    ## The bits of non-negative floats sort as integers: (distance, index) keys
+    neigh_order = torch.arange(max_agents, device=obs.device)
+    key = sq_distance.float().view(torch.int32).long() * max_agents + neigh_order
+    _, neigh_index = torch.topk(key, min(n, max_agents), dim=2, largest=False)
+    neigh_valid = torch.gather(neigh_mask, 2, neigh_index)
+    if max_agents < n:
+        neigh_index = torch.cat([neigh_index, neigh_index.new_zeros(batch_size, max_agents, n - max_agents)], dim=2)
+        neigh_valid = torch.cat([neigh_valid, neigh_valid.new_zeros(batch_size, max_agents, n - max_agents)], dim=2)
+    return neigh_index, neigh_valid
+
+def neighbour_edges(obs, mask, radius=None, n=None):
+    """ Provides the edges of a sparse neighbourhood graph of a padded batch of scenes
+
+    The neighbours of an agent are the other agents of its scene closer than
+    radius and among its n nearest neighbours (see nearest_neighbours).
+    Without radius and n, all the other agents of the scene are neighbours.
+
+    Parameters
+    ----------
+    obs :  Tensor [batch_size, max_agents, 2]
+        x-y positions of all agents
+    mask :  Bool Tensor [batch_size, max_agents]
+        Validity mask of the padded agents
+    radius : Scalar
+        Maximum distance of the neighbours
+    n : Scalar
+        Number of nearest neighbours
+
+    Returns
+    -------
+    scene, agent, neigh : Tensors [num_edges,]
+        Scene, agent and neighbour index of each edge, ordered by scene and agent
+    """
+    adjacency = neighbour_mask(mask)
+    if n is not None:
+        neigh_index, neigh_valid = nearest_neighbours(obs, mask, n)
+        ## (the padding of neigh_index may repeat a selected neighbour)
+        selected = torch.zeros(adjacency.shape, dtype=torch.long, device=obs.device)
+        adjacency = adjacency & (selected.scatter_add(2, neigh_index, neigh_valid.long()) > 0)
+    if radius is not None:
+        rel_position = rel_obs(obs)
+        sq_distance = rel_position[..., 0] * rel_position[..., 0] + rel_position[..., 1] * rel_position[..., 1]
+        adjacency = adjacency & (sq_distance < radius ** 2)
+    return torch.nonzero(adjacency, as_tuple=True)
+
+def nearest_grid(obs1, obs2, mask, n, no_velocity=False):
+    """ Provides the relative coordinates of the n nearest neighbours (see nearest_neighbours)
+
+    Parameters
+    ----------
+    obs1 :  Tensor [batch_size, max_agents, 2]
+        x-y positions of all agents at previous time-step t-1
+    obs2 :  Tensor [batch_size, max_agents, 2]
+        x-y positions of all agents at current time-step t
+    mask :  Bool Tensor [batch_size, max_agents]
+        Validity mask of the padded agents
+    n : Scalar
+        Number of neighbours to select
+    no_velocity : Bool
+        If True, only the relative positions are provided
+
+    Returns
+    -------
+    nearest : Tensor [batch_size, max_agents, n, 2 or 4]
+        Relative position (and velocity) of the neighbours, zero for the padding
+    """
+    neigh_index, neigh_valid = nearest_neighbours(obs2, mask, n)
+    scene = torch.arange(mask.size(0), device=obs2.device).view(-1, 1, 1)
+    nearest = obs2[scene, neigh_index] - obs2.unsqueeze(2)
+    if not no_velocity:
+        vel = obs2 - obs1
+        nearest = torch.cat([nearest, vel[scene, neigh_index] - vel.unsqueeze(2)], dim=3)
+    return nearest.masked_fill(~neigh_valid.unsqueeze(3), 0)
+
+def update_pool_lstm(pool, inputs, mask):
+    """ Updates the interaction-encoder LSTM of the agents of a padded batch of scenes
+
+    The states of the present tracks (pool.track_mask) of the scenes with more
+    than one agent are updated. The others keep their state and get a zero
+    interaction vector.
+
+    Parameters
+    ----------
+    pool : interaction module with pool_lstm, hidden2pool and hidden_cell_state
+    inputs :  Tensor [batch_size, max_agents, input_dim]
+        Inputs of the interaction-encoder LSTM
+    mask :  Bool Tensor [batch_size, max_agents]
+        Validity mask of the padded agents
+
+    Returns
+    -------
+    interaction_vector : Tensor [batch_size, max_agents, pool.out_dim]
+    """
+    batch_size, max_agents = mask.shape
+    rows = (mask & (mask.sum(dim=1, keepdim=True) > 1)).view(-1)
+    interaction_vector = torch.zeros(batch_size * max_agents, pool.out_dim, device=inputs.device)
+    if rows.any():
+        track_mask = pool.track_mask.clone()
+        track_mask[pool.track_mask] = rows[mask.view(-1)]
+        hidden_cell_stacked = [
+            pool.hidden_cell_state[0][track_mask],
+            pool.hidden_cell_state[1][track_mask],
+        ]
+
+        ## Update interaction-encoder LSTM
+        hidden_cell_stacked = pool.pool_lstm(inputs.view(batch_size * max_agents, -1)[rows], hidden_cell_stacked)
+        interaction_vector = interaction_vector.index_put((rows,), pool.hidden2pool(hidden_cell_stacked[0]))
+
+        ## Save hidden-cell-states
+        pool.hidden_cell_state[0][track_mask] = hidden_cell_stacked[0]
+        pool.hidden_cell_state[1][track_mask] = hidden_cell_stacked[1]
+    return interaction_vector.view(batch_size, max_agents, -1)
+
 class NN_Pooling(torch.nn.Module):
     """ Interaction vector is obtained by concatenating the relative coordinates of
         top-n neighbours selected according to criterion (euclidean distance)
@@ -114,39 +293,34 @@ class NN_Pooling(torch.nn.Module):
         interaction_vector : Tensor [num_tracks, self.out_dim]
             interaction vector of all agents in the scene
         """
+        mask = torch.ones(1, obs2.size(0), dtype=torch.bool, device=obs2.device)
+        return self.forward_batch(None, obs1.unsqueeze(0), obs2.unsqueeze(0), mask)[0]
 
-        num_tracks = obs2.size(0)
+    def forward_batch(self, _, obs1, obs2, mask):
+        """ Forward function for a padded batch of scenes
 
-        # Get relative position of all agents wrt one another 
-        # [num_tracks, 2] --> [num_tracks, num_tracks, 2]
-        rel_position = rel_obs(obs2)
-        # Deleting Diagonal (agents wrt themselves) 
-        # [num_tracks, num_tracks, 2] --> [num_tracks, num_tracks - 1, 2]
-        rel_position = rel_position[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, 2)
+        Parameters
+        ----------
+        obs1 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at previous time-step t-1
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
 
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size, max_agents, self.out_dim]
+            interaction vector of all agents in the batch
+        """
+        batch_size, max_agents = mask.shape
 
-        # Get relative velocities of all agents wrt one another 
-        # [num_tracks, 2] --> [num_tracks, num_tracks, 2]
-        rel_direction = rel_directional(obs1, obs2)
-        # Deleting Diagonal (agents wrt themselves) 
-        # [num_tracks, num_tracks, 2] --> [num_tracks, num_tracks - 1, 2]
-        rel_direction = rel_direction[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, 2)
-
-        # Combine [num_tracks, num_tracks - 1, self.input_dim]
-        overall_grid = torch.cat([rel_position, rel_direction], dim=2) if not self.no_velocity else rel_position
-
-        # Get nearest n neighours
-        if (num_tracks - 1) < self.n:
-            nearest_grid = torch.zeros((num_tracks, self.n, self.input_dim), device=obs2.device)
-            nearest_grid[:, :(num_tracks-1)] = overall_grid
-        else:
-            rel_distance = torch.norm(rel_position, dim=2)
-            _, dist_index = torch.topk(-rel_distance, self.n, dim=1)
-            nearest_grid = torch.gather(overall_grid, 1, dist_index.unsqueeze(2).repeat(1, 1, self.input_dim))
+        # Relative coordinates of the nearest n neighbours [batch_size, max_agents, n, self.input_dim]
+        nearest = nearest_grid(obs1, obs2, mask, self.n, self.no_velocity)
 
         ## Embed top-n relative neighbour attributes
-        nearest_grid = self.embedding(nearest_grid)
-        return nearest_grid.view(num_tracks, -1)
+        nearest = self.embedding(nearest)
+        return nearest.view(batch_size, max_agents, -1)
 
 class HiddenStateMLPPooling(torch.nn.Module):
     """ Interaction vector is obtained by max-pooling the embeddings of relative coordinates
@@ -232,6 +406,46 @@ class HiddenStateMLPPooling(torch.nn.Module):
         pooled, _ = torch.max(embedded, dim=1)
         return self.out_projection(pooled)
 
+    def forward_batch(self, hidden_states, obs1, obs2, mask):
+        """ Forward function for a padded batch of scenes
+
+        Parameters
+        ----------
+        obs1 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at previous time-step t-1
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        hidden_states :  Tensor [batch_size, max_agents, hidden_dim]
+            LSTM hidden state of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
+
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size, max_agents, self.out_dim]
+            interaction vector of all agents in the batch
+        """
+        batch_size, max_agents = mask.shape
+
+        # All pairs of agents of the same scene [num_pairs,]
+        scene, agent, neigh = scene_pairs(mask)
+
+        # Relative position [num_pairs, 2] --> [num_pairs, self.mlp_dim_spatial]
+        spatial = self.spatial_embedding(obs2[scene, neigh] - obs2[scene, agent])
+        # [batch_size, max_agents, hidden_dim] --> [num_pairs, mlp_dim_hidden]
+        hidden = self.hidden_embedding(hidden_states)[scene, neigh]
+
+        if self.vel_embedding is not None:
+            vel = obs2 - obs1
+            directional = self.vel_embedding((vel[scene, neigh] - vel[scene, agent])*4)
+            embedded = torch.cat([spatial, directional, hidden], dim=1)
+        else:
+            embedded = torch.cat([spatial, hidden], dim=1)
+
+        # Max Pool over the agents of the scene
+        pooled = segment_max(embedded, scene * max_agents + agent, batch_size * max_agents)
+        return self.out_projection(pooled).view(batch_size, max_agents, -1)
+
 class AttentionMLPPooling(torch.nn.Module):
     """ Interaction vector is obtained by attention-weighting the embeddings of relative coordinates
         and hidden-state of all neighbours. Proposed in S-BiGAT
@@ -328,6 +542,64 @@ class AttentionMLPPooling(torch.nn.Module):
 
         return self.out_projection(attn_output[torch.eye(len(obs2)).bool()])
 
+    def forward_batch(self, hidden_states, obs1, obs2, mask):
+        """ Forward function for a padded batch of scenes
+
+        Parameters
+        ----------
+        obs1 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at previous time-step t-1
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        hidden_states :  Tensor [batch_size, max_agents, hidden_dim]
+            LSTM hidden state of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
+
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size, max_agents, self.out_dim]
+            interaction vector of all agents in the batch
+        """
+        batch_size, max_agents = mask.shape
+        num_rows = batch_size * max_agents
+
+        # All pairs of agents of the same scene [num_pairs,]
+        scene, agent, neigh = scene_pairs(mask)
+        rows = scene * max_agents + agent
+
+        # [num_pairs, mlp_dim]
+        vel = obs2 - obs1
+        spatial = self.spatial_embedding(obs2[scene, neigh] - obs2[scene, agent])
+        directional = self.vel_embedding((vel[scene, neigh] - vel[scene, agent])*4)
+        if self.hidden_embedding is not None:
+            hidden = self.hidden_embedding(hidden_states)[scene, neigh]
+            embedded = torch.cat([spatial, directional, hidden], dim=1)
+        else:
+            embedded = torch.cat([spatial, directional], dim=1)
+
+        ## Attention: only the output of each agent wrt itself is kept, so every
+        ## agent queries once over the agents of its scene (single-head attention
+        ## of self.multihead_attn, computed with segment softmax over the pairs)
+        w_q, w_k, w_v = self.multihead_attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.multihead_attn.in_proj_bias.chunk(3)
+        self_pair = neigh == agent
+        query = torch.zeros(num_rows, embedded.size(1), device=obs2.device)
+        query[rows[self_pair]] = torch.nn.functional.linear(self.wq(embedded[self_pair]), w_q, b_q)
+        key = torch.nn.functional.linear(self.wk(embedded), w_k, b_k)
+        value = torch.nn.functional.linear(self.wv(embedded), w_v, b_v)
+
+        scores = (query[rows] * key).sum(dim=1) / math.sqrt(key.size(1))
+        scores_max = torch.full((num_rows,), float('-inf'), device=obs2.device)
+        scores_max = scores_max.scatter_reduce(0, rows, scores.detach(), 'amax')
+        weights = torch.exp(scores - scores_max[rows])
+        weights = weights / torch.zeros(num_rows, device=obs2.device).index_add(0, rows, weights)[rows]
+        attn_output = torch.zeros(num_rows, value.size(1), device=obs2.device).index_add(
+            0, rows, weights.unsqueeze(1) * value)
+        attn_output = self.multihead_attn.out_proj(attn_output)
+
+        return self.out_projection(attn_output).view(batch_size, max_agents, -1)
+
 class DirectionalMLPPooling(torch.nn.Module):
     """ Interaction vector is obtained by max-pooling the embeddings of relative coordinates
         and relative velocity of all neighbours.
@@ -374,6 +646,21 @@ class DirectionalMLPPooling(torch.nn.Module):
         pooled, _ = torch.max(embedded, dim=1)
         return self.out_projection(pooled)
 
+    def forward_batch(self, _, obs1, obs2, mask):
+        """ Forward function for a padded batch of scenes.
+        See HiddenStateMLPPooling.forward_batch """
+        batch_size, max_agents = mask.shape
+        scene, agent, neigh = scene_pairs(mask)
+
+        vel = obs2 - obs1
+        spatial = self.spatial_embedding(obs2[scene, neigh] - obs2[scene, agent])
+        directional = self.directional_embedding((vel[scene, neigh] - vel[scene, agent])*4)
+
+        # Max Pool over the agents of the scene
+        embedded = torch.cat([spatial, directional], dim=1)
+        pooled = segment_max(embedded, scene * max_agents + agent, batch_size * max_agents)
+        return self.out_projection(pooled).view(batch_size, max_agents, -1)
+
 class NN_LSTM(torch.nn.Module):
     """ Interaction vector is obtained by concatenating the relative coordinates of
         top-n neighbours filtered according to criterion (euclidean distance).
@@ -407,8 +694,8 @@ class NN_LSTM(torch.nn.Module):
 
     def reset(self, num_tracks, device):
         self.hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
         )
 
     def forward(self, _, obs1, obs2):
@@ -426,61 +713,36 @@ class NN_LSTM(torch.nn.Module):
         interaction_vector : Tensor [num_tracks, self.out_dim]
             interaction vector of all agents in the scene
         """
-        num_tracks = obs2.size(0)
+        mask = torch.ones(1, obs2.size(0), dtype=torch.bool, device=obs2.device)
+        return self.forward_batch(None, obs1.unsqueeze(0), obs2.unsqueeze(0), mask)[0]
 
-        ## If only primary pedestrian of the scene present
-        if torch.sum(self.track_mask).item() == 1:
-            return torch.zeros(num_tracks, self.out_dim, device=obs1.device)
-
-        hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(self.track_mask, self.hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(self.track_mask, self.hidden_cell_state[1]) if m], dim=0),
-        ]
+    def forward_batch(self, _, obs1, obs2, mask):
+        """ Forward function for a padded batch of scenes
 
-        # Get relative position of all agents wrt one another 
-        # [num_tracks, 2] --> [num_tracks, num_tracks, 2]
-        rel_position = rel_obs(obs2)
-        # Deleting Diagonal (agents wrt themselves) 
-        # [num_tracks, num_tracks, 2] --> [num_tracks, num_tracks - 1, 2]
-        rel_position = rel_position[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, 2)
+        Parameters
+        ----------
+        obs1 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at previous time-step t-1
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
 
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size, max_agents, self.out_dim]
+            interaction vector of all agents in the batch
+        """
+        batch_size, max_agents = mask.shape
 
-        # Get relative velocities of all agents wrt one another 
-        # [num_tracks, 2] --> [num_tracks, num_tracks, 2]
-        rel_direction = rel_directional(obs1, obs2)
-        # Deleting Diagonal (agents wrt themselves) 
-        # [num_tracks, num_tracks, 2] --> [num_tracks, num_tracks - 1, 2]
-        rel_direction = rel_direction[~torch.eye(num_tracks).bool()].reshape(num_tracks, num_tracks-1, 2)
-
-        # Combine [num_tracks, num_tracks - 1, 4]
-        overall_grid = torch.cat([rel_position, rel_direction], dim=2)
-
-        # Get nearest n neighours
-        if (num_tracks - 1) < self.n:
-            nearest_grid = torch.zeros((num_tracks, self.n, 4), device=obs2.device)
-            nearest_grid[:, :(num_tracks-1)] = overall_grid
-        else:
-            rel_distance = torch.norm(rel_position, dim=2)
-            _, dist_index = torch.topk(-rel_distance, self.n, dim=1)
-            nearest_grid = torch.gather(overall_grid, 1, dist_index.unsqueeze(2).repeat(1, 1, 4))
+        # Relative coordinates of the nearest n neighbours [batch_size, max_agents, n, 4]
+        nearest = nearest_grid(obs1, obs2, mask, self.n)
 
         ## Embed top-n relative neighbour attributes
-        nearest_grid = self.embedding(nearest_grid)
-        nearest_grid = nearest_grid.view(num_tracks, -1)
+        nearest = self.embedding(nearest).view(batch_size, max_agents, -1)
 
         ## Update interaction-encoder LSTM
-        hidden_cell_stacked = self.pool_lstm(nearest_grid, hidden_cell_stacked)
-        interaction_vector = self.hidden2pool(hidden_cell_stacked[0])
-
-        ## Save hidden-cell-states
-        mask_index = [i for i, m in enumerate(self.track_mask) if m]
-        for i, h, c in zip(mask_index,
-                           hidden_cell_stacked[0],
-                           hidden_cell_stacked[1]):
-            self.hidden_cell_state[0][i] = h
-            self.hidden_cell_state[1][i] = c
-
-        return interaction_vector
+        return update_pool_lstm(self, nearest, mask)
 
 class TrajectronPooling(torch.nn.Module):
     """ Interaction vector is obtained by sum-pooling the absolute coordinates and passed
@@ -511,8 +773,8 @@ class TrajectronPooling(torch.nn.Module):
 
     def reset(self, num_tracks, device):
         self.hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
         )
 
     def forward(self, _, obs1, obs2):
@@ -530,40 +792,36 @@ class TrajectronPooling(torch.nn.Module):
         interaction_vector : Tensor [num_tracks, self.out_dim]
             interaction vector of all agents in the scene
         """
+        mask = torch.ones(1, obs2.size(0), dtype=torch.bool, device=obs2.device)
+        return self.forward_batch(None, obs1.unsqueeze(0), obs2.unsqueeze(0), mask)[0]
 
-        num_tracks = obs2.size(0)
+    def forward_batch(self, _, obs1, obs2, mask):
+        """ Forward function for a padded batch of scenes
 
-        ## If only primary pedestrian of the scene present
-        if torch.sum(self.track_mask).item() == 1:
-            return torch.zeros(num_tracks, self.out_dim, device=obs1.device)
-
-        hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(self.track_mask, self.hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(self.track_mask, self.hidden_cell_state[1]) if m], dim=0),
-        ]
+        Parameters
+        ----------
+        obs1 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at previous time-step t-1
+        obs2 :  Tensor [batch_size, max_agents, 2]
+            x-y positions of all agents at current time-step t
+        mask :  Bool Tensor [batch_size, max_agents]
+            Validity mask of the padded agents
 
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size, max_agents, self.out_dim]
+            interaction vector of all agents in the batch
+        """
         ## Construct neighbour grid using current position and velocity
+        ## (state of the agent and sum of the states of its neighbours)
         curr_vel = obs2 - obs1
         curr_pos = obs2
-        states = torch.cat([curr_pos, curr_vel], dim=1)
-        neigh_grid = torch.stack([
-            torch.cat([states[i], torch.sum(states[one_cold(i, num_tracks)], dim=0)])
-            for i in range(num_tracks)], dim=0)
-        neigh_grid = self.embedding(neigh_grid).view(num_tracks, -1)
+        states = torch.cat([curr_pos, curr_vel], dim=2)
+        neigh_states = torch.matmul(neighbour_mask(mask).to(states.dtype), states)
+        neigh_grid = self.embedding(torch.cat([states, neigh_states], dim=2))
 
         ## Update interaction-encoder LSTM
-        hidden_cell_stacked = self.pool_lstm(neigh_grid, hidden_cell_stacked)
-        interaction_vector = self.hidden2pool(hidden_cell_stacked[0])
-
-        ## Save hidden-cell-states
-        mask_index = [i for i, m in enumerate(self.track_mask) if m]
-        for i, h, c in zip(mask_index,
-                           hidden_cell_stacked[0],
-                           hidden_cell_stacked[1]):
-            self.hidden_cell_state[0][i] = h
-            self.hidden_cell_state[1][i] = c
-
-        return interaction_vector
+        return update_pool_lstm(self, neigh_grid, mask)
 
 class SAttention_fast(torch.nn.Module):
     """ Interaction vector is obtained by attention-weighting the embeddings of relative coordinates obtained
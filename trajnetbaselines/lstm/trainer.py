@@ -9,13 +9,9 @@ import random
 import os
 import pickle
 import torch
-import numpy as np
 
-import trajnetplusplustools
-
-from .. import augmentation
 from .loss import PredictionLoss, L2Loss
-from .lstm import LSTM, LSTMPredictor, drop_distant
+from .lstm import LSTM, LSTMPredictor
 from .gridbased_pooling import GridBasedPooling
 from .non_gridbased_pooling import NN_Pooling, HiddenStateMLPPooling, AttentionMLPPooling, DirectionalMLPPooling
 from .non_gridbased_pooling import NN_LSTM, TrajectronPooling, SAttention_fast
@@ -23,8 +19,7 @@ from .more_non_gridbased_pooling import NMMP
 
 from .. import __version__ as VERSION
 
-from .utils import center_scene, random_rotation
-from .data_load_utils import prepare_data
+from .data_load_utils import prepare_data, SceneDataset, BucketBatchSampler, num_agents, scene_loader
 from .contrastive import SocialNCE, ProjHead, EventEncoder, SpatialEncoder
 
 class Trainer(object):
@@ -33,7 +28,8 @@ class Trainer(object):
                  model=None, criterion=None, optimizer=None, lr_scheduler=None,
                  device=None, batch_size=8, obs_length=9, pred_length=12, augment=True,
                  normalize_scene=False, save_every=1, start_length=0, obs_dropout=False,
-                 augment_noise=False, col_weight=0.0, col_gamma=2.0, val_flag=True):
+                 augment_noise=False, col_weight=0.0, col_gamma=2.0, val_flag=True,
+                 workers=0, prefetch=2, bucket=False, max_agents=None):
 
         self.model = model if model is not None else LSTM()
         self.criterion = criterion if criterion is not None else PredictionLoss()
@@ -68,16 +64,24 @@ class Trainer(object):
 
         self.val_flag = val_flag
 
+        self.workers = workers
+        self.prefetch = prefetch
+        self.bucket = bucket
+        self.max_agents = max_agents
+
     def loop(self, train_scenes, val_scenes, train_goals, val_goals, out, epochs=35, start_epoch=0):
+        ## The loaders (and their workers) are kept for all epochs
+        train_loader = self.build_loader(train_scenes, train_goals)
+        val_loader = self.build_loader(val_scenes, val_goals, train=False) if self.val_flag else None
         for epoch in range(start_epoch, start_epoch + epochs):
             if epoch % self.save_every == 0:
                 state = {'epoch': epoch, 'state_dict': self.model.state_dict(),
                          'optimizer': self.optimizer.state_dict(),
                          'scheduler': self.lr_scheduler.state_dict()}
                 LSTMPredictor(self.model).save(state, out + '.epoch{}'.format(epoch))
-            self.train(train_scenes, train_goals, epoch)
+            self.train(train_loader, epoch)
             if self.val_flag:
-                self.val(val_scenes, val_goals, epoch)
+                self.val(val_loader, epoch)
 
 
         state = {'epoch': epoch + 1, 'state_dict': self.model.state_dict(),
@@ -90,75 +94,51 @@ class Trainer(object):
         for param_group in self.optimizer.param_groups:
             return param_group['lr']
 
-    def train(self, scenes, goals, epoch):
+    def build_loader(self, scenes, goals, train=True):
+        """ Loader of the batches of the scenes of a split, built once for all epochs
+
+        Scenes are prepared (and augmented) into batches by the loader workers.
+        Training scenes are shuffled and augmented, validation scenes are not.
+        """
+        if train:
+            dataset = SceneDataset(scenes, goals, self.obs_length, normalize_scene=self.normalize_scene,
+                                   augment=self.augment, augment_noise=self.augment_noise)
+        else:
+            dataset = SceneDataset(scenes, goals, self.obs_length, normalize_scene=self.normalize_scene)
+        batch_sampler = None
+        if self.bucket or self.max_agents is not None:
+            batch_sampler = BucketBatchSampler(num_agents(scenes), self.batch_size, self.max_agents, shuffle=train)
+        return scene_loader(dataset, self.batch_size, shuffle=train, workers=self.workers,
+                            prefetch=self.prefetch, pin_memory=self.device.type == 'cuda',
+                            batch_sampler=batch_sampler)
+
+    def train(self, loader, epoch):
         start_time = time.time()
 
         print('epoch', epoch)
-        random.shuffle(scenes)
         epoch_loss = 0.0
         self.model.train()
         self.optimizer.zero_grad()
 
-        ## Initialize batch of scenes
-        batch_scene = []
-        batch_scene_goal = []
-        batch_split = [0]
+        num_scenes = 0
+        batch_start = time.time()
+        for batch_i, (batch_scene, batch_scene_goal, batch_split) in enumerate(loader):
+            num_scenes += len(batch_split) - 1
+            batch_scene = batch_scene.to(self.device, non_blocking=True)
+            batch_scene_goal = batch_scene_goal.to(self.device, non_blocking=True)
+            batch_split = batch_split.to(self.device, non_blocking=True)
 
-        for scene_i, (filename, scene_id, paths) in enumerate(scenes):
-            scene_start = time.time()
+            preprocess_time = time.time() - batch_start
 
-            ## make new scene
-            scene = trajnetplusplustools.Reader.paths_to_xy(paths)
+            ## Train Batch
+            loss, loss_pred, loss_nce = self.train_batch(batch_scene, batch_scene_goal, batch_split)
+            epoch_loss += loss
+            total_time = time.time() - batch_start
 
-            ## get goals
-            if goals is not None:
-                scene_goal = np.array(goals[filename][scene_id])
-            else:
-                scene_goal = np.array([[0, 0] for path in paths])
-
-            ## Drop Distant
-            scene, mask = drop_distant(scene)
-            scene_goal = scene_goal[mask]
-
-            ##process scene
-            if self.normalize_scene:
-                scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
-            if self.augment:
-                scene, scene_goal = random_rotation(scene, goals=scene_goal)
-            if self.augment_noise:
-                scene = augmentation.add_noise(scene, thresh=0.02, ped='neigh')
-
-            ## Augment scene to batch of scenes
-            batch_scene.append(scene)
-            batch_split.append(int(scene.shape[1]))
-            batch_scene_goal.append(scene_goal)
-
-            if ((scene_i + 1) % self.batch_size == 0) or ((scene_i + 1) == len(scenes)):
-                ## Construct Batch
-                batch_scene = np.concatenate(batch_scene, axis=1)
-                batch_scene_goal = np.concatenate(batch_scene_goal, axis=0)
-                batch_split = np.cumsum(batch_split)
-                
-                batch_scene = torch.Tensor(batch_scene).to(self.device)
-                batch_scene_goal = torch.Tensor(batch_scene_goal).to(self.device)
-                batch_split = torch.Tensor(batch_split).to(self.device).long()
-
-                preprocess_time = time.time() - scene_start
-
-                ## Train Batch
-                loss, loss_pred, loss_nce = self.train_batch(batch_scene, batch_scene_goal, batch_split)                
-                epoch_loss += loss
-                total_time = time.time() - scene_start
-
-                ## Reset Batch
-                batch_scene = []
-                batch_scene_goal = []
-                batch_split = [0]
-
-            if (scene_i + 1) % (10*self.batch_size) == 0:
+            if (batch_i + 1) % 10 == 0:
                 self.log.info({
                     # 'type': 'train',
-                    'epoch': epoch, 'batch': '{:d} / {:d}'.format(scene_i, len(scenes)),
+                    'epoch': epoch, 'batch': '{:d} / {:d}'.format(num_scenes - 1, len(loader.dataset)),
                     # 'time': round(total_time, 2),
                     # 'data_time': round(preprocess_time, 2),
                     'lr': '{:.1e}'.format(self.get_lr()),
@@ -166,76 +146,39 @@ class Trainer(object):
                     'pred': round(loss_pred, 2),
                     'nce': round(loss_nce, 2),
                 })
+            batch_start = time.time()
 
         self.lr_scheduler.step()
         self.log.info({
             'type': 'train-epoch',
             'epoch': epoch + 1,
-            'loss': round(epoch_loss / (len(scenes)), 4),
+            'loss': round(epoch_loss / (len(loader.dataset)), 4),
             'time': round(time.time() - start_time, 1),
         })
 
-    def val(self, scenes, goals, epoch):
+    def val(self, loader, epoch):
         eval_start = time.time()
 
         val_loss = 0.0
         test_loss = 0.0
         self.model.eval()
 
-        ## Initialize batch of scenes
-        batch_scene = []
-        batch_scene_goal = []
-        batch_split = [0]
+        for batch_scene, batch_scene_goal, batch_split in loader:
+            batch_scene = batch_scene.to(self.device, non_blocking=True)
+            batch_scene_goal = batch_scene_goal.to(self.device, non_blocking=True)
+            batch_split = batch_split.to(self.device, non_blocking=True)
 
-        for scene_i, (filename, scene_id, paths) in enumerate(scenes):
-            ## make new scene
-            scene = trajnetplusplustools.Reader.paths_to_xy(paths)
-
-            ## get goals
-            if goals is not None:
-                scene_goal = np.array(goals[filename][scene_id])
-            else:
-                scene_goal = np.array([[0, 0] for path in paths])
-
-            ## Drop Distant
-            scene, mask = drop_distant(scene)
-            scene_goal = scene_goal[mask]
-
-            ##process scene
-            if self.normalize_scene:
-                scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
-
-            ## Augment scene to batch of scenes
-            batch_scene.append(scene)
-            batch_split.append(int(scene.shape[1]))
-            batch_scene_goal.append(scene_goal)
-
-            if ((scene_i + 1) % self.batch_size == 0) or ((scene_i + 1) == len(scenes)):
-                ## Construct Batch
-                batch_scene = np.concatenate(batch_scene, axis=1)
-                batch_scene_goal = np.concatenate(batch_scene_goal, axis=0)
-                batch_split = np.cumsum(batch_split)
-                
-                batch_scene = torch.Tensor(batch_scene).to(self.device)
-                batch_scene_goal = torch.Tensor(batch_scene_goal).to(self.device)
-                batch_split = torch.Tensor(batch_split).to(self.device).long()
-                
-                loss_val_batch, loss_test_batch = self.val_batch(batch_scene, batch_scene_goal, batch_split)
-                val_loss += loss_val_batch
-                test_loss += loss_test_batch
-
-                ## Reset Batch
-                batch_scene = []
-                batch_scene_goal = []
-                batch_split = [0]
+            loss_val_batch, loss_test_batch = self.val_batch(batch_scene, batch_scene_goal, batch_split)
+            val_loss += loss_val_batch
+            test_loss += loss_test_batch
 
         eval_time = time.time() - eval_start
 
         self.log.info({
             'type': 'val-epoch',
             'epoch': epoch + 1,
-            'loss': round(val_loss / (len(scenes)), 3),
-            'test_loss': round(test_loss / len(scenes), 3),
+            'loss': round(val_loss / (len(loader.dataset)), 3),
+            'test_loss': round(test_loss / len(loader.dataset), 3),
             'time': round(eval_time, 1),
         })
 
@@ -383,6 +326,16 @@ def main(epochs=25):
                         help='type of interaction encoder')
     parser.add_argument('--sample', default=1.0, type=float,
                         help='sample ratio when loading train/val scenes')
+    parser.add_argument('--cache', action='store_true',
+                        help='load train/val scenes from the binary scene cache (compiled on first use)')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='number of data loader workers preparing the batches')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help='number of batches prefetched by each data loader worker')
+    parser.add_argument('--bucket', action='store_true',
+                        help='batch scenes with a similar number of agents together')
+    parser.add_argument('--max_agents', default=None, type=int,
+                        help='fill batches up to this total number of agents instead of batch_size scenes')
 
     ## Augmentations
     parser.add_argument('--augment', action='store_true',
@@ -445,6 +398,10 @@ def main(epochs=25):
                                  help='number of nearest neighbours to consider')
     hyperparameters.add_argument('--mp_iters', default=5, type=int,
                                  help='message passing iterations in NMMP')
+    hyperparameters.add_argument('--mp_radius', default=None, type=float,
+                                 help='neighbourhood radius of sparse message passing in NMMP (default: all agents)')
+    hyperparameters.add_argument('--mp_neigh', default=None, type=int,
+                                 help='number of nearest neighbours of sparse message passing in NMMP (default: all agents)')
 
     ## Collision Loss
     hyperparameters.add_argument('--col_weight', default=0., type=float,
@@ -473,8 +430,8 @@ def main(epochs=25):
         random.seed(1)
 
     ## Prepare data
-    train_scenes, train_goals, _ = prepare_data('DATA_BLOCK/' + args.path, subset='/train/', sample=args.sample, goals=args.goals)
-    val_scenes, val_goals, val_flag = prepare_data('DATA_BLOCK/' + args.path, subset='/val/', sample=args.sample, goals=args.goals)
+    train_scenes, train_goals, _ = prepare_data('DATA_BLOCK/' + args.path, subset='/train/', sample=args.sample, goals=args.goals, cache=args.cache)
+    val_scenes, val_goals, val_flag = prepare_data('DATA_BLOCK/' + args.path, subset='/val/', sample=args.sample, goals=args.goals, cache=args.cache)
 
     args.path += '/{}/'.format(args.type)
 
@@ -532,7 +489,8 @@ def main(epochs=25):
         pool = HiddenStateMLPPooling(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
                                      mlp_dim_vel=args.vel_dim)
     elif args.type == 'nmmp':
-        pool = NMMP(hidden_dim=args.hidden_dim, out_dim=args.pool_dim, k=args.mp_iters)
+        pool = NMMP(hidden_dim=args.hidden_dim, out_dim=args.pool_dim, k=args.mp_iters,
+                    radius=args.mp_radius, neigh=args.mp_neigh)
     elif args.type == 'attentionmlp':
         pool = AttentionMLPPooling(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
                                    mlp_dim_spatial=args.spatial_dim, mlp_dim_vel=args.vel_dim)
@@ -616,7 +574,9 @@ def main(epochs=25):
                       pred_length=args.pred_length, augment=args.augment, normalize_scene=args.normalize_scene,
                       save_every=args.save_every, start_length=args.start_length, obs_dropout=args.obs_dropout,
                       augment_noise=args.augment_noise, col_weight=args.col_weight, col_gamma=args.col_gamma,
-                      val_flag=val_flag)
+                      val_flag=val_flag,
+                      workers=args.workers, prefetch=args.prefetch,
+                      bucket=args.bucket, max_agents=args.max_agents)
 
     # ------------- Social NCE ----------------
     if args.contrast_pretrain > 0 and args.contrast_weight > 0:
@@ -624,8 +584,9 @@ def main(epochs=25):
         for param in model.parameters():
             param.requires_grad = False
         # pretrain contrastive heads
+        pretrain_loader = trainer.build_loader(train_scenes, train_goals)
         for i in range(args.contrast_pretrain):
-            trainer.train(train_scenes, train_goals, i-args.contrast_pretrain)
+            trainer.train(pretrain_loader, i-args.contrast_pretrain)
         # release forecasting model parameters
         for param in model.parameters():
             param.requires_grad = True
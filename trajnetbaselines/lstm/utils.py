@@ -2,6 +2,7 @@ import math
 import random
 
 import numpy
+import torch
 import matplotlib.pyplot as plt
 
 import trajnetplusplustools
@@ -50,6 +51,126 @@ def center_scene(xy, obs_length=9, ped_id=0, goals=None):
         return xy, rotation, center, goals[0]
     return xy, rotation, center
 
+def padded_index(track_mask, batch_split):
+    """ Indices to gather the present tracks of a batch of scenes into a padded tensor
+
+    Parameters
+    ----------
+    track_mask : Bool Tensor [num_tracks,]
+        Mask of tracks present at the current time-step
+    batch_split : Tensor [batch_size + 1]
+        Tensor defining the split of the batch.
+
+    Returns
+    -------
+    scene_index : Tensor [num_present,]
+        Scene of every present track
+    agent_index : Tensor [num_present,]
+        Position of every present track within its scene
+    mask : Bool Tensor [batch_size, max_agents]
+        Validity mask of the padded tensor
+    """
+    scene_sizes = batch_split[1:] - batch_split[:-1]
+    scene_of_track = torch.repeat_interleave(torch.arange(len(scene_sizes), device=track_mask.device), scene_sizes)
+    scene_index = scene_of_track[track_mask]
+    counts = torch.bincount(scene_index, minlength=len(scene_sizes))
+    starts = torch.cumsum(counts, dim=0) - counts
+    agent_index = torch.arange(len(scene_index), device=track_mask.device) - starts[scene_index]
+    max_agents = int(counts.max()) if len(counts) else 0
+    mask = torch.arange(max_agents, device=track_mask.device).unsqueeze(0) < counts.unsqueeze(1)
+    return scene_index, agent_index, mask
+
+
+def to_padded(values, scene_index, agent_index, mask):
+    """ [num_present, ...] --> [batch_size, max_agents, ...], padded with zeros """
+    padded = values.new_zeros(mask.shape + values.shape[1:])
+    return padded.index_put((scene_index, agent_index), values)
+
+
+def pool_scenes(pool, hidden_states, obs1, obs2, track_mask, batch_split):
+    """ Interaction vectors of the present tracks of a batch of scenes
+
+    Interaction modules providing 'forward_batch' pool all scenes in a single call
+    on padded [batch_size, max_agents, ...] tensors. The others are called once per scene.
+
+    Parameters
+    ----------
+    pool : interaction module
+    hidden_states : Tensor [num_tracks, hidden_dim]
+        Hidden-states of all tracks of the batch
+    obs1 : Tensor [num_tracks, 2]
+        Previous x-y positions of all tracks of the batch
+    obs2 : Tensor [num_tracks, 2]
+        Current x-y positions of all tracks of the batch
+    track_mask : Bool Tensor [num_tracks,]
+        Mask of tracks present at the current time-step
+    batch_split : Tensor [batch_size + 1]
+        Tensor defining the split of the batch.
+
+    Returns
+    -------
+    pooled : Tensor [num_present, pool.out_dim]
+    """
+    if hasattr(pool, 'forward_batch'):
+        scene_index, agent_index, mask = padded_index(track_mask, batch_split)
+        pool.track_mask = track_mask
+        pooled = pool.forward_batch(to_padded(hidden_states[track_mask], scene_index, agent_index, mask),
+                                    to_padded(obs1[track_mask], scene_index, agent_index, mask),
+                                    to_padded(obs2[track_mask], scene_index, agent_index, mask),
+                                    mask)
+        return pooled[scene_index, agent_index]
+
+    num_tracks = len(obs2)
+    batch_pool = []
+    ## Iterate over scenes
+    for (start, end) in zip(batch_split[:-1], batch_split[1:]):
+        ## Mask for the scene
+        scene_track_mask = track_mask[start:end]
+        ## Get observations and hidden-state for the scene
+        prev_position = obs1[start:end][scene_track_mask]
+        curr_position = obs2[start:end][scene_track_mask]
+        curr_hidden_state = hidden_states[start:end][scene_track_mask]
+
+        ## Provide track_mask to the interaction encoders
+        ## Everyone absent by default. Only those visible in current scene are present
+        interaction_track_mask = torch.zeros(num_tracks, device=obs1.device).bool()
+        interaction_track_mask[start:end] = track_mask[start:end]
+        pool.track_mask = interaction_track_mask
+
+        ## Pool
+        pool_sample = pool(curr_hidden_state, prev_position, curr_position)
+        batch_pool.append(pool_sample)
+
+    return torch.cat(batch_pool)
+
+def repeat_split(batch_split, k):
+    """ batch_split of k consecutive copies of all the tracks of a batch
+
+    Copy m of the tracks of the batch occupies indices [m * num_tracks, (m + 1) * num_tracks)
+    and each copy of a scene is a separate scene.
+    """
+    num_tracks = batch_split[-1]
+    copies = [batch_split[:-1] + m * num_tracks for m in range(k)]
+    return torch.cat(copies + [batch_split[-1:] * k])
+
+def repeat_pool_state(pool, k):
+    """ Repeats the recurrent state of the interaction module for k copies of the tracks (see repeat_split) """
+    state = getattr(pool, 'hidden_cell_state', None)
+    if state is None:
+        return
+    if state[0].dim() == 2:
+        pool.hidden_cell_state = (state[0].repeat(k, 1), state[1].repeat(k, 1))
+    else:
+        ## Pairwise state [num_tracks, num_tracks, dim]: copies do not interact
+        num_tracks = state[0].size(0)
+        repeated = []
+        for s in state:
+            block_diagonal = s.new_zeros((k * num_tracks, k * num_tracks) + s.shape[2:])
+            for m in range(k):
+                block_diagonal[m * num_tracks:(m + 1) * num_tracks, m * num_tracks:(m + 1) * num_tracks] = s
+            repeated.append(block_diagonal)
+        pool.hidden_cell_state = tuple(repeated)
+
 def visualize_scene(scene, goal=None):
     for t in range(scene.shape[1]):
         path = scene[:, t]
@@ -11,7 +11,7 @@ import trajnetplusplustools
 from ..lstm.modules import Hidden2Normal, InputEmbedding
 
 from .. import augmentation
-from ..lstm.utils import center_scene
+from ..lstm.utils import center_scene, pool_scenes, repeat_split, repeat_pool_state
 
 NAN = float('nan')
 
@@ -74,7 +74,8 @@ class SGAN(torch.nn.Module):
         ## Variety Loss
         self.k = k
 
-    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None, step_type='g', pred_length=12):
+    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None, step_type='g', pred_length=12,
+                stacked=False):
         """forward
         
         Parameters
@@ -95,6 +96,9 @@ class SGAN(torch.nn.Module):
             Determines to train the generator / discriminator
         pred_length:
             Length of prediction sequence
+        stacked : Bool
+            If true, the modes are returned stacked in Tensors [k, pred_length, num_tracks, _]
+            instead of lists
 
         Returns
         -------
@@ -111,16 +115,11 @@ class SGAN(torch.nn.Module):
             Discriminator scores of prediction primary tracks
         """
 
-        rel_pred_list = []
-        pred_list = []
-        for _ in range(self.k):
-            # print("k:", k)
-            rel_pred_scene, pred_scene, batch_feat = self.generator(observed, goals, batch_split, prediction_truth, n_predict)
-            rel_pred_list.append(rel_pred_scene)
-            pred_list.append(pred_scene)
-
-            if step_type == 'd':
-                break
+        ## The observations are encoded once, the k modes are decoded in one pass
+        k = 1 if step_type == 'd' else self.k
+        rel_pred_list, pred_list, batch_feat = self.generator(observed, goals, batch_split, prediction_truth, n_predict,
+                                                             k=k, stacked=stacked)
+        pred_scene = pred_list[-1]
 
         ## Get real scores and fake scores from discriminator
         if self.d_steps and (prediction_truth is not None):
@@ -196,28 +195,21 @@ class LSTMGenerator(torch.nn.Module):
         )
         ###############################
 
-    def adding_noise(self, hidden_cell_state):
+    def adding_noise(self, hidden_cell_state, k=1):
         ## Adds noise to hidden_cell_state for multimodal prediction
+        ## The tracks are k consecutive copies of the batch, one noise vector per copy (mode)
 
         if self.no_noise:
             return hidden_cell_state
 
-        hidden_cell_state = (
-            torch.stack([h for h in hidden_cell_state[0]], dim=0),
-            torch.stack([c for c in hidden_cell_state[1]], dim=0),
-        )
-
         ## Add noise to hidden state
         ## [num_tracks, hidden_dim] --> [num_tracks, hidden_dim - noise_dim]
         new_hidden_state = self.mlp_decoder_context(hidden_cell_state[0])
-        noise = get_noise((self.noise_dim, ), self.noise_type, device=hidden_cell_state[0].device)
-        z_decoder = noise.repeat(new_hidden_state.size(0), 1)
+        noise = get_noise((k, self.noise_dim), self.noise_type, device=hidden_cell_state[0].device)
+        z_decoder = noise.repeat_interleave(new_hidden_state.size(0) // k, dim=0)
         new_hidden_state = torch.cat([new_hidden_state, z_decoder], dim=1)
 
-        return (
-            list(new_hidden_state),
-            list(hidden_cell_state[1]),
-        )
+        return (new_hidden_state, hidden_cell_state[1])
 
     def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split):
         """Do one step of prediction: two inputs to one normal prediction.
@@ -226,7 +218,7 @@ class LSTMGenerator(torch.nn.Module):
         ----------
         lstm: torch nn module [Encoder / Decoder]
             The module responsible for prediction
-        hidden_cell_state : tuple (hidden_state, cell_state)
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [num_tracks, hidden_dim]
             Current hidden_cell_state of the pedestrians
         obs1 : Tensor [num_tracks, 2]
             Previous x-y positions of the pedestrians
@@ -237,7 +229,7 @@ class LSTMGenerator(torch.nn.Module):
         
         Returns
         -------
-        hidden_cell_state : tuple (hidden_state, cell_state)
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [num_tracks, hidden_dim]
             Updated hidden_cell_state of the pedestrians
         normals : Tensor [num_tracks, 5]
             Parameters of a multivariate normal of the predicted position 
@@ -250,8 +242,8 @@ class LSTMGenerator(torch.nn.Module):
 
         ## Masked Hidden Cell State
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+            hidden_cell_state[0][track_mask],
+            hidden_cell_state[1][track_mask],
         ]
 
         ## Mask current velocity & embed
@@ -271,28 +263,8 @@ class LSTMGenerator(torch.nn.Module):
 
         ## Mask & Pool per scene
         if self.pool is not None:
-            hidden_states_to_pool = torch.stack(hidden_cell_state[0]).clone() # detach?
-            batch_pool = []
-            ## Iterate over scenes
-            for (start, end) in zip(batch_split[:-1], batch_split[1:]):
-                ## Mask for the scene
-                scene_track_mask = track_mask[start:end]
-                ## Get observations and hidden-state for the scene
-                prev_position = obs1[start:end][scene_track_mask]
-                curr_position = obs2[start:end][scene_track_mask]
-                curr_hidden_state = hidden_states_to_pool[start:end][scene_track_mask]
-
-                ## Provide track_mask to the interaction encoders
-                ## Everyone absent by default. Only those visible in current scene are present
-                interaction_track_mask = torch.zeros(num_tracks, device=obs1.device).bool()
-                interaction_track_mask[start:end] = track_mask[start:end]
-                self.pool.track_mask = interaction_track_mask
-
-                ## Pool
-                pool_sample = self.pool(curr_hidden_state, prev_position, curr_position)
-                batch_pool.append(pool_sample)
-
-            pooled = torch.cat(batch_pool)
+            hidden_states_to_pool = hidden_cell_state[0].clone() # detach?
+            pooled = pool_scenes(self.pool, hidden_states_to_pool, obs1, obs2, track_mask, batch_split)
             if self.pool_to_input:
                 input_emb = torch.cat([input_emb, pooled], dim=1)
             else:
@@ -303,19 +275,18 @@ class LSTMGenerator(torch.nn.Module):
         normal_masked = self.hidden2normal(hidden_cell_stacked[0])
 
         # unmask [Update hidden-states and next velocities of pedestrians]
+        # out-of-place index_put: absent tracks keep their state (and graph)
+        mask_index = track_mask.nonzero(as_tuple=True)
+        hidden_cell_state = (
+            hidden_cell_state[0].index_put(mask_index, hidden_cell_stacked[0]),
+            hidden_cell_state[1].index_put(mask_index, hidden_cell_stacked[1]),
+        )
         normal = torch.full((track_mask.size(0), 5), NAN, device=obs1.device)
-        mask_index = [i for i, m in enumerate(track_mask) if m]
-        for i, h, c, n in zip(mask_index,
-                              hidden_cell_stacked[0],
-                              hidden_cell_stacked[1],
-                              normal_masked):
-            hidden_cell_state[0][i] = h
-            hidden_cell_state[1][i] = c
-            normal[i] = n
+        normal = normal.index_put(mask_index, normal_masked)
 
         return hidden_cell_state, normal
 
-    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None):
+    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None, k=None, stacked=False):
         """Forecast the entire sequence 
         
         Parameters
@@ -332,6 +303,11 @@ class LSTMGenerator(torch.nn.Module):
             Helps in teacher forcing wrt neighbours positions during training
         n_predict: Int
             Length of sequence to be predicted during test time
+        k: Int
+            Number of modes. If given, the observations are encoded once and the k modes
+            (each with its own noise) are decoded from this encoding, see decode
+        stacked: Bool
+            If true (and k is given), the k modes are returned stacked instead of as lists
 
         Returns
         -------
@@ -340,6 +316,11 @@ class LSTMGenerator(torch.nn.Module):
             i.e. positions relative to previous positions
         pred_scene : Tensor [pred_length, num_tracks, 2]
             Predicted positions of pedestrians i.e. absolute positions
+        feat_scene : Tensor [pred_length, num_tracks, hidden_dim]
+            Hidden-states of the decoder
+        If k is given, rel_pred_scene and pred_scene are lists of length k
+        (Tensors [k, pred_length, num_tracks, _] if stacked)
+        and feat_scene corresponds to the last mode.
         """
 
         assert ((prediction_truth is None) + (n_predict is None)) == 1
@@ -347,14 +328,14 @@ class LSTMGenerator(torch.nn.Module):
             # -1 because one prediction is done by the encoder already
             prediction_truth = [None for _ in range(n_predict)]
 
-        # initialize: Because of tracks with different lengths and the masked
-        # update, the hidden state for every LSTM needs to be a separate object
-        # in the backprop graph. Therefore: list of hidden states instead of
-        # a single higher rank Tensor.
+        # initialize: Tensor [num_tracks, hidden_dim] of hidden and cell states.
+        # Because of tracks with different lengths, every step only updates
+        # the rows of the tracks present (see step) without modifying the
+        # states of the previous step in place.
         num_tracks = observed.size(1)
         hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
         )
 
         ## Reset LSTMs of Interaction Encoders.
@@ -382,14 +363,74 @@ class LSTMGenerator(torch.nn.Module):
             (observed[-1:], prediction_truth[:-1])
         )))
 
+        ## Decode the modes as copies of the scenes of the batch, all in one pass.
+        ## Pairwise recurrent states of interaction encoders grow quadratically with
+        ## the number of copies: for them, the modes are decoded one at a time
+        ## (from the same encoding).
+        num_modes = 1 if k is None else k
+        pool_state = getattr(self.pool, 'hidden_cell_state', None)
+        pairwise_state = pool_state is not None and pool_state[0].dim() == 3
+        modes_per_pass = 1 if pairwise_state else num_modes
+
+        ## Decoded copies [seq_length, modes * num_tracks, _] viewed as [modes, seq_length, num_tracks, _]
+        rel_pred_modes, pred_modes = [], []
+        for _ in range(0, num_modes, modes_per_pass):
+            if pairwise_state:
+                self.pool.hidden_cell_state = pool_state
+            rel_pred_scene, pred_scene, feat_scene = self.decode(hidden_cell_state, normals, positions, prediction_truth,
+                                                                 goals, batch_split, modes_per_pass)
+            rel_pred_modes.append(rel_pred_scene.view(-1, modes_per_pass, num_tracks, 5).transpose(0, 1))
+            pred_modes.append(pred_scene.view(-1, modes_per_pass, num_tracks, 2).transpose(0, 1))
+        rel_pred_modes = rel_pred_modes[0] if len(rel_pred_modes) == 1 else torch.cat(rel_pred_modes)
+        pred_modes = pred_modes[0] if len(pred_modes) == 1 else torch.cat(pred_modes)
+        feat_scene = feat_scene.chunk(modes_per_pass, dim=1)[-1]
+
+        if k is None:
+            return rel_pred_modes[0], pred_modes[0], feat_scene
+        if stacked:
+            return rel_pred_modes, pred_modes, feat_scene
+        return list(rel_pred_modes.unbind(0)), list(pred_modes.unbind(0)), feat_scene
+
+    def decode(self, hidden_cell_state, normals, positions, prediction_truth, goals, batch_split, k=1):
+        """Decode k modes of the predictions of an encoded batch in parallel
+
+        The tracks are repeated k times, every copy of the batch being decoded with its own noise.
 
+        Parameters
+        ----------
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [num_tracks, hidden_dim]
+            hidden_cell_state of the pedestrians at the end of the observations
+        normals : List of Tensors [num_tracks, 5]
+            Normals predicted by the encoder
+        positions : List of Tensors [num_tracks, 2]
+            Positions predicted by the encoder
+        prediction_truth : List of Tensors [num_tracks, 2] (or None during test time)
+            Last observed positions followed by the ground truth positions
+        goals : Tensor [num_tracks, 2]
+        batch_split : Tensor [batch_size + 1]
+        k : Int
+            Number of modes
 
+        Returns
+        -------
+        rel_pred_scene : Tensor [seq_length - 1, k * num_tracks, 5]
+        pred_scene : Tensor [seq_length - 1, k * num_tracks, 2]
+        feat_scene : Tensor [pred_length, k * num_tracks, hidden_dim]
+        """
+        hidden_cell_state = (hidden_cell_state[0].repeat(k, 1), hidden_cell_state[1].repeat(k, 1))
+        normals = [normal.repeat(k, 1) for normal in normals]
+        positions = [position.repeat(k, 1) for position in positions]
+        prediction_truth = [obs if obs is None else obs.repeat(k, 1) for obs in prediction_truth]
+        goals = goals.repeat(k, 1)
+        batch_split = repeat_split(batch_split, k)
+        if self.pool is not None:
+            repeat_pool_state(self.pool, k)
 
         # Add Noise
-        hidden_cell_state = self.adding_noise(hidden_cell_state)
+        hidden_cell_state = self.adding_noise(hidden_cell_state, k)
         #by gpuBurner
         hidden_state_memory = []
-        hidden_state_memory.append(torch.stack([h for h in hidden_cell_state[0]], dim=0))
+        hidden_state_memory.append(hidden_cell_state[0])
 
 
         # decoder, predictions
@@ -410,9 +451,9 @@ class LSTMGenerator(torch.nn.Module):
             normals.append(normal)
             positions.append(obs2 + normal[:, :2])  # no sampling, just mean
             #by GPUburner
-            hidden_state_memory.append(torch.stack([h for h in hidden_cell_state[0]], dim=0))
+            hidden_state_memory.append(hidden_cell_state[0])
 
-    # Pred_scene: Tensor [seq_length, num_tracks, 2]
+        # Pred_scene: Tensor [seq_length, num_tracks, 2]
         #    Absolute positions of all pedestrians
         # Rel_pred_scene: Tensor [seq_length, num_tracks, 5]
         #    Velocities of all pedestrians
@@ -523,27 +564,7 @@ class LSTMDiscriminator(torch.nn.Module):
         ## Mask & Pool per scene
         if self.pool is not None:
             hidden_states_to_pool = torch.stack(hidden_cell_state[0]).clone() # detach?
-            batch_pool = []
-            ## Iterate over scenes
-            for (start, end) in zip(batch_split[:-1], batch_split[1:]):
-                ## Mask for the scene
-                scene_track_mask = track_mask[start:end]
-                ## Get observations and hidden-state for the scene
-                prev_position = obs1[start:end][scene_track_mask]
-                curr_position = obs2[start:end][scene_track_mask]
-                curr_hidden_state = hidden_states_to_pool[start:end][scene_track_mask]
-
-                ## Provide track_mask to the interaction encoders
-                ## Everyone absent by default. Only those visible in current scene are present
-                interaction_track_mask = torch.zeros(num_tracks, device=obs1.device).bool()
-                interaction_track_mask[start:end] = track_mask[start:end]
-                self.pool.track_mask = interaction_track_mask
-
-                ## Pool
-                pool_sample = self.pool(curr_hidden_state, prev_position, curr_position)
-                batch_pool.append(pool_sample)
-
-            pooled = torch.cat(batch_pool)
+            pooled = pool_scenes(self.pool, hidden_states_to_pool, obs1, obs2, track_mask, batch_split)
             if self.pool_to_input:
                 input_emb = torch.cat([input_emb, pooled], dim=1)
             else:
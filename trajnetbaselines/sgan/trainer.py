@@ -10,24 +10,20 @@ import os
 import pickle
 import copy
 
-import numpy as np
-
 import torch
-import trajnetplusplustools
 
-from .. import augmentation
 from ..lstm.loss import PredictionLoss, L2Loss
 from ..lstm.loss import gan_d_loss, gan_g_loss # variety_loss
 from ..lstm.gridbased_pooling import GridBasedPooling
 from ..lstm.non_gridbased_pooling import NN_Pooling, HiddenStateMLPPooling, AttentionMLPPooling, DirectionalMLPPooling
 from ..lstm.non_gridbased_pooling import NN_LSTM, TrajectronPooling, SAttention_fast
 from ..lstm.more_non_gridbased_pooling import NMMP
-from .sgan import SGAN, drop_distant, SGANPredictor
+from .sgan import SGAN, SGANPredictor
 from .sgan import LSTMGenerator, LSTMDiscriminator
 from .. import __version__ as VERSION
 
-from ..lstm.utils import center_scene, random_rotation
-from ..lstm.data_load_utils import prepare_data
+from ..lstm.data_load_utils import prepare_data, SceneDataset, BucketBatchSampler, num_agents, scene_loader
+from ..lstm.contrastive import spatial_samples
 from torch import nn as nn
 
 
@@ -67,7 +63,8 @@ class SpatialEncoder(nn.Module):
 class Trainer(object):
     def __init__(self, model=None, g_optimizer=None, g_lr_scheduler=None, d_optimizer=None, d_lr_scheduler=None,
                  criterion=None, device=None, batch_size=8, obs_length=9, pred_length=12, augment=True,
-                 normalize_scene=False, save_every=1, start_length=0, val_flag=True):
+                 normalize_scene=False, save_every=1, start_length=0, val_flag=True,
+                 workers=0, prefetch=2, bucket=False, max_agents=None):
         self.model = model if model is not None else SGAN()
         self.g_optimizer = g_optimizer if g_optimizer is not None else torch.optim.Adam(
                            model.generator.parameters(), lr=1e-3, weight_decay=1e-4)
@@ -97,7 +94,15 @@ class Trainer(object):
 
         self.val_flag = val_flag
 
+        self.workers = workers
+        self.prefetch = prefetch
+        self.bucket = bucket
+        self.max_agents = max_agents
+
     def loop(self, train_scenes, val_scenes, train_goals, val_goals, out, epochs=35, start_epoch=0):
+        ## The loaders (and their workers) are kept for all epochs
+        train_loader = self.build_loader(train_scenes, train_goals)
+        val_loader = self.build_loader(val_scenes, val_goals, train=False) if self.val_flag else None
         for epoch in range(start_epoch, epochs):
             if epoch % self.save_every == 0:
                 state = {'epoch': epoch, 'state_dict': self.model.state_dict(),
@@ -105,9 +110,9 @@ class Trainer(object):
                          'g_lr_scheduler': self.g_lr_scheduler.state_dict(),
                          'd_lr_scheduler': self.d_lr_scheduler.state_dict()}
                 SGANPredictor(self.model).save(state, out + '.epoch{}'.format(epoch))
-            self.train(train_scenes, train_goals, epoch)
+            self.train(train_loader, epoch)
             if self.val_flag:
-                self.val(val_scenes, val_goals, epoch)
+                self.val(val_loader, epoch)
 
         state = {'epoch': epoch + 1, 'state_dict': self.model.state_dict(),
                  'g_optimizer': self.g_optimizer.state_dict(), 'd_optimizer': self.d_optimizer.state_dict(),
@@ -120,101 +125,80 @@ class Trainer(object):
         for param_group in self.g_optimizer.param_groups:
             return param_group['lr']
 
-    def train(self, scenes, goals, epoch):
+    def build_loader(self, scenes, goals, train=True):
+        """ Loader of the batches of the scenes of a split, built once for all epochs
+
+        Scenes are prepared (and augmented) into batches by the loader workers.
+        Training scenes are shuffled and augmented, validation scenes are not.
+        """
+        if train:
+            dataset = SceneDataset(scenes, goals, self.obs_length, normalize_scene=self.normalize_scene,
+                                   augment=self.augment)
+        else:
+            dataset = SceneDataset(scenes, goals, self.obs_length, normalize_scene=self.normalize_scene)
+        batch_sampler = None
+        if self.bucket or self.max_agents is not None:
+            batch_sampler = BucketBatchSampler(num_agents(scenes), self.batch_size, self.max_agents, shuffle=train)
+        return scene_loader(dataset, self.batch_size, shuffle=train, workers=self.workers,
+                            prefetch=self.prefetch, pin_memory=self.device.type == 'cuda',
+                            batch_sampler=batch_sampler)
+
+    def train(self, loader, epoch):
         start_time = time.time()
 
         print('epoch', epoch)
 
-        random.shuffle(scenes)
         epoch_loss = 0.0
         self.model.train()
         self.g_optimizer.zero_grad()
         self.d_optimizer.zero_grad()
 
-        ## Initialize batch of scenes
-        batch_scene = []
-        batch_scene_goal = []
-        batch_split = [0]
-
         d_steps_left = self.model.d_steps
         g_steps_left = self.model.g_steps
-        for scene_i, (filename, scene_id, paths) in enumerate(scenes):
-            scene_start = time.time()
-
-            ## make new scene
-            scene = trajnetplusplustools.Reader.paths_to_xy(paths)
-
-            ## get goals
-            if goals is not None:
-                scene_goal = np.array(goals[filename][scene_id])
-            else:
-                scene_goal = np.array([[0, 0] for path in paths])
-
-            ## Drop Distant
-            scene, mask = drop_distant(scene)
-            scene_goal = scene_goal[mask]
-
-            ##process scene
-            if self.normalize_scene:
-                scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
-            if self.augment:
-                scene, scene_goal = random_rotation(scene, goals=scene_goal)
-            
-            ## Augment scene to batch of scenes
-            batch_scene.append(scene)
-            batch_split.append(int(scene.shape[1]))
-            batch_scene_goal.append(scene_goal)
-
-            if ((scene_i + 1) % self.batch_size == 0) or ((scene_i + 1) == len(scenes)):
-                ## Construct Batch
-                batch_scene = np.concatenate(batch_scene, axis=1)
-                batch_scene_goal = np.concatenate(batch_scene_goal, axis=0)
-                batch_split = np.cumsum(batch_split)
-                
-                batch_scene = torch.Tensor(batch_scene).to(self.device)
-                batch_scene_goal = torch.Tensor(batch_scene_goal).to(self.device)
-                batch_split = torch.Tensor(batch_split).to(self.device).long()
-
-                preprocess_time = time.time() - scene_start
-
-                # Decide whether to use the batch for stepping on discriminator or
-                # generator; an iteration consists of args.g_steps steps on the
-                # generator followed by args.d_steps steps on the discriminator.
-                if g_steps_left > 0:
-                    step_type = 'g'
-                    g_steps_left -= 1
-                    ## Train Batch
-                    loss, contrastLoss = self.train_batch(batch_scene, batch_scene_goal, batch_split, step_type='g')
-
-                elif d_steps_left > 0:
-                    step_type = 'd'
-                    d_steps_left -= 1
-                    ## Train Batch
-                    loss, contrastLoss = self.train_batch(batch_scene, batch_scene_goal, batch_split, step_type='d')
-
-                epoch_loss += loss
-                total_time = time.time() - scene_start
-
-                ## Reset Batch
-                batch_scene = []
-                batch_scene_goal = []
-                batch_split = [0]
-
-                ## Update d_steps, g_steps once they end
-                if d_steps_left == 0 and g_steps_left == 0:
-                    d_steps_left = self.model.d_steps
-                    g_steps_left = self.model.g_steps
-
-            if (scene_i + 1) % (10*self.batch_size) == 0:
+        num_scenes = 0
+        batch_start = time.time()
+        for batch_i, (batch_scene, batch_scene_goal, batch_split) in enumerate(loader):
+            num_scenes += len(batch_split) - 1
+            batch_scene = batch_scene.to(self.device, non_blocking=True)
+            batch_scene_goal = batch_scene_goal.to(self.device, non_blocking=True)
+            batch_split = batch_split.to(self.device, non_blocking=True)
+
+            preprocess_time = time.time() - batch_start
+
+            # Decide whether to use the batch for stepping on discriminator or
+            # generator; an iteration consists of args.g_steps steps on the
+            # generator followed by args.d_steps steps on the discriminator.
+            if g_steps_left > 0:
+                step_type = 'g'
+                g_steps_left -= 1
+                ## Train Batch
+                loss, contrastLoss = self.train_batch(batch_scene, batch_scene_goal, batch_split, step_type='g')
+
+            elif d_steps_left > 0:
+                step_type = 'd'
+                d_steps_left -= 1
+                ## Train Batch
+                loss, contrastLoss = self.train_batch(batch_scene, batch_scene_goal, batch_split, step_type='d')
+
+            epoch_loss += loss
+            total_time = time.time() - batch_start
+
+            ## Update d_steps, g_steps once they end
+            if d_steps_left == 0 and g_steps_left == 0:
+                d_steps_left = self.model.d_steps
+                g_steps_left = self.model.g_steps
+
+            if (batch_i + 1) % 10 == 0:
                 self.log.info({
                     'type': 'train',
-                    'epoch': epoch, 'batch': scene_i, 'n_batches': len(scenes),
+                    'epoch': epoch, 'batch': num_scenes - 1, 'n_batches': len(loader.dataset),
                     'time': round(total_time, 3),
                     'data_time': round(preprocess_time, 3),
                     'lr': self.get_lr(),
                     'loss': round(loss, 3),
                     'contrastLoss': round(contrastLoss.item(), 3),
                 })
+            batch_start = time.time()
 
         self.g_lr_scheduler.step()
         self.d_lr_scheduler.step()
@@ -222,72 +206,33 @@ class Trainer(object):
         self.log.info({
             'type': 'train-epoch',
             'epoch': epoch + 1,
-            'loss': round(epoch_loss / (len(scenes)), 5),
+            'loss': round(epoch_loss / (len(loader.dataset)), 5),
             'time': round(time.time() - start_time, 1),
         })
 
-    def val(self, scenes, goals, epoch):
+    def val(self, loader, epoch):
         eval_start = time.time()
 
         val_loss = 0.0
         test_loss = 0.0
         self.model.train()  # so that it does not return positions but still normals
 
-        ## Initialize batch of scenes
-        batch_scene = []
-        batch_scene_goal = []
-        batch_split = [0]
-
-        for scene_i, (filename, scene_id, paths) in enumerate(scenes):
-            # make new scene
-            scene = trajnetplusplustools.Reader.paths_to_xy(paths)
-
-            ## get goals
-            if goals is not None:
-                # scene_goal = np.array([goals[path[0].pedestrian] for path in paths])
-                scene_goal = np.array(goals[filename][scene_id])
-            else:
-                scene_goal = np.array([[0, 0] for path in paths])
-
-            ## Drop Distant
-            scene, mask = drop_distant(scene)
-            scene_goal = scene_goal[mask]
-
-            ##process scene
-            if self.normalize_scene:
-                scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
-
-            ## Augment scene to batch of scenes
-            batch_scene.append(scene)
-            batch_split.append(int(scene.shape[1]))
-            batch_scene_goal.append(scene_goal)
-
-            if ((scene_i + 1) % self.batch_size == 0) or ((scene_i + 1) == len(scenes)):
-                ## Construct Batch
-                batch_scene = np.concatenate(batch_scene, axis=1)
-                batch_scene_goal = np.concatenate(batch_scene_goal, axis=0)
-                batch_split = np.cumsum(batch_split)
-                
-                batch_scene = torch.Tensor(batch_scene).to(self.device)
-                batch_scene_goal = torch.Tensor(batch_scene_goal).to(self.device)
-                batch_split = torch.Tensor(batch_split).to(self.device).long()
-                
-                loss_val_batch, loss_test_batch = self.val_batch(batch_scene, batch_scene_goal, batch_split)
-                val_loss += loss_val_batch
-                test_loss += loss_test_batch
-
-                ## Reset Batch
-                batch_scene = []
-                batch_scene_goal = []
-                batch_split = [0]
+        for batch_scene, batch_scene_goal, batch_split in loader:
+            batch_scene = batch_scene.to(self.device, non_blocking=True)
+            batch_scene_goal = batch_scene_goal.to(self.device, non_blocking=True)
+            batch_split = batch_split.to(self.device, non_blocking=True)
+
+            loss_val_batch, loss_test_batch = self.val_batch(batch_scene, batch_scene_goal, batch_split)
+            val_loss += loss_val_batch
+            test_loss += loss_test_batch
 
         eval_time = time.time() - eval_start
 
         self.log.info({
             'type': 'val-epoch',
             'epoch': epoch + 1,
-            'loss': round(val_loss / (len(scenes)), 3),
-            'test_loss': round(test_loss / len(scenes), 3),
+            'loss': round(val_loss / (len(loader.dataset)), 3),
+            'test_loss': round(test_loss / len(loader.dataset), 3),
             'time': round(eval_time, 1),
         })
 
@@ -317,7 +262,8 @@ class Trainer(object):
         targets = batch_scene[self.obs_length:self.seq_length] - batch_scene[self.obs_length-1:self.seq_length-1]
 
         rel_output_list, outputs, scores_real, scores_fake, batch_feat = self.model(observed, batch_scene_goal, batch_split, prediction_truth,
-                                                                        step_type=step_type, pred_length=self.pred_length)
+                                                                        step_type=step_type, pred_length=self.pred_length,
+                                                                        stacked=True)
 
         loss, lossContrast = self.loss_criterion(rel_output_list, targets, batch_split, scores_fake, scores_real, step_type, batch_scene, batch_feat)
 
@@ -360,7 +306,8 @@ class Trainer(object):
         with torch.no_grad():
             # "batch_feat" added as an additional returned argument by Antho
             rel_output_list, _, _, _, batch_feat = self.model(observed, batch_scene_goal, batch_split,
-                                                  n_predict=self.pred_length, pred_length=self.pred_length)
+                                                  n_predict=self.pred_length, pred_length=self.pred_length,
+                                                  stacked=True)
 
             # top-k loss
             loss = self.variety_loss(rel_output_list, targets, batch_split)
@@ -393,92 +340,9 @@ class Trainer(object):
         # sample (i.e. the 10th element in batch_scene) is accessed as
         # "batch_scene[9]" (i.e. "batch_scene[self.obs_length]")
 
-        # #####################################################
-        #           TODO: fill the following code
-        # #####################################################
-
-        # -----------------------------------------------------
-        #                  Positive Samples
-        # -----------------------------------------------------
-        # cf. equ. 7 in paper "Social NCE: Contrastive Learning of Socially-aware
-        # Motion Representations" (https://arxiv.org/abs/2012.11717):
-
-        # positive sample ≡ ground truth + N(0, c_e * I )
-        # positive sample: (persons of interest x coordinates)
-
-        c_e = self.noise_local
-        # Retrieving the location of the pedestrians of interest only
-        personOfInterestLocation = gt_future[batch_split[0:-1], :]  # (persons of interest x coordinates) --> for instance: 8 x 2
-        noise_pos = np.random.multivariate_normal([0, 0], np.array([[c_e, 0], [0, c_e]]), (personOfInterestLocation.shape[0]))  # (2,)
-        #                      8 x 2                   1 x 2
-        # sample_pos = personOfInterestLocation + noise.reshape(1, 2)
-        #                      8 x 2             (2,)
-        sample_pos = personOfInterestLocation + noise_pos
-
-        # Retrieving the location of all pedestrians
-        # sample_pos = gt_future[:, :, :] + np.random.multivariate_normal([0,0], np.array([[c_e, 0], [0, c_e]]))
-
-        # -----------------------------------------------------
-        #                  Negative Samples
-        # -----------------------------------------------------
-        # cf. fig 4b and eq. 6 in paper "Social NCE: Contrastive Learning of
-        # Socially-aware Motion Representations" (https://arxiv.org/abs/2012.11717):
-
-        nDirection = self.agent_zone.shape[0]
-        nMaxNeighbour = 80 # TODO re-tune
-
-        # sample_neg: (#persons of interest, #neigboor for this person of interest * #directions, #coordinates)
-        # --> for instance: 8 x 12*9 x 2 = 8 x 108 x 2
-        sample_neg = np.empty(
-            (batch_split.shape[0] - 1, nDirection * nMaxNeighbour, 2))
-        sample_neg[:] = np.NaN  # populating sample_neg with NaN values
-        for i in range(batch_split.shape[0] - 1):
-            # traj_primary = gt_future[batch_split[i]]
-            traj_neighbour = gt_future[batch_split[i] + 1:batch_split[i + 1]]  # (number of neigbours x coordinates) --> for instance: 3 x 2
-
-            noise_neg = np.random.multivariate_normal([0, 0], np.array([[c_e**2, 0], [0, c_e**2]]), (traj_neighbour.shape[0], self.agent_zone.shape[0])) # (2,)
-            # negSampleNonSqueezed: (number of neighbours x directions x coordinates) --> for instance: 3 x 9 x 2
-            #                            3 x 1 x 2                     1 x 9 x 2                (2,)
-            negSampleNonSqueezed = traj_neighbour[:, None, :] + self.agent_zone[None, :, :] + noise_neg
-
-            # negSampleSqueezed: (number of neighbours * directions x coordinates) --> for instance: 27 x 2
-            negSampleSqueezed = negSampleNonSqueezed.reshape((-1, negSampleNonSqueezed.shape[2]))
-
-
-            # Getting rid of too close negative samples
-            vectForDist = negSampleSqueezed - personOfInterestLocation[i, :].reshape(-1, 2)
-            dist = np.sqrt(vectForDist[:, 0]**2 + vectForDist[:, 1]**2)
-            log_array = np.less_equal(dist, self.min_seperation)
-            negSampleSqueezed[log_array] = np.nan
-
-            # Getting rid of too far away negative samples
-            # dist = np.linalg.norm(negSampleSqueezed - personOfInterestLocation[i, :].reshape(-1, 2))
-            # log_array = np.greater_equal(dist, self.min_seperation)
-            # negSampleSqueezed[log_array] = np.nan
-
-            # Filling only the first part in the second dimension of sample_neg (leaving the rest as NaN values)
-            sample_neg[i, 0:negSampleSqueezed.shape[0], :] = negSampleSqueezed
-
-        # negative sample for everyone
-        # the position          # the direction to look around     #some noise
-        # sample_neg = gt_future[:,:,None,:] + self.agent_zone[None, None, :, :] + np.random.multivariate_normal([0,0], np.array([[c_e, 0], [0, c_e]]))
-
-        # -----------------------------------------------------
-        #       Remove negatives that are too close to person of interrest
-        # -----------------------------------------------------
-
-
-
-
-        # -----------------------------------------------------
-        #       Remove negatives that are too easy (optional)
-        # -----------------------------------------------------
-
-        sample_pos = sample_pos.float()
-        sample_neg = torch.tensor(sample_neg).float()
-        return sample_pos, sample_neg
-
-
+        # Positive samples around the primary pedestrians, negative samples around
+        # their neighbours (without the ones too close to the primary pedestrian)
+        return spatial_samples(gt_future, batch_split, self.agent_zone, self.noise_local, self.min_seperation)
 
 
     def contrastive_loss(self, rel_output_list, targets, batch_split, batch_scene, batch_feat):
@@ -626,9 +490,8 @@ class Trainer(object):
 
         Parameters
         ----------
-        rel_output_list : List of length k
-            Each element of the list is Tensor [pred_length, num_tracks, 5]
-            Predicted velocities of pedestrians as multivariate normal
+        rel_output_list : Tensor [k, pred_length, num_tracks, 5]
+            Predicted velocities of pedestrians (k modes) as multivariate normal
             i.e. positions relative to previous positions
         targets : Tensor [pred_length, batch_size, 2]
             Groundtruth sequence of primary pedestrians of each scene
@@ -674,7 +537,7 @@ class Trainer(object):
 
         Parameters
         ----------
-        inputs : List of length k
+        inputs : List of length k or Tensor [k, pred_length, num_tracks, 5]
             Each element of the list is Tensor [pred_length, num_tracks, 5]
             Predicted velocities of pedestrians as multivariate normal
             i.e. positions relative to previous positions
@@ -690,12 +553,10 @@ class Trainer(object):
             variety loss
         """
 
-        iterative_loss = [] 
-        for sample in inputs:
-            sample_loss = self.criterion(sample[-self.pred_length:], target, batch_split)
-            iterative_loss.append(sample_loss)
-
-        loss = torch.stack(iterative_loss)
+        ## Losses of all modes in a single criterion call: Tensor [k, batch_size]
+        if isinstance(inputs, (list, tuple)):
+            inputs = torch.stack(inputs)
+        loss = self.criterion(inputs[:, -self.pred_length:], target, batch_split)
         loss = torch.min(loss, dim=0)[0]
         loss = torch.sum(loss)
         return loss
@@ -731,6 +592,16 @@ def main(epochs=25):
                         help='type of interaction encoder')
     parser.add_argument('--sample', default=1.0, type=float,
                         help='sample ratio when loading train/val scenes')
+    parser.add_argument('--cache', action='store_true',
+                        help='load train/val scenes from the binary scene cache (compiled on first use)')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='number of data loader workers preparing the batches')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help='number of batches prefetched by each data loader worker')
+    parser.add_argument('--bucket', action='store_true',
+                        help='batch scenes with a similar number of agents together')
+    parser.add_argument('--max_agents', default=None, type=int,
+                        help='fill batches up to this total number of agents instead of batch_size scenes')
     parser.add_argument('--contrast_weight', default=0.0, type=float,
                         help='weight of the contrast weight')
     ## Augmentations
@@ -790,6 +661,10 @@ def main(epochs=25):
                                  help='number of nearest neighbours to consider')
     hyperparameters.add_argument('--mp_iters', default=5, type=int,
                                  help='message passing iterations in NMMP')
+    hyperparameters.add_argument('--mp_radius', default=None, type=float,
+                                 help='neighbourhood radius of sparse message passing in NMMP (default: all agents)')
+    hyperparameters.add_argument('--mp_neigh', default=None, type=int,
+                                 help='number of nearest neighbours of sparse message passing in NMMP (default: all agents)')
 
     ## SGAN-Specific Parameters
     hyperparameters.add_argument('--g_steps', default=1, type=int,
@@ -861,8 +736,8 @@ def main(epochs=25):
 
     args.path = 'DATA_BLOCK/' + args.path
     ## Prepare data
-    train_scenes, train_goals, _ = prepare_data(args.path, subset='/train/', sample=args.sample, goals=args.goals)
-    val_scenes, val_goals, val_flag = prepare_data(args.path, subset='/val/', sample=args.sample, goals=args.goals)
+    train_scenes, train_goals, _ = prepare_data(args.path, subset='/train/', sample=args.sample, goals=args.goals, cache=args.cache)
+    val_scenes, val_goals, val_flag = prepare_data(args.path, subset='/val/', sample=args.sample, goals=args.goals, cache=args.cache)
 
     ## pretrained pool model (if any)
     pretrained_pool = None
@@ -873,7 +748,8 @@ def main(epochs=25):
         pool = HiddenStateMLPPooling(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
                                      mlp_dim_vel=args.vel_dim)
     elif args.type == 'nmmp':
-        pool = NMMP(hidden_dim=args.hidden_dim, out_dim=args.pool_dim, k=args.mp_iters)
+        pool = NMMP(hidden_dim=args.hidden_dim, out_dim=args.pool_dim, k=args.mp_iters,
+                    radius=args.mp_radius, neigh=args.mp_neigh)
     elif args.type == 'attentionmlp':
         pool = AttentionMLPPooling(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
                                    mlp_dim_spatial=args.spatial_dim, mlp_dim_vel=args.vel_dim)
@@ -947,7 +823,9 @@ def main(epochs=25):
                       d_lr_scheduler=d_lr_scheduler, device=args.device, criterion=criterion,
                       batch_size=args.batch_size, obs_length=args.obs_length, pred_length=args.pred_length,
                       augment=args.augment, normalize_scene=args.normalize_scene, save_every=args.save_every,
-                      start_length=args.start_length, val_flag=val_flag)
+                      start_length=args.start_length, val_flag=val_flag,
+                      workers=args.workers, prefetch=args.prefetch,
+                      bucket=args.bucket, max_agents=args.max_agents)
     trainer.loop(train_scenes, val_scenes, train_goals, val_goals, args.output, epochs=args.epochs, start_epoch=start_epoch)
 
 
@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 
 def sample_multivariate_distribution(mean, var_log):
@@ -17,8 +16,6 @@ def sample_multivariate_distribution(mean, var_log):
     samples : Tensor [num_tracks, dim]  
         The drawn samples of size [num_tracks, dim]
     """
-    samples = torch.zeros_like(mean)
-    for track in range(mean.size(0)):
-        cov_matrix = np.diag(torch.exp(var_log[track, :]).numpy())
-        samples[track, :] = torch.Tensor(np.random.multivariate_normal(mean[track, :].numpy(), cov_matrix))
+    ## Diagonal covariance: independent normal coordinates
+    samples = mean + torch.exp(0.5 * var_log) * torch.randn_like(mean)
     return samples
\ No newline at end of file
@@ -7,7 +7,7 @@ import torch
 import trajnetplusplustools
 
 from .. import augmentation
-from ..lstm.utils import center_scene
+from ..lstm.utils import center_scene, pool_scenes, repeat_split, repeat_pool_state
 from ..lstm.modules import Hidden2Normal, InputEmbedding
 
 from .utils import sample_multivariate_distribution
@@ -80,30 +80,29 @@ class VAE(torch.nn.Module):
         self.vae_decoder = VAEDecoder(self.latent_dim, self.hidden_dim)
 
     def concat(self, hidden_cell_state, hidden_cell_state_pred):
-        return  (list(torch.cat([torch.stack(hidden_cell_state[0]), torch.stack(hidden_cell_state_pred[0])], dim=1)),
-                 list(torch.cat([torch.stack(hidden_cell_state[1]), torch.stack(hidden_cell_state_pred[1])], dim=1))
-                )
+        return (torch.cat([hidden_cell_state[0], hidden_cell_state_pred[0]], dim=1),
+                torch.cat([hidden_cell_state[1], hidden_cell_state_pred[1]], dim=1))
 
-    def add_noise(self, hidden_cell_state, z_mu, z_var_log, z_mu_obs, z_var_log_obs):
+    def add_noise(self, hidden_cell_state, z_mu, z_var_log, z_mu_obs, z_var_log_obs, k=1):
+        ## The tracks of hidden_cell_state are k consecutive copies of the batch (one per mode)
+        ## The latent distributions are those of a single copy: one sample is drawn for every copy
 
         if self.training:
             ## Sampling using "reparametrization trick"
             # See Kingma & Wellig, Auto-Encoding Variational Bayes, 2014 (arXiv:1312.6114)
-            epsilon = torch.empty(size=z_mu.size()).normal_(mean=0, std=1)
+            z_mu, z_var_log = z_mu.repeat(k, 1), z_var_log.repeat(k, 1)
+            epsilon = torch.randn_like(z_mu)
             z_val = z_mu + torch.exp(0.5*z_var_log) * epsilon
 
         else:
             # Draw a sample from the learned multivariate distribution (z_mu, z_var_log)
-            z_val = sample_multivariate_distribution(z_mu_obs, z_var_log_obs)
+            z_val = sample_multivariate_distribution(z_mu_obs.repeat(k, 1), z_var_log_obs.repeat(k, 1))
 
         ## VAE decoder
         decoder_output = self.vae_decoder(z_val)
 
         ## Update Hidden-Cell-State
-        hidden_state_new = [hidden_state * dec_output for dec_output, hidden_state in zip(decoder_output, hidden_cell_state[0])]
-        cell_state_new = [cell_state for cell_state in hidden_cell_state[1]]
-
-        return (hidden_state_new, cell_state_new)
+        return (hidden_cell_state[0] * decoder_output, hidden_cell_state[1])
 
     def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split):
         """Do one step of prediction: two inputs to one normal prediction.
@@ -112,7 +111,7 @@ class VAE(torch.nn.Module):
         ----------
         lstm: torch nn module [Encoder / Decoder]
             The module responsible for prediction
-        hidden_cell_state : tuple (hidden_state, cell_state)
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [num_tracks, hidden_dim]
             Current hidden_cell_state of the pedestrians
         obs1 : Tensor [num_tracks, 2]
             Previous x-y positions of the pedestrians
@@ -123,7 +122,7 @@ class VAE(torch.nn.Module):
         
         Returns
         -------
-        hidden_cell_state : tuple (hidden_state, cell_state)
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [num_tracks, hidden_dim]
             Updated hidden_cell_state of the pedestrians
         normals : Tensor [num_tracks, 5]
             Parameters of a multivariate normal of the predicted position 
@@ -136,8 +135,8 @@ class VAE(torch.nn.Module):
 
         ## Masked Hidden Cell State
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+            hidden_cell_state[0][track_mask],
+            hidden_cell_state[1][track_mask],
         ]
 
         ## Mask current velocity & embed
@@ -157,28 +156,8 @@ class VAE(torch.nn.Module):
 
         ## Mask & Pool per scene
         if self.pool is not None:
-            hidden_states_to_pool = torch.stack(hidden_cell_state[0]).clone() # detach?
-            batch_pool = []
-            ## Iterate over scenes
-            for (start, end) in zip(batch_split[:-1], batch_split[1:]):
-                ## Mask for the scene
-                scene_track_mask = track_mask[start:end]
-                ## Get observations and hidden-state for the scene
-                prev_position = obs1[start:end][scene_track_mask]
-                curr_position = obs2[start:end][scene_track_mask]
-                curr_hidden_state = hidden_states_to_pool[start:end][scene_track_mask]
-
-                ## Provide track_mask to the interaction encoders
-                ## Everyone absent by default. Only those visible in current scene are present
-                interaction_track_mask = torch.zeros(num_tracks, device=obs1.device).bool()
-                interaction_track_mask[start:end] = track_mask[start:end]
-                self.pool.track_mask = interaction_track_mask
-
-                ## Pool
-                pool_sample = self.pool(curr_hidden_state, prev_position, curr_position)
-                batch_pool.append(pool_sample)
-
-            pooled = torch.cat(batch_pool)
+            hidden_states_to_pool = hidden_cell_state[0].clone() # detach?
+            pooled = pool_scenes(self.pool, hidden_states_to_pool, obs1, obs2, track_mask, batch_split)
             if self.pool_to_input:
                 input_emb = torch.cat([input_emb, pooled], dim=1)
             else:
@@ -189,15 +168,14 @@ class VAE(torch.nn.Module):
         normal_masked = self.hidden2normal(hidden_cell_stacked[0])
 
         # unmask [Update hidden-states and next velocities of pedestrians]
+        # out-of-place index_put: absent tracks keep their state (and graph)
+        mask_index = track_mask.nonzero(as_tuple=True)
+        hidden_cell_state = (
+            hidden_cell_state[0].index_put(mask_index, hidden_cell_stacked[0]),
+            hidden_cell_state[1].index_put(mask_index, hidden_cell_stacked[1]),
+        )
         normal = torch.full((track_mask.size(0), 5), NAN, device=obs1.device)
-        mask_index = [i for i, m in enumerate(track_mask) if m]
-        for i, h, c, n in zip(mask_index,
-                              hidden_cell_stacked[0],
-                              hidden_cell_stacked[1],
-                              normal_masked):
-            hidden_cell_state[0][i] = h
-            hidden_cell_state[1][i] = c
-            normal[i] = n
+        normal = normal.index_put(mask_index, normal_masked)
 
         return hidden_cell_state, normal
 
@@ -232,23 +210,23 @@ class VAE(torch.nn.Module):
             # -1 because one prediction is done by the encoder already
             prediction_truth = [None for _ in range(n_predict - 1)]
 
-        # initialize: Because of tracks with different lengths and the masked
-        # update, the hidden state for every LSTM needs to be a separate object
-        # in the backprop graph. Therefore: list of hidden states instead of
-        # a single higher rank Tensor.
+        # initialize: Tensor [num_tracks, hidden_dim] of hidden and cell states.
+        # Because of tracks with different lengths, every step only updates
+        # the rows of the tracks present (see step) without modifying the
+        # states of the previous step in place.
         num_tracks = observed.size(1)
         hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
         )
 
         ## Reset LSTMs of Interaction Encoders.
         if self.pool is not None:
             self.pool.reset(num_tracks, device=observed.device)
 
-        # list of predictions store a dictionary. Each key corresponds to one mode
-        normals = {mode: [] for mode in range(self.num_modes)} # predicted normal parameters for both phases
-        positions = {mode: [] for mode in range(self.num_modes)} # true (during obs phase) and predicted positions
+        # list of predictions
+        normals = []  # predicted normal parameters for both phases
+        positions = []  # true (during obs phase) and predicted positions
 
         # encoder
         for obs1, obs2 in zip(observed[:-1], observed[1:]):
@@ -256,9 +234,8 @@ class VAE(torch.nn.Module):
             hidden_cell_state, normal = self.step(self.obs_encoder, hidden_cell_state, obs1, obs2, goals, batch_split)
 
             # concat predictions
-            for mode_n, mode_p in zip(normals.keys(), positions.keys()):
-                normals[mode_n].append(normal)
-                positions[mode_p].append(obs2 + normal[:, :2]) # no sampling, just mean
+            normals.append(normal)
+            positions.append(obs2 + normal[:, :2]) # no sampling, just mean
     
         # initialize predictions with last position to form velocity. DEEP COPY !!!
         prediction_truth = copy.deepcopy(list(itertools.chain.from_iterable(
@@ -270,8 +247,8 @@ class VAE(torch.nn.Module):
             assert prediction_truth is not None
             # Initialize hidden cell state for prediction encoder
             hidden_cell_state_pred = (
-                [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-                [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+                torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+                torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
             )
 
             ## Encode
@@ -298,35 +275,81 @@ class VAE(torch.nn.Module):
             z_distr_x = torch.cat((z_mu_obs, z_var_log_obs), dim=1)
         ########################################################
 
-        # Make num_modes predictions
-        for k in range(self.num_modes):
-            hidden_cell_state_dec = self.add_noise(hidden_cell_state, z_mu, z_var_log, z_mu_obs, z_var_log_obs)
+        ## Decode the modes as copies of the scenes of the batch, all in one pass.
+        ## Pairwise recurrent states of interaction encoders grow quadratically with
+        ## the number of copies: for them, the modes are decoded one at a time
+        ## (from the same encoding).
+        pool_state = getattr(self.pool, 'hidden_cell_state', None)
+        pairwise_state = pool_state is not None and pool_state[0].dim() == 3
+        modes_per_pass = 1 if pairwise_state else self.num_modes
+
+        rel_pred_scene, pred_scene = [], []
+        for _ in range(0, self.num_modes, modes_per_pass):
+            if pairwise_state:
+                self.pool.hidden_cell_state = pool_state
+            hidden_cell_state_dec = self.add_noise(
+                (hidden_cell_state[0].repeat(modes_per_pass, 1), hidden_cell_state[1].repeat(modes_per_pass, 1)),
+                z_mu, z_var_log, z_mu_obs, z_var_log_obs, modes_per_pass)
+            rel_pred_modes, pred_modes = self.decode(hidden_cell_state_dec, normals, positions, prediction_truth,
+                                                     goals, batch_split, modes_per_pass)
+            rel_pred_scene += rel_pred_modes.chunk(modes_per_pass, dim=1)
+            pred_scene += pred_modes.chunk(modes_per_pass, dim=1)
 
-            # decoder, predictions
-            for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
-                if obs1 is None:
-                    obs1 = positions[k][-2].detach()  # DETACH!!!
-                else:
-                    for primary_id in batch_split[:-1]:
-                        obs1[primary_id] = positions[k][-2][primary_id].detach()  # DETACH!!!
-                if obs2 is None:
-                    obs2 = positions[k][-1].detach()
-                else:
-                    for primary_id in batch_split[:-1]:
-                        obs2[primary_id] = positions[k][-1][primary_id].detach()  # DETACH!!!
-                hidden_cell_state_dec, normal = self.step(self.decoder, hidden_cell_state_dec, obs1, obs2, goals, batch_split)
-                # concat predictions
-                normals[k].append(normal)
-                positions[k].append(obs2 + normal[:, :2])  # no sampling, just mean
+        return rel_pred_scene, pred_scene, z_distr_xy, z_distr_x
+
+    def decode(self, hidden_cell_state, normals, positions, prediction_truth, goals, batch_split, k=1):
+        """Decode k modes of the predictions of an encoded batch in parallel
+
+        Parameters
+        ----------
+        hidden_cell_state : tuple (hidden_state, cell_state) of Tensors [k * num_tracks, hidden_dim]
+            Decoder hidden_cell_state of k copies of the batch, each with its own latent sample
+        normals : List of Tensors [num_tracks, 5]
+            Normals predicted by the observation encoder
+        positions : List of Tensors [num_tracks, 2]
+            Positions predicted by the observation encoder
+        prediction_truth : List of Tensors [num_tracks, 2] (or None during test time)
+            Last observed positions followed by the ground truth positions
+        goals : Tensor [num_tracks, 2]
+        batch_split : Tensor [batch_size + 1]
+        k : Int
+            Number of modes
+
+        Returns
+        -------
+        rel_pred_scene : Tensor [seq_length - 1, k * num_tracks, 5]
+        pred_scene : Tensor [seq_length - 1, k * num_tracks, 2]
+        """
+        normals = [normal.repeat(k, 1) for normal in normals]
+        positions = [position.repeat(k, 1) for position in positions]
+        prediction_truth = [obs if obs is None else obs.repeat(k, 1) for obs in prediction_truth]
+        goals = goals.repeat(k, 1)
+        batch_split = repeat_split(batch_split, k)
+        if self.pool is not None:
+            repeat_pool_state(self.pool, k)
+
+        # decoder, predictions
+        for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
+            if obs1 is None:
+                obs1 = positions[-2].detach()  # DETACH!!!
+            else:
+                for primary_id in batch_split[:-1]:
+                    obs1[primary_id] = positions[-2][primary_id].detach()  # DETACH!!!
+            if obs2 is None:
+                obs2 = positions[-1].detach()
+            else:
+                for primary_id in batch_split[:-1]:
+                    obs2[primary_id] = positions[-1][primary_id].detach()  # DETACH!!!
+            hidden_cell_state, normal = self.step(self.decoder, hidden_cell_state, obs1, obs2, goals, batch_split)
+            # concat predictions
+            normals.append(normal)
+            positions.append(obs2 + normal[:, :2])  # no sampling, just mean
 
         # Pred_scene: Tensor [seq_length, num_tracks, 2]
         #    Absolute positions of all pedestrians
         # Rel_pred_scene: Tensor [seq_length, num_tracks, 5]
         #    Velocities of all pedestrians
-        rel_pred_scene = [torch.stack(normals[mode_n], dim=0) for mode_n in normals.keys()]
-        pred_scene = [torch.stack(positions[mode_p], dim=0) for mode_p in positions.keys()]
-
-        return rel_pred_scene, pred_scene, z_distr_xy, z_distr_x
+        return torch.stack(normals, dim=0), torch.stack(positions, dim=0)
 
 class VAEEncoder(torch.nn.Module):
 
@@ -339,7 +362,6 @@ class VAEEncoder(torch.nn.Module):
         self.relu = torch.nn.ReLU()
 
     def forward(self, inputs):
-        inputs = torch.stack(inputs)
         inputs = torch.reshape(inputs, shape=(-1, self.input_dim))
         z_mu = self.relu(self.fc_mu(inputs))
         z_log_var = 0.01 + self.relu(self.fc_var(inputs))